@@ -0,0 +1,370 @@
+'''
+Benchmarks for fsdetect, results are printed as JSON to be compared
+across versions:
+
+    $ python benchmarks/run.py --output results.json
+
+Runs on a tmpfs (/dev/shm) by default so disk speed doesn't affect the
+results. Sizes of the trees used by the startup benchmark can be changed
+with --tree-sizes, the ones bigger than fs.inotify.max_user_watches are
+skipped.
+
+'''
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+import pyinotify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fsdetect import Detector, ReplayBackend
+from fsdetect import _Recorder
+
+
+def bench_check_throughput(basedir, events, raw_reader=False):
+    '''
+    Events per second through check() -> _on_event -> notify_handlers_2,
+    for files created before calling check()
+
+    '''
+    directory = make_dir(basedir, 'throughput-raw' if raw_reader else 'throughput')
+    counter = Counter()
+    detector = Detector(directory, raw_reader=raw_reader)
+    detector.on('create', counter)
+
+    handled = 0
+    elapsed = 0
+    # the kernel queue holds max_queued_events, create files in chunks
+    chunk = min(events, max_queued_events() // 2)
+    while handled < events:
+        for i in range(handled, min(events, handled + chunk)):
+            open(os.path.join(directory, str(i)), 'w').close()
+        start = time.time()
+        detector.check()
+        elapsed += time.time() - start
+        handled = counter.count
+
+    return {'events': handled, 'seconds': elapsed,
+            'events_per_second': handled / elapsed}
+
+
+def bench_dispatch_throughput(basedir, events):
+    '''
+    Events per second through _on_event -> notify_handlers_2 only, without
+    reading from the kernel
+
+    '''
+    directory = make_dir(basedir, 'dispatch')
+    counter = Counter()
+    detector = Detector(directory)
+    detector.on('create', counter)
+
+    raw_events = [raw_event(pyinotify.IN_CREATE, os.path.join(directory, str(i)))
+                  for i in range(events)]
+    start = time.time()
+    for event in raw_events:
+        detector._on_event(event)
+    elapsed = time.time() - start
+
+    return {'events': counter.count, 'seconds': elapsed,
+            'events_per_second': counter.count / elapsed}
+
+
+def bench_replay_throughput(basedir, events):
+    '''
+    Events per second replayed from a recorded log as fast as possible,
+    through check() -> _on_event -> notify_handlers_2
+
+    '''
+    directory = make_dir(basedir, 'replay')
+    log = os.path.join(basedir, 'replay.log')
+    recorder = _Recorder(log)
+    now = time.time()
+    for i in range(events):
+        recorder.add(raw_event(pyinotify.IN_CREATE, os.path.join(directory, str(i))), now)
+        if i % 1000 == 999:
+            recorder.flush()
+    recorder.close()
+
+    counter = Counter()
+    backend = ReplayBackend(log)
+    detector = Detector(directory, backend=backend)
+    detector.on('create', counter)
+    start = time.time()
+    while not backend.done:
+        detector.check()
+    elapsed = time.time() - start
+
+    return {'events': counter.count, 'seconds': elapsed,
+            'events_per_second': counter.count / elapsed,
+            'log_bytes_per_event': os.path.getsize(log) / float(events)}
+
+
+def bench_latency(basedir, events, interval):
+    '''
+    Time between creating a file and its handler being called, with a
+    thread calling check() in a loop
+
+    '''
+    directory = make_dir(basedir, 'latency')
+    created = {}
+    latencies = []
+
+    def on_create(event):
+        latencies.append(time.time() - created[event.pathname])
+
+    detector = Detector(directory)
+    detector.on('create', on_create)
+
+    stop = threading.Event()
+    def loop():
+        while not stop.is_set():
+            detector.check()
+    thread = threading.Thread(target=loop)
+    thread.start()
+    try:
+        for i in range(events):
+            pathname = os.path.join(directory, str(i))
+            created[pathname] = time.time()
+            open(pathname, 'w').close()
+            time.sleep(interval)
+        deadline = time.time() + 5
+        while len(latencies) < events and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        thread.join()
+
+    latencies.sort()
+    return {
+        'events': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def bench_startup(basedir, sizes, workers):
+    '''
+    Time to watch trees of different sizes, with `on()` and with
+    `watch()` using multiple threads, and Python memory used per
+    watched directory
+
+    '''
+    results = []
+    limit = max_user_watches()
+    for size in sizes:
+        if size >= limit:
+            results.append({'directories': size, 'skipped': 'max_user_watches'})
+            continue
+        directory = make_tree(make_dir(basedir, 'startup-{0}'.format(size)), size)
+        result = {'directories': size}
+
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time.time()
+        detector = Detector(directory)
+        detector.on('create', Counter())
+        result['on_seconds'] = time.time() - start
+        if tracemalloc is not None:
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            result['bytes_per_directory'] = memory / float(size)
+        close(detector)
+
+        start = time.time()
+        detector = Detector(directory)
+        detector.watch(['create'], workers=workers)
+        result['watch_seconds'] = time.time() - start
+        result['watch_workers'] = workers
+        close(detector)
+
+        shutil.rmtree(directory)
+        results.append(result)
+    return results
+
+
+def bench_moves(basedir, moves):
+    '''
+    Cost of pairing IN_MOVED_FROM and IN_MOVED_TO for bulk renames, with
+    all IN_MOVED_FROM arriving before the IN_MOVED_TO (the worst case)
+    and for real renames
+
+    '''
+    directory = make_dir(basedir, 'moves')
+    counter = Counter()
+    detector = Detector(directory)
+    detector.on('move', counter)
+
+    raw_events = []
+    for i in range(moves):
+        raw_events.append(raw_event(pyinotify.IN_MOVED_FROM,
+                                    os.path.join(directory, 'a{0}'.format(i)), i + 1))
+    for i in range(moves):
+        raw_events.append(raw_event(pyinotify.IN_MOVED_TO,
+                                    os.path.join(directory, 'b{0}'.format(i)), i + 1))
+    start = time.time()
+    for event in raw_events:
+        detector._on_event(event)
+    interleaved = time.time() - start
+
+    real_moves = min(moves, max_queued_events() // 4)
+    for i in range(real_moves):
+        open(os.path.join(directory, 'c{0}'.format(i)), 'w').close()
+    counter.count = 0
+    for i in range(real_moves):
+        os.rename(os.path.join(directory, 'c{0}'.format(i)),
+                  os.path.join(directory, 'd{0}'.format(i)))
+    start = time.time()
+    while counter.count < real_moves:
+        detector.check()
+    renames = time.time() - start
+
+    return {
+        'moves': moves,
+        'interleaved_us_per_move': interleaved / moves * 1e6,
+        'renames': real_moves,
+        'renames_us_per_move': renames / real_moves * 1e6,
+    }
+
+
+#
+# helpers
+#
+
+class Counter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, event):
+        self.count += 1
+
+
+def raw_event(mask, pathname, cookie=0):
+    return pyinotify.Event({'mask': mask, 'pathname': pathname, 'cookie': cookie,
+                            'maskname': pyinotify.EventsCodes.maskname(mask)})
+
+
+def make_dir(basedir, name):
+    directory = os.path.join(basedir, name)
+    os.mkdir(directory)
+    return directory
+
+
+def make_tree(directory, size, fanout=10):
+    '''
+    Creates `size` directories in total inside `directory`, each with up
+    to `fanout` subdirectories
+
+    '''
+    parents = [directory]
+    created = 0
+    while created < size:
+        children = []
+        for parent in parents:
+            for i in range(fanout):
+                if created == size:
+                    break
+                child = os.path.join(parent, str(i))
+                os.mkdir(child)
+                children.append(child)
+                created += 1
+        parents = children
+    return directory
+
+
+def close(detector):
+    detector._backend.notifier.stop()
+
+
+def percentile(values, percent):
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def read_int(path, default):
+    try:
+        with open(path) as fileobj:
+            return int(fileobj.read())
+    except (IOError, ValueError):
+        return default
+
+
+def max_user_watches():
+    return read_int('/proc/sys/fs/inotify/max_user_watches', 8192)
+
+
+def max_queued_events():
+    return read_int('/proc/sys/fs/inotify/max_queued_events', 16384)
+
+
+def default_basedir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fsdetect benchmarks')
+    parser.add_argument('--dir', default=default_basedir(),
+                        help='where to create the test files (default: %(default)s)')
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--latency-events', type=int, default=1000)
+    parser.add_argument('--latency-interval', type=float, default=0.001,
+                        help='seconds between files created for latency')
+    parser.add_argument('--tree-sizes', default='1000,10000,100000',
+                        help='comma separated number of directories')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--moves', type=int, default=10000)
+    parser.add_argument('--output', help='file to write the results, default stdout')
+    args = parser.parse_args()
+
+    basedir = tempfile.mkdtemp(prefix='fsdetect-bench-', dir=args.dir)
+    try:
+        results = {
+            'python': platform.python_version(),
+            'kernel': platform.release(),
+            'time': time.time(),
+            'check_throughput': bench_check_throughput(basedir, args.events),
+            'check_throughput_raw_reader': bench_check_throughput(basedir, args.events,
+                                                                  raw_reader=True),
+            'dispatch_throughput': bench_dispatch_throughput(basedir, args.events),
+            'replay_throughput': bench_replay_throughput(basedir, args.events),
+            'latency': bench_latency(basedir, args.latency_events,
+                                     args.latency_interval),
+            'startup': bench_startup(basedir,
+                                     [int(size) for size in args.tree_sizes.split(',')],
+                                     args.workers),
+            'moves': bench_moves(basedir, args.moves),
+        }
+    finally:
+        shutil.rmtree(basedir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fileobj:
+            fileobj.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+'''
+Example of watching the directory recursivelly using asyncio,
+handlers are fired as soon as the events arrive, no need to
+call `check()` periodically.
+
+Requires python 3.5+
+
+'''
+import asyncio
+from fsdetect import Detector
+
+
+async def on_create(event):
+    # coroutine handlers are awaited before the next handler
+    # on the chain is called
+    await asyncio.sleep(0)
+    print('created: ', event.pathname)
+
+
+async def print_deleted(detector):
+    async for event in detector.events('delete'):
+        print('deleted: ', event.pathname)
+
+
+loop = asyncio.get_event_loop()
+
+detector = Detector('/tmp/files')
+detector.on('create', on_create)
+detector.attach(loop)
+
+loop.run_until_complete(print_deleted(detector))
@@ -1,55 +1,303 @@
 import time
 import os
+import re
+import sys
+import errno
+import select
+import stat
+import hashlib
+import mmap
+import array
+import fcntl
+import struct
+import termios
+import bisect
+import fnmatch
+import logging
+import threading
+from functools import reduce
 from collections import defaultdict
+from collections import deque
 from collections import namedtuple
+from collections import OrderedDict
 
-import pyinotify
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    scandir = None
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # python 2 without the 'futures' backport
+    ThreadPoolExecutor = None
 
-__all__ = 'Detector', 'Event'
 
+log = logging.getLogger('fsdetect')
+
+
+__all__ = ('Detector', 'Event', 'MOVE', 'READY', 'TREE_CHANGED', 'PrometheusExporter',
+           'InotifyBackend', 'PollingBackend', 'FanotifyBackend', 'ReplayBackend')
+
+
+# inotify masks, the same as pyinotify's. pyinotify is only imported when
+# the inotify backend starts watching
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+ALL_EVENTS = 0x00000fff
+
+# key used for the 'move' event, pairs of IN_MOVED_FROM and IN_MOVED_TO
+MOVE = IN_MOVED_FROM | IN_MOVED_TO
+
+# key used for the 'ready' event, synthesized when a file is completely
+# written, not an inotify bit
+READY = 0x00100000
+
+# key used for the 'tree_changed' event, a summary of a burst of events in
+# a subtree, not an inotify bit
+TREE_CHANGED = 0x00200000
+
+
+class Event(namedtuple('Event', ('pathname', 'src_pathname'))):
+    '''
+    Received by the handlers, see `Detector.on()`.
+
+    It's still a (pathname, src_pathname) tuple, the other fields are
+    attributes: `mask` is the inotify mask of the event, without IN_ISDIR
+    (`MOVE` for 'move' events, `READY` for 'ready') and `is_dir` tells if
+    it happened to a directory.
+
+    `fingerprint` is the hash of the file contents for 'modify' and
+    'close_write' events when fingerprinting is enabled, otherwise None.
+
+    `counts` and `paths` are only set for 'tree_changed' events: the
+    number of events summarized per event name, like {'create': 5000},
+    and up to `Detector.aggregate_paths` of their pathnames (None if not
+    kept).
+
+    '''
+
+    _attributes = ('mask', 'is_dir', 'fingerprint', 'counts', 'paths')
+
+    def __new__(cls, pathname, src_pathname=None, mask=None, is_dir=False,
+                fingerprint=None, counts=None, paths=None):
+        event = super(Event, cls).__new__(cls, pathname, src_pathname)
+        event.mask = mask
+        event.is_dir = is_dir
+        event.fingerprint = fingerprint
+        event.counts = counts
+        event.paths = paths
+        return event
+
+    @property
+    def name(self):
+        '''
+        Event name as used in `Detector.on()`, like 'create' or 'move'
+
+        '''
+        return _event_name(self.mask)
+
+    def _values(self):
+        return tuple(self) + tuple(getattr(self, name) for name in self._attributes)
+
+    def _replace(self, **fields):
+        values = dict(zip(self._fields + self._attributes, self._values()))
+        values.update(fields)
+        return type(self)(**values)
+
+    def __eq__(self, other):
+        # compares like a tuple, unless both are events
+        if isinstance(other, Event):
+            return self._values() == other._values()
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = tuple.__hash__
+
+    def __reduce__(self):
+        return type(self), self._values()
+
+    def __repr__(self):
+        return 'Event({0})'.format(', '.join(
+            '{0}={1!r}'.format(name, value)
+            for name, value in zip(self._fields + self._attributes, self._values())))
 
-Event = namedtuple('Event', ('pathname', 'src_pathname'))
 
 class Detector(object):
     '''
-    Watches for events on a single file or directory
+    Watches for events on a single file or directory, or on a list of them
+    (see `add_root()`) using a single inotify instance.
+
+    `backend` is 'inotify' (the default), 'polling' for filesystems where
+    inotify doesn't work (NFS, FUSE), 'fanotify' to watch huge trees
+    without a watch per directory or a backend object, see
+    `InotifyBackend`, `PollingBackend`, `FanotifyBackend` and
+    `ReplayBackend`.
 
     Multiple calls to `on()` can be made to detect multiple events.
     `check()` needs to be called periodically to call fire the event
     handlers.
 
+    `coalesce_ms` enables merging of repeated events for the same path,
+    see `_Coalescer` for the accepted values.
+
+    `resync` keeps a snapshot of the tree to synthesize the events lost
+    when the kernel event queue overflows, see `on('overflow', ...)`.
+
+    `exclude` and `include` are lists of rules to ignore paths, see
+    `_PathFilter`. Hidden files and directories are always ignored.
+
+    `snapshot` is the path of a file where the snapshot of `resync` is
+    stored, updated as events are received. When watching starts the tree
+    is compared with it and the changes made while nothing was watching
+    are sent to the handlers, see `_StoredSnapshot`.
+
+    `fingerprint` hashes the contents of files on 'modify' and
+    'close_write' events, in a separate thread, and only delivers them if
+    the contents changed. See `_Fingerprinter`.
+
+    `max_watches` limits the number of inotify watches, the directories
+    that don't fit are polled instead, see `_WatchBudget`. Only for the
+    inotify backend.
+
+    `lazy_depth` only watches the directories up to that many levels
+    under the roots at first, deeper ones are watched when something
+    happens in their parent or by a slow crawl, see `_LazyWatches`. Only
+    for the inotify backend, and not with `max_watches`.
+
+    `metrics` enables the counters and histograms of `stats()`.
+
+    `raw_reader` reads and parses the events directly instead of using
+    pyinotify's `Notifier`, allocating less objects per event. Only for
+    the inotify backend.
+
     '''
 
     check_timeout = 10  # milliseconds
+    read_timeout = 100  # milliseconds, used by the reader thread of `start()`
+    move_timeout = 100  # milliseconds to wait for the IN_MOVED_TO of a move
+    ready_timeout = 1000  # milliseconds without writes after IN_CLOSE_WRITE for 'ready'
+    aggregate_events = 1000  # events in a subtree within aggregate_ms that start a burst
+    aggregate_ms = 1000  # milliseconds, also the quiet period that ends a burst
+    aggregate_paths = None  # pathnames kept in 'tree_changed' events, None for none
+
+    # events needed to keep the `resync` snapshot up to date
+    snapshot_mask = (IN_CREATE | IN_DELETE |
+                     IN_MOVED_FROM | IN_MOVED_TO |
+                     IN_CLOSE_WRITE)
+
+    # events needed to synthesize 'ready'
+    ready_mask = (IN_CREATE | IN_DELETE | IN_MODIFY |
+                  IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CLOSE_WRITE)
 
-    def __init__(self, directory):
-        self._directory = directory
-        self._manager = pyinotify.WatchManager(
-            exclude_filter=is_hidden
-        )
-        self._notifier = pyinotify.Notifier(
-            self._manager,
-            self._on_event,
-            timeout=self.check_timeout,
-        )
-        self._wds = None
+    # events summarized by 'tree_changed', besides the ones watched by
+    # other handlers
+    aggregate_mask = (IN_CREATE | IN_DELETE |
+                      IN_MOVED_FROM | IN_MOVED_TO |
+                      IN_CLOSE_WRITE)
+
+    def __init__(self, directory, coalesce_ms=None, resync=False,
+                 exclude=None, include=None, raw_reader=False, snapshot=None,
+                 fingerprint=False, metrics=False, max_watches=None, backend='inotify',
+                 lazy_depth=None):
+        if isinstance(directory, (list, tuple)):
+            self._roots = [_normalize(root) for root in directory]
+        else:
+            self._roots = [_normalize(directory)]
+        self._root_set = set(self._roots)
+        self._filter = _PathFilter(self._root_set, exclude, include)
+        if backend == 'inotify':
+            backend = InotifyBackend(raw_reader, max_watches, lazy_depth)
+        elif raw_reader or max_watches is not None or lazy_depth is not None:
+            raise ValueError('raw_reader, max_watches and lazy_depth require the '
+                             'inotify backend')
+        elif backend == 'polling':
+            backend = PollingBackend()
+        elif backend == 'fanotify':
+            backend = FanotifyBackend()
+        elif not hasattr(backend, 'open'):
+            raise ValueError('invalid backend: {0!r}'.format(backend))
+        self._backend = backend
+        self._backend.open(self._root_set, self._filter)
         self._full_mask = None
-        self._handlers = defaultdict(list)
-        self._previous_moved_from = None
+        self._registrations = []  # (masks or None, kind, root, handler)
+        self._chains = {}         # (mask, is_dir, root) -> handlers
+        self._root_handlers = False
+        self._batch_handlers = defaultdict(list)
+        self._batches = OrderedDict()
+        self._moves = _PendingMoves()
+        self._resyncing = None  # (mask, event) left from a resync
+        self._held = deque()    # raw events read during a resync
+        self._backlog = deque()  # (function, mask, event) left by `check()` limits
+        self._loop = None
+        self._timer = None
+        self._dispatcher = None
+        self._reader = None
+        self._stopping = threading.Event()
+        self._coalescer = None
+        if coalesce_ms is not None:
+            self._coalescer = _Coalescer(coalesce_ms)
+        self._fingerprinter = _Fingerprinter() if fingerprint else None
+        self._ready = None
+        self._aggregator = None
+        self._snapshot = None
+        if snapshot is not None:
+            self._snapshot = _StoredSnapshot(snapshot, self._roots, self._filter.excluded)
+        elif resync:
+            self._snapshot = _Snapshot(self._roots, self._filter.excluded)
+        self._metrics = _Metrics() if metrics else None
+        self._exporters = []  # [exporter, interval, next export]
+        self._recorder = None
+        self.overflows = 0
+        self.resynced = 0
 
-    def on(self, event_name, handler):
+    def on(self, event_name, handler, root=None, kind=None):
         '''
         Adds new handler to event.
 
         `event` is the event name to be watched.
 
         Works for all pyinotify events, with a small syntax change, removing
-        the 'IN_' prefix and lowercase, ex: 'IN_CREATE' becomes 'create'
+        the 'IN_' prefix and lowercase, ex: 'IN_CREATE' becomes 'create'.
+        Multiple events can be given separated by '|', ex: 'create|delete'.
+        The special name '*' receives every event watched because of other
+        calls to `on()` or `watch()`.
 
         There is a special event 'move' that handles 'IN_MOVED_FROM' and
         'IN_MOVED_TO', see README.md for more details.
 
+        The event 'overflow' is fired when the kernel event queue overflowed
+        and events were lost, the handler receives an `Event` with the watched
+        directory as `pathname`.
+
+        The event 'ready' is fired when a file has been completely written:
+        `ready_timeout` milliseconds after its last 'close_write' if it
+        isn't modified again in between, or when it's moved into place.
+        See `_ReadyFiles`.
+
+        The event 'tree_changed' summarizes bulk operations: once
+        `aggregate_events` events happen inside one subtree within
+        `aggregate_ms`, the next ones aren't sent to any handler until the
+        subtree is quiet for `aggregate_ms`, then a single event is fired
+        for their closest common directory. See `_Aggregator`.
+
         `handler` should be a callable.
 
         Multiple calls with same 'event' will chain the handlers, if any handler
@@ -59,81 +307,3817 @@ class Detector(object):
         the same as pyinotify event. Depending on the event being handled it
         can have `pathname` and/or `src_pathname` attributes.
 
+        If `root` is given the handler is only called for events inside that
+        watched directory. These handlers are chained before the ones for
+        every directory.
+
+        `kind` can be 'file' or 'dir' to only receive events for files or
+        directories.
+
+        '''
+        if root is not None:
+            root = _normalize(root)
+            if root not in self._root_set:
+                raise ValueError('not watched: {0}'.format(root))
+            self._root_handlers = True
+        if kind not in (None, 'file', 'dir'):
+            raise ValueError('invalid kind: {0!r}'.format(kind))
+        self._check_not_forked()
+        masks = _event_masks(event_name)
+        if masks is not None:
+            self._watch(reduce(lambda mask, other: mask | other, masks))
+        self._registrations.append((masks, kind, root, handler))
+        self._chains.clear()
+        return self
+
+    def add_root(self, directory):
+        '''
+        Starts watching another file or directory, with the same events and
+        sharing the same inotify instance.
+
+        '''
+        root = _normalize(directory)
+        if root in self._root_set:
+            return self
+        self._roots.append(root)
+        self._root_set.add(root)
+        if self._full_mask is not None:
+            self._backend.watch(self._full_mask, [root])
+            if self._snapshot is not None:
+                self._snapshot.scan()
+        return self
+
+    def on_batch(self, event_name, handler):
+        '''
+        Adds new batch handler to event.
+
+        Works like `on()` but `handler` is called once per `check()` with
+        the list of all `Event` objects of that event received during the
+        call, in the order they were received. It's not called if no event
+        was received.
+
+        Batch handlers are chained the same way as `on()` handlers, but
+        independently from them. '*' isn't accepted, batches are per event.
+
+        '''
+        self._check_not_forked()
+        masks = _event_masks(event_name)
+        if masks is None:
+            raise ValueError("'*' is not supported by on_batch()")
+        for mask in masks:
+            self._watch(mask)
+            self._batch_handlers[mask].append(handler)
+        return self
+
+    def watch(self, event_names=None, workers=1, progress=None):
+        '''
+        Starts watching the directory tree for all `event_names` at once
+        (every inotify event if not given), so later calls to `on()` for
+        any of them don't need to update the watch of every directory.
+
+        Does nothing if the events are already watched.
+
+        Watches are added using `workers` threads, which helps on huge trees.
+        `progress` is called with the number of directories watched so far
+        after each one is added.
+
         '''
-        if event_name == 'move':
-            mask = pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
-            maskname = 'MOVE'
+        if event_names is None:
+            mask = ALL_EVENTS
         else:
-            mask = pyinotify.EventsCodes.OP_FLAGS['IN_' + event_name.upper()]
-            maskname = pyinotify.EventsCodes.maskname(mask)
+            mask = reduce(lambda mask, other: mask | other,
+                          (mask for name in event_names for mask in _event_masks(name)), 0)
+        self._watch(mask, workers, progress)
+        return self
 
-        if self._wds is not None:
+    def _watch(self, mask, workers=1, progress=None):
+        if mask & READY:
+            mask = mask & ~READY | self.ready_mask
+            if self._ready is None:
+                self._ready = _ReadyFiles(self.ready_timeout)
+        if mask & TREE_CHANGED:
+            mask = mask & ~TREE_CHANGED | self.aggregate_mask
+            if self._aggregator is None:
+                self._aggregator = _Aggregator(self._root_set, self.aggregate_events,
+                                               self.aggregate_ms, self.aggregate_paths)
+        if self._snapshot is not None:
+            mask |= self.snapshot_mask
+        if self._full_mask is None:
+            self._full_mask = mask
+            self._backend.watch(mask, self._roots, workers, progress)
+            if self._snapshot is not None:
+                self._snapshot.scan()
+        elif mask & ~self._full_mask:
             self._full_mask |= mask
-            self._manager.update_watch(self._wds.values(), mask=self._full_mask,
-                                       rec=True, auto_add=True)
+            self._backend.update(self._full_mask)
+
+    def check(self, timeout=None, max_events=None, budget_ms=None):
+        '''
+        Must be called periodically to fire the handlers, usually inside
+        a loop in the main application.
+
+        If no events are ready, waits up to `timeout` milliseconds for them
+        (`self.check_timeout` by default, 0 to return right away). Then
+        handles every event available without waiting more.
+
+        `max_events` and `budget_ms` limit the work done by a call: it
+        returns after handling that many events or after that many
+        milliseconds, leaving the rest for the next call (which won't wait
+        for new events while there are some left). Returns the number of
+        events handled, counting the changes found by a resync and the
+        events delivered after being held back.
+
+        When coalescing is enabled events are only delivered here once
+        their quiet period has passed.
+
+        '''
+        start = time.time()
+        deadline = None
+        if budget_ms is not None:
+            deadline = start + budget_ms / 1000.0
+        if timeout is None:
+            timeout = self.check_timeout
+        handled = self._catch_up(max_events, deadline)
+        backend = self._backend
+        if not self._behind() and (backend.queued() or backend.wait(timeout)):
+            while True:
+                if not backend.queued():
+                    backend.read()
+                    if not backend.queued():
+                        break
+                handled += backend.process(
+                    self._on_event, None if max_events is None else max_events - handled,
+                    deadline)
+                # an overflow starts a resync
+                handled += self._catch_up(
+                    None if max_events is None else max_events - handled, deadline)
+                if self._behind() or backend.queued() or not backend.wait(0):
+                    break
+        handled += self._flush(None if max_events is None else max_events - handled, deadline,
+                               start)
+        return handled
+
+    def attach(self, loop=None):
+        '''
+        Integrates with an asyncio event loop, instead of calling `check()`
+        periodically handlers are fired as soon as events are readable.
+
+        Handlers can be coroutine functions, the remaining handlers of the
+        chain are called after the coroutine finishes (unless it returns
+        `True`). Exceptions raised by them are reported to the loop's
+        exception handler.
+
+        Requires python 3.5+
+
+        '''
+        try:
+            import asyncio
+        except ImportError:  # python 2
+            raise RuntimeError('asyncio is not available')
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        if self._backend.fileno() is not None:
+            self._loop.add_reader(self._backend.fileno(), self._on_readable)
+        self._loop.call_soon(self._on_readable)
+        return self
+
+    def detach(self):
+        '''
+        Stops the integration started with `attach()`
+
+        '''
+        if self._loop is None:
+            return
+        if self._backend.fileno() is not None:
+            self._loop.remove_reader(self._backend.fileno())
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._loop = None
+
+    def start(self, executor=None, workers=4, max_pending=1000, overflow='block',
+              processes=None, shard_by='path'):
+        '''
+        Starts a reader thread that continuously reads the events and hands
+        them to a thread pool to run the handlers, instead of calling
+        `check()` periodically. Slow handlers won't delay reading events
+        from the kernel.
+
+        `executor` is a `concurrent.futures.ThreadPoolExecutor` (or
+        compatible) to run the handlers, if not given one with `workers`
+        threads is created.
+
+        Events for the same path are handled in the order they were received,
+        one at a time. Batch handlers are ordered by event.
+
+        `max_pending` limits how many events can be waiting for or running
+        handlers. When the limit is reached `overflow` decides what happens:
+
+          - 'block': reading stops until there is room
+          - 'drop_oldest': the oldest waiting event is dropped
+          - 'coalesce': the new event is dropped if it's equal to one
+            waiting for the same path, otherwise blocks
+
+        Exceptions raised by handlers abort the chain and are logged in the
+        'fsdetect' logger.
+
+        With `processes` the handlers run in that many forked processes
+        instead, for CPU bound handlers, see `_ProcessDispatcher`. Events
+        are sent to a process by the hash of their path, or of the top
+        level subdirectory of the root they're in if `shard_by` is
+        'subdirectory', which keeps the order of the events in each
+        subdirectory. The handlers must be added before calling `start()`,
+        and `executor`, `workers`, `max_pending` and `overflow` are not
+        used: reading blocks while the processes are busy.
+
+        '''
+        if overflow not in _ThreadedDispatcher.overflow_modes:
+            raise ValueError('invalid overflow: {0!r}'.format(overflow))
+        if shard_by not in _ProcessDispatcher.shard_modes:
+            raise ValueError('invalid shard_by: {0!r}'.format(shard_by))
+        if self._reader is not None:
+            raise RuntimeError('already started')
+        if processes is not None:
+            self._dispatcher = _ProcessDispatcher(self, processes, shard_by)
         else:
-            self._full_mask = mask
-            self._wds = self._manager.add_watch(self._directory, mask=self._full_mask,
-                                                rec=True, auto_add=True)
+            owns_executor = executor is None
+            if owns_executor:
+                if ThreadPoolExecutor is None:
+                    raise RuntimeError('concurrent.futures is not available')
+                executor = ThreadPoolExecutor(workers)
+            self._dispatcher = _ThreadedDispatcher(executor, max_pending, overflow,
+                                                   owns_executor)
+        self._stopping.clear()
+        self._reader = threading.Thread(target=self._read_loop,
+                                        name='fsdetect-reader')
+        self._reader.daemon = True
+        self._reader.start()
+        return self
+
+    def stop(self, wait=True):
+        '''
+        Stops the reader thread started with `start()`. If `wait` is true
+        blocks until all pending events were handled.
+
+        '''
+        if self._reader is None:
+            return
+        self._stopping.set()
+        self._reader.join()
+        self._reader = None
+        self._dispatcher.shutdown(wait)
+        self._dispatcher = None
+
+    def _read_loop(self):
+        while not self._stopping.is_set():
+            self._catch_up()
+            if self._backend.wait(self._read_timeout()):
+                self._read()
+            self._flush()
+
+    def _read_timeout(self):
+        timeout = self.read_timeout
+        deadline = self._next_deadline()
+        if deadline is not None:
+            timeout = max(0, min(timeout, (deadline - time.time()) * 1000))
+        return timeout
+
+    def events(self, event_name, maxsize=0):
+        '''
+        Returns an asynchronous iterator over the `Event` objects received
+        for `event_name`, to be used with `async for` after `attach()`.
+
+        Events are queued until consumed, up to `maxsize` events if
+        not 0, after that new events are dropped.
+
+        '''
+        return _EventStream(self, event_name, maxsize)
+
+    def stats(self):
+        '''
+        Returns a dict with the state of the detector:
+
+        - 'watches': number of watched directories, and 'max_user_watches'
+          the limit of the user (fs.inotify.max_user_watches)
+        - 'polled': number of directories polled, by the polling backend or
+          because of `max_watches`
+        - 'queue_depth': dict of events waiting in each internal queue
+        - 'overflows', 'resynced' and 'dropped' (by `start()`) events
+
+        And, if created with `metrics=True`:
+
+        - 'events_received' and 'events_dispatched': dicts of event name
+          to count, 'events_ignored' the count of `ignored()` events
+        - 'handler_seconds': dict of handler name (with '#2', '#3'...
+          appended for other handlers with the same name) to histogram of
+          the time each call took, 'check_seconds' the histogram for `check()`.
+          Histograms are dicts with 'count', 'sum' and 'buckets', a list
+          of (upper bound, cumulative count)
+
+        '''
+        stats = {
+            'queue_depth': {
+                'moves': len(self._moves),
+                'batches': sum(len(events) for events in self._batches.values()),
+                'coalescer': len(self._coalescer) if self._coalescer is not None else 0,
+                'fingerprints': (len(self._fingerprinter)
+                                 if self._fingerprinter is not None else 0),
+                'ready': len(self._ready) if self._ready is not None else 0,
+                'tree_changed': len(self._aggregator) if self._aggregator is not None else 0,
+                'dispatcher': len(self._dispatcher) if self._dispatcher is not None else 0,
+                'backlog': len(self._backlog) + len(self._held),
+            },
+            'overflows': self.overflows,
+            'resynced': self.resynced,
+            'dropped': self._dispatcher.dropped if self._dispatcher is not None else 0,
+        }
+        stats.update(self._backend.stats())
+        if self._metrics is not None:
+            stats.update(self._metrics.stats())
+        return stats
 
-        self._handlers[maskname].append(handler)
+    def add_exporter(self, exporter, interval=10):
+        '''
+        Calls `exporter` with `stats()` every `interval` seconds, from
+        `check()` (or the thread of `start()`, or the asyncio loop). See
+        `PrometheusExporter`.
+
+        '''
+        self._exporters.append([exporter, interval, 0])
         return self
 
-    def check(self):
+    def record(self, path):
         '''
-        Must be called periodically to fire the handlers, usually inside
-        a loop in the main application.
+        Starts appending the events received to the log file `path`, to
+        replay them later with `ReplayBackend`. They're written once per
+        `check()`. Stops recording if `path` is None.
+
+        '''
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        if path is not None:
+            self._recorder = _Recorder(path)
+        return self
 
-        Will block for `self.check_timeout` milliseconds
+    def _export(self, now):
+        stats = None
+        for exporter in self._exporters:
+            if now < exporter[2]:
+                continue
+            exporter[2] = now + exporter[1]
+            if stats is None:
+                stats = self.stats()
+            try:
+                exporter[0](stats)
+            except Exception:
+                log.exception('Error exporting stats')
+
+    def _on_readable(self):
+        self._catch_up()
+        self._read()
+        self._flush()
+
+    def _read(self):
+        self._backend.read()
+        self._backend.process(self._on_event)
+
+    def _catch_up(self, max_events=None, deadline=None):
+        '''
+        Sends what is left from the last call to `_flush()`, the changes
+        found by a resync (after an overflow, or compared with a stored
+        snapshot before watching the tree) and then the events read
+        meanwhile. Stops after `max_events` of them or at `deadline`, the
+        next call goes on from there. Returns how many were sent
+
+        '''
+        if self._resyncing is None and self._snapshot is not None and self._snapshot.stale:
+            self._resyncing = iter(self._snapshot.resync())
+        handled = 0
+        while not _limit_reached(handled, max_events, deadline):
+            if self._backlog:
+                function, mask, event = self._backlog.popleft()
+                function(mask, event)
+            elif self._resyncing is not None:
+                change = next(self._resyncing, None)
+                if change is None:
+                    self._resyncing = None
+                    continue
+                self._dispatch(*change)
+            elif self._held:
+                self._handle_raw_event(self._held.popleft())
+            else:
+                break
+            handled += 1
+        return handled
+
+    def _behind(self):
+        '''
+        Returns True if `_catch_up()` has something left to send
+
+        '''
+        return bool(self._backlog or self._resyncing is not None or self._held)
+
+    def _flush(self, max_events=None, deadline=None, check_start=None):
+        '''
+        Sends the events held back whose time has come, up to `max_events`
+        or until `deadline` (the rest is sent by the next call), and
+        flushes the batches, the stored snapshot and the exporters. When
+        called by `check()`, its time since `check_start` is recorded
+        first so that it's exported. Returns how many events (or batches)
+        were sent
 
         '''
-        self._notifier.process_events()
-        while self._notifier.check_events():
-            self._notifier.read_events()
-            self._notifier.process_events()
+        now = time.time()
+        backlog = self._backlog
+        backlog.extend((self._dispatch, MOVE, moved_from)
+                       for moved_from in self._moves.expired(now) if moved_from is not None)
+        if self._aggregator is not None:
+            backlog.extend((self._deliver, TREE_CHANGED, changed)
+                           for changed in self._aggregator.expired(now))
+        if self._coalescer is not None:
+            backlog.extend((self._deliver, mask, event)
+                           for mask, event in self._coalescer.expired(now))
+        if self._ready is not None:
+            backlog.extend((self._deliver, READY, ready) for ready in self._ready.expired(now))
+        if self._fingerprinter is not None:
+            backlog.extend((self.notify_handlers_2, mask, event)
+                           for mask, event in self._fingerprinter.done())
+        handled = self._catch_up(max_events, deadline)
+        if self._loop is not None:
+            self._schedule_flush(self._next_deadline(), now)
+        if self._snapshot is not None:
+            self._snapshot.flush()
+        handled += self._notify_batch_handlers(
+            None if max_events is None else max_events - handled, deadline)
+        if self._dispatcher is not None:
+            self._dispatcher.flush()
+        if self._recorder is not None:
+            self._recorder.flush()
+        if check_start is not None and self._metrics is not None:
+            self._metrics.check.observe(time.time() - check_start)
+        if self._exporters:
+            self._export(now)
+        return handled
+
+    def _next_deadline(self):
+        deadlines = [self._moves.next_deadline()]
+        if self._coalescer is not None:
+            deadlines.append(self._coalescer.next_deadline())
+        if self._fingerprinter is not None:
+            deadlines.append(self._fingerprinter.next_deadline())
+        if self._ready is not None:
+            deadlines.append(self._ready.next_deadline())
+        if self._aggregator is not None:
+            deadlines.append(self._aggregator.next_deadline())
+        deadlines.append(self._backend.next_deadline())
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def _schedule_flush(self, deadline, now):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if deadline is not None:
+            self._timer = self._loop.call_later(deadline - now, self._on_readable)
 
     def ignored(self, raw_event):
         '''
         Called when any event is received to verify if it should be ignored.
-        By default ignores hidden files.
+        By default ignores hidden files and the `exclude`/`include` rules.
 
         '''
-        return is_hidden(raw_event.pathname)
+        return self._filter.excluded(raw_event.pathname,
+                                     raw_event.mask & IN_ISDIR)
 
     def _on_event(self, raw_event):
-        if self.ignored(raw_event):
-            return
-        elif raw_event.mask & pyinotify.IN_MOVED_FROM:
-            self._handle_previous_moved_from()
-            self._previous_moved_from = raw_event
-        elif raw_event.mask & pyinotify.IN_MOVED_TO:
-            self._previous_moved_from = None
-            event = Event(raw_event.pathname, getattr(raw_event, 'src_pathname', None))
-            self.notify_handlers_2('MOVE', event)
+        if self._recorder is not None:
+            self._recorder.add(raw_event, time.time())
+        if self._metrics is not None:
+            self._metrics.received[raw_event.mask & ~IN_ISDIR] += 1
+        if self._resyncing is not None:
+            # handled once the resync is over, it could report them again
+            self._held.append(raw_event)
+            return
+        self._handle_raw_event(raw_event)
+
+    def _handle_raw_event(self, raw_event):
+        if raw_event.mask & IN_Q_OVERFLOW:
+            self._on_overflow()
+            return
+        elif self.ignored(raw_event):
+            if self._metrics is not None:
+                self._metrics.ignored += 1
+            return
+        if self._snapshot is not None:
+            self._snapshot.record(raw_event)
+        mask = raw_event.mask
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM:
+            self._handle_moved_from(self._moves.pop_pathname(raw_event.pathname))
+            self._moves.add(raw_event.cookie, Event(None, raw_event.pathname, MOVE, is_dir),
+                            time.time() + self.move_timeout / 1000.0)
+        elif mask & IN_MOVED_TO:
+            moved_from = self._moves.pop(raw_event.cookie)
+            if moved_from is not None:
+                src_pathname = moved_from.src_pathname
+            else:
+                # the IN_MOVED_FROM could have been ignored, pyinotify knows it
+                src_pathname = getattr(raw_event, 'src_pathname', None)
+            self._handle_moved_from(self._moves.pop_pathname(raw_event.pathname))
+            self._dispatch(MOVE, Event(raw_event.pathname, src_pathname, MOVE, is_dir))
+        else:
+            # a path moved out must be reported before new events for it
+            self._handle_moved_from(self._moves.pop_pathname(raw_event.pathname))
+            for event_mask in _split_mask(mask):
+                self._dispatch(event_mask, Event(raw_event.pathname, None, event_mask, is_dir))
+
+    def _on_overflow(self):
+        self.overflows += 1
+        for moved_from in self._moves.pop_all():
+            self._handle_moved_from(moved_from)
+        for root in self._roots:
+            self._dispatch(IN_Q_OVERFLOW,
+                           Event(root, None, IN_Q_OVERFLOW, True))
+        if self._snapshot is not None:
+            # sent by `_catch_up()`, the next events are held until then
+            self._resyncing = self._overflow_changes()
+
+    def _overflow_changes(self):
+        watched = []  # new directories watched with their subtrees
+        for mask, event in self._snapshot.resync():
+            self.resynced += 1
+            if event.is_dir and mask in (IN_CREATE, MOVE) and event.pathname is not None \
+                    and not any(_is_inside(event.pathname, directory) for directory in watched):
+                # the events that would have added its watch were lost
+                self._backend.watch(self._full_mask, [event.pathname])
+                watched.append(event.pathname)
+            yield mask, event
+
+    def _handle_moved_from(self, moved_from):
+        if moved_from is not None:
+            self._dispatch(MOVE, moved_from)
+
+    def _dispatch(self, mask, event):
+        if self._aggregator is not None and self._aggregator.add(mask, event, time.time()):
+            return
+        if self._coalescer is None:
+            self._deliver(mask, event)
         else:
-            self._handle_previous_moved_from()
-            event = Event(raw_event.pathname, None)
-            maskname = self._parse_maskname(raw_event)
-            self.notify_handlers_2(maskname, event)
-
-    def _parse_maskname(self, raw_event):
-        if raw_event.mask & pyinotify.IN_ISDIR:
-            return raw_event.maskname.replace('|IN_ISDIR', '')
+            for coalesced_mask, coalesced_event in self._coalescer.add(mask, event,
+                                                                       time.time()):
+                self._deliver(coalesced_mask, coalesced_event)
+        if self._ready is not None:
+            for ready in self._ready.add(mask, event, time.time()):
+                self._deliver(READY, ready)
+
+    def _deliver(self, mask, event):
+        if self._fingerprinter is None:
+            self.notify_handlers_2(mask, event)
+            return
+        for mask, event in self._fingerprinter.add(mask, event):
+            self.notify_handlers_2(mask, event)
+
+    def notify_handlers_2(self, mask, event):
+        if self._metrics is not None:
+            self._metrics.dispatched[mask] += 1
+        if mask in self._batch_handlers:
+            self._batches.setdefault(mask, []).append(event)
+        handlers = self._chain(mask, event)
+        if self._dispatcher is not None:
+            if handlers:
+                self._dispatcher.submit(event.pathname or event.src_pathname,
+                                        list(handlers), event)
         else:
-            return raw_event.maskname
+            self._call_handlers(handlers, event)
+
+    def _chain(self, mask, event):
+        root = None
+        if self._root_handlers:
+            root = self._root_of(event.pathname or event.src_pathname)
+        handlers = self._chains.get((mask, event.is_dir, root))
+        if handlers is None:
+            handlers = self._build_chain(mask, event.is_dir, root)
+        return handlers
+
+    def _build_chain(self, mask, is_dir, root):
+        def matches(masks, kind):
+            return (masks is None or mask in masks) and \
+                (kind is None or (kind == 'dir') == is_dir)
+        handlers = [handler for masks, kind, handler_root, handler in self._registrations
+                    if root is not None and handler_root == root and matches(masks, kind)]
+        handlers.extend(handler for masks, kind, handler_root, handler in self._registrations
+                        if handler_root is None and matches(masks, kind))
+        if self._metrics is not None:
+            handlers = [self._metrics.timed(handler) for handler in handlers]
+        self._chains[(mask, is_dir, root)] = handlers
+        return handlers
+
+    def _check_not_forked(self):
+        if isinstance(self._dispatcher, _ProcessDispatcher):
+            raise RuntimeError('handlers must be added before start() with processes')
+
+    def _remove_handler(self, handler):
+        self._registrations = [registration for registration in self._registrations
+                               if registration[3] is not handler]
+        self._chains.clear()
 
-    def _handle_previous_moved_from(self):
-        if self._previous_moved_from is not None:
-            event = Event(None, self._previous_moved_from.pathname)
-            self.notify_handlers_2('MOVE', event)
-            self._previous_moved_from = None
+    def _root_of(self, pathname):
+        roots = self._root_set
+        while pathname not in roots:
+            parent = os.path.dirname(pathname)
+            if parent == pathname:
+                return None
+            pathname = parent
+        return pathname
 
-    def notify_handlers_2(self, maskname, event):
-        for handler in self._handlers[maskname]:
-            if handler(event):
+    def _notify_batch_handlers(self, max_events=None, deadline=None):
+        handled = 0
+        while self._batches and not _limit_reached(handled, max_events, deadline):
+            mask, events = self._batches.popitem(last=False)
+            handled += 1
+            handlers = self._batch_handlers[mask]
+            if self._metrics is not None:
+                handlers = [self._metrics.timed(handler) for handler in handlers]
+            if self._dispatcher is not None:
+                self._dispatcher.submit(('batch', mask), list(handlers), events)
+            else:
+                self._call_handlers(handlers, events)
+        return handled
+
+    def _call_handlers(self, handlers, event):
+        for i, handler in enumerate(handlers):
+            result = handler(event)
+            if self._loop is not None and _isawaitable(result):
+                remaining = handlers[i + 1:]
+                def resume(future):
+                    if not future.result():
+                        self._call_handlers(remaining, event)
+                _asyncio().ensure_future(result, loop=self._loop).add_done_callback(resume)
+                break
+            if result:
                 break
 
 
+class _RawEvent(object):
+    '''
+    Event read by `_RawReader`, with the attributes of pyinotify events
+    used by `Detector`. `pathname` is only built when needed.
+
+    '''
+    __slots__ = ('wd', 'mask', 'cookie', 'name', 'path', 'src_pathname', '_pathname')
+
+    def __init__(self, wd, mask, cookie, name):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+        self.path = None
+        self.src_pathname = None
+        self._pathname = None
+
+    @property
+    def pathname(self):
+        if self._pathname is None and self.path is not None:
+            if self.name:
+                self._pathname = os.path.join(self.path, self.name)
+            else:
+                self._pathname = self.path
+        return self._pathname
+
+
+def _raw_event(directory, name, mask, is_dir=False, cookie=0):
+    '''
+    Returns a `_RawEvent` for an event generated without inotify
+
+    '''
+    if is_dir:
+        mask |= IN_ISDIR
+    event = _RawEvent(None, mask, cookie, name)
+    event.path = directory
+    return event
+
+
+class InotifyBackend(object):
+    '''
+    Gets the events from inotify, using pyinotify.
+
+    pyinotify is imported, and the inotify fd opened, when watching starts
+    (or `fileno()` is called). A forked process opens its own fd and adds
+    the watches again the first time the backend is used in it, the fd of
+    the parent would share its events.
+
+    Backends are used by `Detector` through these methods:
+
+      - `open(roots, path_filter)` called once, with the set of roots and
+        the `_PathFilter` of the detector
+      - `watch(mask, roots, workers=1, progress=None)` starts watching the
+        `roots` trees for the events in `mask`
+      - `update(mask)` changes the events watched in every directory
+      - `fileno()` returns a file descriptor readable when there are events
+        to read, or None. In that case `next_deadline()` returns when
+        `read()` needs to be called, or None
+      - `wait(timeout)` blocks up to `timeout` milliseconds, returns if
+        there are events to read
+      - `read()` reads the events available into a queue, `queued()`
+        tells if there are events in it
+      - `process(callback, max_events=None, deadline=None)` calls
+        `callback` for each queued event, up to `max_events` or until the
+        `deadline` time. Returns the number of events handled. Events have
+        the `mask`, `pathname`, `cookie` and optionally `src_pathname`
+        attributes of pyinotify events
+      - `stats()` returns a dict merged into `Detector.stats()`
+
+    '''
+
+    def __init__(self, raw_reader=False, max_watches=None, lazy_depth=None):
+        if max_watches is not None and lazy_depth is not None:
+            raise ValueError("max_watches and lazy_depth can't be used together")
+        self._use_raw_reader = raw_reader
+        self._max_watches = max_watches
+        self._lazy_depth = lazy_depth
+        self._polled_events = deque()  # from `budget` and `lazy`
+
+    def open(self, roots, path_filter):
+        self._roots = roots
+        self._filter = path_filter
+        self._pid = None
+        self.manager = self.notifier = self.raw_reader = self.budget = self.lazy = None
+        self._mask = None
+
+    def watch(self, mask, roots, workers=1, progress=None):
+        def add_watch(pathname):
+            return self.manager.add_watch(pathname, mask=mask, rec=False,
+                                          auto_add=True, do_glob=False)
+
+        if not self._opened():
+            self._open()
+        self._mask = mask
+        if self.lazy is not None:
+            directories = (pathname for root in roots for pathname in self.lazy.walk(root))
+        else:
+            directories = (pathname for root in roots
+                           for pathname in _walk_directories(
+                               root, self._filter.excluded_directory,
+                               breadth_first=self.budget is not None))
+        if self.budget is not None:
+            directories = self.budget.split(directories)
+        if workers > 1:
+            if ThreadPoolExecutor is None:
+                raise RuntimeError('concurrent.futures is not available')
+            executor = ThreadPoolExecutor(workers)
+            results = executor.map(add_watch, directories)
+        else:
+            executor = None
+            results = (add_watch(pathname) for pathname in directories)
+
+        wds = {}
+        try:
+            for result in results:
+                wds.update(result)
+                if progress is not None:
+                    progress(len(wds))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if self.budget is not None:
+            self.budget.added(wds)
+
+    def update(self, mask):
+        self._opened()
+        self._mask = mask
+        # every watch, including the ones added automatically for new
+        # directories. not recursive: pyinotify would look for the
+        # subdirectories of each wd among all the others
+        wds = list(self.manager.watches)
+        self.manager.update_watch(wds, mask=mask, auto_add=True)
+        for wd in wds:
+            # used when adding watches for new directories
+            self.manager.watches[wd].mask = mask
+
+    def fileno(self):
+        if not self._opened():
+            self._open()
+        return self.manager.get_fd()
+
+    def next_deadline(self):
+        if self.lazy is not None:
+            return self.lazy.next_deadline()
+        if self.budget is None:
+            return None
+        return self.budget.next_deadline()
+
+    def wait(self, timeout):
+        if not self._opened():
+            time.sleep(timeout / 1000.0)
+            return False
+        deadline = self.next_deadline()
+        if deadline is not None:
+            timeout = max(0, min(timeout, (deadline - time.time()) * 1000))
+        if self.notifier.check_events(timeout):
+            return True
+        return deadline is not None and time.time() >= deadline
+
+    def read(self):
+        if not self._opened():
+            return
+        if self.raw_reader is not None:
+            self.raw_reader.read()
+        elif self.notifier.check_events(0):  # reading nothing would block
+            self.notifier.read_events()
+        if self.budget is not None and self._mask is not None:
+            self._polled_events.extend(self.budget.poll(time.time(), self._mask))
+        if self.lazy is not None and self._mask is not None:
+            self._polled_events.extend(self.lazy.crawl(time.time(), self._mask))
+
+    def queued(self):
+        if not self._opened():
+            return False
+        if self._polled_events:
+            return True
+        if self.raw_reader is not None:
+            return bool(self.raw_reader.queue)
+        return bool(self.notifier._eventq)
+
+    def process(self, callback, max_events=None, deadline=None):
+        if not self._opened():
+            return 0
+        if self.budget is not None:
+            callback = self._touching(callback)
+        elif self.lazy is not None:
+            callback = self._expanding(callback)
+        handled = 0
+        while self._polled_events and not _limit_reached(handled, max_events, deadline):
+            callback(self._polled_events.popleft())
+            handled += 1
+        if self.raw_reader is not None:
+            handled += self.raw_reader.process(
+                callback, None if max_events is None else max_events - handled, deadline)
+        else:
+            # same as pyinotify's Notifier.process_events(), one event at a time
+            queue = self.notifier._eventq
+            system_processing = self.notifier._sys_proc_fun
+            while queue and not _limit_reached(handled, max_events, deadline):
+                raw_event = queue.popleft()
+                handled += 1
+                if self.manager.get_watch(raw_event.wd) is None and \
+                        not raw_event.mask & IN_Q_OVERFLOW:
+                    continue
+                callback(system_processing(raw_event))
+            system_processing.cleanup()
+        if self.budget is not None:
+            # before events are read for the directories watched
+            # automatically, they're lost if their watch is removed
+            self.budget.enforce(time.time())
+        return handled
+
+    def stats(self):
+        return {
+            'watches': len(self.manager.watches) if self.manager is not None else 0,
+            'max_user_watches': _max_user_watches(),
+            'polled': len(self.budget) if self.budget is not None else 0,
+        }
+
+    def _open(self):
+        import pyinotify
+
+        if self.manager is not None:
+            self.manager.close()  # inherited from the parent process
+        self._pid = os.getpid()
+        self._polled_events.clear()
+        self.manager = pyinotify.WatchManager(
+            exclude_filter=self._filter.excluded_directory)
+        self.notifier = pyinotify.Notifier(self.manager)
+        self.raw_reader = _RawReader(self.manager) if self._use_raw_reader else None
+        if self._max_watches is not None:
+            self.budget = _WatchBudget(self.manager, self._roots, self._filter.excluded,
+                                       self._max_watches)
+        if self._lazy_depth is not None:
+            self.lazy = _LazyWatches(self.manager, self._filter, self._lazy_depth)
+
+    def _opened(self):
+        '''
+        Returns if inotify was opened, opening it again (and watching
+        the same) in a forked process
+
+        '''
+        if self.manager is None:
+            return False
+        if self._pid != os.getpid():
+            self._open()
+            if self._mask is not None:
+                self.watch(self._mask, self._roots)
+        return True
+
+    def _touching(self, callback):
+        '''
+        Wraps `callback` to record the activity of each event for `budget`
+
+        '''
+        def touching(raw_event):
+            if not raw_event.mask & IN_Q_OVERFLOW:
+                self.budget.touch(raw_event.pathname, raw_event.mask & IN_ISDIR,
+                                  time.time())
+            callback(raw_event)
+        return touching
+
+    def _expanding(self, callback):
+        '''
+        Wraps `callback` to watch the subdirectories of the directories
+        with events for `lazy`
+
+        '''
+        def expanding(raw_event):
+            callback(raw_event)
+            if not raw_event.mask & IN_Q_OVERFLOW:
+                self._polled_events.extend(self.lazy.touch(raw_event.path, self._mask))
+        return expanding
+
+
+class PollingBackend(object):
+    '''
+    Gets the events listing the directories periodically, for filesystems
+    without inotify support, see `InotifyBackend` for the interface.
+
+    Every `interval` seconds all the directories are scanned, `batch` at a
+    time per `read()` so each call does a bounded amount of work, using
+    `workers` threads. The listing of a directory is skipped if its mtime
+    didn't change since well before the last scan, and if 'modify' events
+    are watched only its files are stat'ed. Changes generate 'create',
+    'delete' and 'modify' events, and 'move' when a path deleted and one
+    created in the same scan have the same inode. Deleting a directory
+    only generates the event for it. A root that isn't a directory is
+    polled by scanning its parent for that name only.
+
+    Keeps the (inode, mtime, size) of every file and the mtime of every
+    directory, about 150 bytes per file.
+
+    '''
+
+    interval = 2  # seconds
+    batch = 1000
+    workers = 4
+
+    def __init__(self, interval=None, workers=None):
+        if interval is not None:
+            self.interval = interval
+        if workers is not None:
+            self.workers = workers
+        self._queue = deque()  # events
+        # directory -> (mtime, {name: (inode, mtime, size, is_dir)}, scan time)
+        self._directories = {}
+        self._only = {}         # parent of file roots -> names of the roots
+        self._cycle = deque()   # directories left to scan in this cycle
+        self._created = []      # (directory, name, entry) waiting to be paired
+        self._deleted = []
+        self._next_cycle = 0
+        self._cookie = 0
+        self._mask = 0
+        self._executor = None
+
+    def open(self, roots, path_filter):
+        self._filter = path_filter
+
+    def watch(self, mask, roots, workers=1, progress=None):
+        self._mask = mask
+        pending = [root for root in roots if os.path.isdir(root)]
+        files = [root for root in roots if root not in pending]
+        while pending:
+            for directory in pending[:self.batch]:
+                self._only.pop(directory, None)  # watched whole now
+            scanned = self._scan_all(pending[:self.batch])
+            pending = pending[self.batch:]
+            for directory, mtime, entries in scanned:
+                if entries is None:
+                    continue
+                self._directories[directory] = (mtime, entries, time.time())
+                pending.extend(os.path.join(directory, name)
+                               for name, entry in entries.items() if entry[3])
+                if progress is not None:
+                    progress(len(self._directories))
+        for root in files:
+            directory, name = os.path.split(root)
+            if directory in self._directories and directory not in self._only:
+                continue
+            self._only.setdefault(directory, set()).add(name)
+            try:
+                mtime = os.lstat(directory).st_mtime
+            except OSError:
+                continue
+            directory, mtime, entries = self._list(directory, mtime)
+            if entries is not None:
+                self._directories[directory] = (mtime, entries, time.time())
+        self._next_cycle = time.time() + self.interval
+
+    def update(self, mask):
+        self._mask = mask
+
+    def fileno(self):
+        return None
+
+    def next_deadline(self):
+        if self._cycle:
+            return time.time()
+        if self._directories:
+            return self._next_cycle
+        return None
+
+    def wait(self, timeout):
+        return _sleep_until(self.next_deadline(), timeout)
+
+    def read(self):
+        now = time.time()
+        if not self._cycle:
+            if now < self._next_cycle or not self._directories:
+                return
+            self._cycle.extend(self._directories)
+            self._next_cycle = now + self.interval
+        directories = [self._cycle.popleft()
+                       for i in range(min(self.batch, len(self._cycle)))]
+        for directory, mtime, entries in self._scan_all(directories):
+            self._compare(directory, mtime, entries)
+        if not self._cycle:
+            self._pair()
+
+    def queued(self):
+        return bool(self._queue)
+
+    def process(self, callback, max_events=None, deadline=None):
+        queue = self._queue
+        handled = 0
+        while queue and not _limit_reached(handled, max_events, deadline):
+            callback(queue.popleft())
+            handled += 1
+        return handled
+
+    def stats(self):
+        return {
+            'watches': 0,
+            'max_user_watches': None,
+            'polled': len(self._directories),
+        }
+
+    def _scan_all(self, directories):
+        '''
+        Returns a list of (directory, mtime, entries) for `directories`,
+        scanned in threads. `entries` is None if the directory doesn't exist
+
+        '''
+        if self.workers > 1 and len(directories) > 1 and ThreadPoolExecutor is not None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers)
+            return list(self._executor.map(self._scan, directories))
+        return [self._scan(directory) for directory in directories]
+
+    def _scan(self, directory):
+        try:
+            mtime = os.lstat(directory).st_mtime
+        except OSError:
+            return directory, None, None
+        known = self._directories.get(directory)
+        # changes right before the last scan may not have changed the mtime
+        # yet, filesystems like NFS only keep seconds
+        if known is not None and known[0] == mtime and mtime < known[2] - 1:
+            if not self._mask & IN_MODIFY:
+                return directory, mtime, known[1]
+            # same names, only files can have changed
+            entries = dict(known[1])
+            for name, entry in known[1].items():
+                if not entry[3]:
+                    current = _stat_entry(os.path.join(directory, name))
+                    if current is None:  # changed after the listing
+                        return self._list(directory, mtime)
+                    entries[name] = current
+            return directory, mtime, entries
+        return self._list(directory, mtime)
+
+    def _list(self, directory, mtime):
+        if not os.path.isdir(directory):
+            return directory, None, None
+        entries = {}
+        excluded = self._filter.excluded
+        only = self._only.get(directory)
+        for name, pathname, st in _list_entries(directory):
+            if only is not None and name not in only:
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if not excluded(pathname, is_dir):
+                entries[name] = st.st_ino, st.st_mtime, st.st_size, is_dir
+        return directory, mtime, entries
+
+    def _compare(self, directory, mtime, entries):
+        known = self._directories.get(directory)
+        if known is None or entries is None:
+            # removed or moved, found by the scan of the parent
+            return
+        old = known[1]
+        self._directories[directory] = (mtime, entries, time.time())
+        if entries is old:
+            return
+        for name, entry in entries.items():
+            previous = old.get(name)
+            if previous is not None and previous[0] != entry[0]:
+                self._deleted.append((directory, name, previous))
+                previous = None
+            if previous is None:
+                self._created.append((directory, name, entry))
+            elif not entry[3] and previous[1:3] != entry[1:3]:
+                self._event(directory, name, IN_MODIFY, entry)
+        for name in old:
+            if name not in entries:
+                self._deleted.append((directory, name, old[name]))
+
+    def _pair(self):
+        '''
+        Generates the events for the paths created and deleted in the cycle
+        that ended, as moves when they have the same inode
+
+        '''
+        # inodes are reused, files must also have the same mtime and size
+        def key(entry):
+            return entry[:1] + entry[3:] if entry[3] else entry
+
+        deleted = dict((key(entry), (directory, name))
+                       for directory, name, entry in self._deleted)
+        for directory, name, entry in self._created:
+            source = deleted.pop(key(entry), None)
+            pathname = os.path.join(directory, name)
+            if source is not None:
+                self._cookie += 1
+                self._event(source[0], source[1], IN_MOVED_FROM, entry, self._cookie)
+                self._event(directory, name, IN_MOVED_TO, entry, self._cookie)
+                if entry[3]:
+                    self._move_directories(os.path.join(*source), pathname)
+                continue
+            self._event(directory, name, IN_CREATE, entry)
+            if entry[3]:
+                # scanned in the next cycle, everything inside is reported
+                # as created
+                self._directories[pathname] = (None, {}, 0)
+        for directory, name, entry in self._deleted:
+            if key(entry) in deleted:
+                self._event(directory, name, IN_DELETE, entry)
+                if entry[3]:
+                    self._forget_directories(os.path.join(directory, name))
+        self._created = []
+        self._deleted = []
+
+    def _move_directories(self, src_pathname, pathname):
+        prefix = src_pathname + os.sep
+        for directory in list(self._directories):
+            if directory == src_pathname:
+                self._directories[pathname] = self._directories.pop(directory)
+            elif directory.startswith(prefix):
+                self._directories[os.path.join(pathname, directory[len(prefix):])] = \
+                    self._directories.pop(directory)
+
+    def _forget_directories(self, pathname):
+        prefix = pathname + os.sep
+        for directory in list(self._directories):
+            if directory == pathname or directory.startswith(prefix):
+                del self._directories[directory]
+
+    def _event(self, directory, name, mask, entry, cookie=0):
+        if mask & self._mask:
+            self._queue.append(_raw_event(directory, name, mask, entry[3], cookie))
+
+
+class FanotifyBackend(object):
+    '''
+    Gets the events from fanotify, with one mark for the whole filesystem
+    of each root instead of a watch per directory, so watching starts
+    right away whatever the size of the tree. See `InotifyBackend` for
+    the interface.
+
+    Needs Linux 5.9 (FAN_REPORT_DFID_NAME) and CAP_SYS_ADMIN, watching
+    raises RuntimeError otherwise. Like `InotifyBackend` the fanotify fd
+    is opened when watching starts, and again in a forked process.
+    Moves are paired using FAN_RENAME
+    (Linux 5.17), on older kernels a 'moved_from' is paired with the
+    'moved_to' right after it.
+
+    Events come with a handle of their directory, its path is found with
+    open_by_handle_at() and cached for `cache_size` directories. Events of
+    the filesystem outside the roots are discarded after that. Paths are
+    the ones when the events are read: after a directory is moved the
+    events from before have the new path. Events inside directories
+    deleted before they are read can be lost. The kernel merges repeated
+    events of a file, they're split in the order they usually happen.
+
+    '''
+
+    buffer_size = 64 * 1024
+    cache_size = 65536
+
+    def __init__(self):
+        self._queue = deque()
+        self._directories = OrderedDict()  # handle -> (directory, inside a root)
+        self._mounts = {}  # fsid -> fd to open handles
+        self._marked = set()
+        self._rename = True  # FAN_RENAME supported
+        self._cookie = 0
+        self._mask = None
+        self._fd = None
+        self._pid = None
+
+    def open(self, roots, path_filter):
+        self._roots = roots
+
+    def _open(self):
+        if self._fd is not None:  # inherited from the parent process
+            for fd in [self._fd] + list(self._mounts.values()):
+                os.close(fd)
+            self._mounts.clear()
+            self._marked.clear()
+            self._directories.clear()
+            self._queue.clear()
+        if _libc() is None or not hasattr(_libc(), 'fanotify_init'):
+            raise RuntimeError('fanotify is not available')
+        fd = _libc().fanotify_init(_FAN_INIT_FLAGS, os.O_RDONLY)
+        if fd < 0:
+            error = _libc_errno()
+            if error == errno.EPERM:
+                raise RuntimeError('fanotify needs CAP_SYS_ADMIN')
+            raise RuntimeError('fanotify is not available (needs Linux 5.9): {0}'.format(
+                os.strerror(error)))
+        self._fd = fd
+        self._pid = os.getpid()
+        self._buffer = bytearray(self.buffer_size)
+        self._poll = select.poll()
+        self._poll.register(fd, select.POLLIN)
+
+    def _opened(self):
+        '''
+        Returns if fanotify was opened, opening it again (and marking the
+        same) in a forked process
+
+        '''
+        if self._fd is None:
+            return False
+        if self._pid != os.getpid():
+            self._open()
+            if self._mask is not None:
+                self.watch(self._mask, self._roots)
+        return True
+
+    def watch(self, mask, roots, workers=1, progress=None):
+        if not self._opened():
+            self._open()
+        self._mask = mask
+        self._directories.clear()  # cached before the new roots
+        for root in roots:
+            fsid = _fsid(root)
+            if fsid in self._mounts:
+                continue
+            directory = root if os.path.isdir(root) else os.path.dirname(root)
+            self._mounts[fsid] = os.open(directory, os.O_RDONLY)
+            self._mark(root, mask)
+            if progress is not None:
+                progress(len(self._mounts))
+
+    def update(self, mask):
+        self._opened()
+        self._mask = mask
+        for root in self._marked:
+            self._mark(root, mask)
+
+    def fileno(self):
+        if not self._opened():
+            self._open()
+        return self._fd
+
+    def next_deadline(self):
+        return None
+
+    def wait(self, timeout):
+        if not self._opened():
+            time.sleep(timeout / 1000.0)
+            return False
+        return bool(self._poll.poll(timeout))
+
+    def read(self):
+        if not self._opened():
+            return
+        try:
+            size = _readinto(self._fd, self._buffer)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return
+            raise
+        self._parse(size)
+
+    def queued(self):
+        if not self._opened():
+            return False
+        return bool(self._queue)
+
+    def process(self, callback, max_events=None, deadline=None):
+        if not self._opened():
+            return 0
+        queue = self._queue
+        handled = 0
+        while queue and not _limit_reached(handled, max_events, deadline):
+            callback(queue.popleft())
+            handled += 1
+        return handled
+
+    def stats(self):
+        return {
+            'watches': len(self._marked),
+            'max_user_watches': None,
+            'polled': 0,
+        }
+
+    def _mark(self, root, mask):
+        fan_mask = (mask & ALL_EVENTS) | _FAN_ONDIR
+        if self._rename and mask & MOVE:
+            fan_mask = fan_mask & ~MOVE | _FAN_RENAME
+        result = _libc().fanotify_mark(self._fd, _FAN_MARK_ADD | _FAN_MARK_FILESYSTEM,
+                                       fan_mask, _AT_FDCWD, _fsencode(root))
+        if result < 0:
+            error = _libc_errno()
+            if error == errno.EINVAL and fan_mask & _FAN_RENAME:
+                self._rename = False
+                self._mark(root, mask)
+                return
+            raise OSError(error, os.strerror(error), root)
+        self._marked.add(root)
+
+    def _parse(self, size):
+        buffer, unpack_from = self._buffer, _FAN_METADATA.unpack_from
+        offset = 0
+        while offset < size:
+            length, version, metadata_length, mask, fd = unpack_from(buffer, offset)
+            if version != _FANOTIFY_METADATA_VERSION:
+                raise RuntimeError('unknown fanotify version: {0}'.format(version))
+            if fd >= 0:
+                os.close(fd)
+            if mask & IN_Q_OVERFLOW:
+                self._queue.append(_RawEvent(None, IN_Q_OVERFLOW, 0, ''))
+            else:
+                records = {}
+                position, end = offset + metadata_length, offset + length
+                while position < end:
+                    info_type, info_length = _FAN_INFO_HEADER.unpack_from(buffer, position)
+                    records[info_type] = position + 4
+                    position += info_length
+                self._add(mask, records)
+            offset += length
+
+    def _add(self, mask, records):
+        is_dir = mask & _FAN_ONDIR
+        if mask & _FAN_RENAME:
+            src = self._resolve(records.get(_FAN_INFO_OLD_DFID_NAME))
+            dst = self._resolve(records.get(_FAN_INFO_NEW_DFID_NAME))
+            self._cookie += 1
+            if src is not None:
+                self._append(src, IN_MOVED_FROM, is_dir, self._cookie)
+            if dst is not None:
+                self._append(dst, IN_MOVED_TO, is_dir, self._cookie)
+        else:
+            if _FAN_INFO_DFID_NAME in records:
+                target = self._resolve(records[_FAN_INFO_DFID_NAME])
+            else:  # events of a directory itself
+                target = self._resolve(records.get(_FAN_INFO_DFID), named=False)
+            if mask & IN_MOVED_FROM:
+                self._cookie += 1
+            if target is not None:
+                for bits in _FAN_ORDER:
+                    if mask & bits:
+                        self._append(target, mask & bits, is_dir,
+                                     self._cookie if bits & MOVE else 0)
+        if is_dir and mask & (MOVE | _FAN_RENAME | IN_DELETE):
+            # handles of the directories inside are still valid, their paths aren't
+            self._directories.clear()
+
+    def _append(self, target, mask, is_dir, cookie):
+        (directory, inside), name = target
+        if name == '.':
+            name = ''
+        if not inside:
+            pathname = os.path.join(directory, name) if name else directory
+            if pathname not in self._roots:
+                return
+        self._queue.append(_raw_event(directory, name, mask, is_dir, cookie))
+
+    def _resolve(self, position, named=True):
+        '''
+        Returns ((directory, inside a root), name) for a DFID_NAME (or
+        DFID if not `named`) info record, or None if the directory is gone
+
+        '''
+        if position is None:
+            return None
+        buffer = self._buffer
+        handle_length = struct.unpack_from('I', buffer, position + 8)[0]
+        end = position + 16 + handle_length
+        name = ''
+        if named:
+            name = _fsdecode(bytes(buffer[end:buffer.find(b'\0', end)]))
+        key = bytes(buffer[position:end])  # fsid and handle
+        directory = self._directories.pop(key, None)
+        if directory is None:
+            directory = self._directory(key)
+            if directory is None:
+                return None
+        self._directories[key] = directory
+        if len(self._directories) > self.cache_size:
+            self._directories.popitem(last=False)
+        return directory, name
+
+    def _directory(self, key):
+        low, high = struct.unpack_from('=II', key)
+        mount = self._mounts.get(low | high << 32)
+        if mount is None:
+            if len(self._mounts) != 1:
+                return None
+            mount = next(iter(self._mounts.values()))
+        fd = _libc().open_by_handle_at(mount, key[8:], _O_PATH)
+        if fd < 0:
+            return None  # deleted, ESTALE
+        try:
+            directory = os.readlink('/proc/self/fd/{0}'.format(fd))
+        finally:
+            os.close(fd)
+        if directory.endswith(' (deleted)'):
+            directory = directory[:-len(' (deleted)')]
+        prefix = directory + os.sep
+        inside = any(prefix.startswith(root + os.sep) for root in self._roots)
+        return directory, inside
+
+
+def _fsid(pathname):
+    '''
+    Returns the id of the filesystem of `pathname`, as in fanotify events
+
+    '''
+    # val[0] | val[1] << 32, python < 3.7 doesn't have it
+    fsid = getattr(os.statvfs(pathname), 'f_fsid', None)
+    if fsid is None:
+        return ('dev', os.stat(pathname).st_dev)
+    return fsid
+
+
+_libc_cache = []
+
+
+def _libc():
+    # ctypes is imported on first use, None when python is built without it
+    if not _libc_cache:
+        try:
+            import ctypes
+            import ctypes.util
+        except ImportError:
+            _libc_cache.append(None)
+            return None
+        _libc_cache.append(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True))
+        libc = _libc_cache[0]
+        if hasattr(libc, 'fanotify_init'):
+            libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64,
+                                           ctypes.c_int, ctypes.c_char_p]
+            libc.open_by_handle_at.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    return _libc_cache[0]
+
+
+def _libc_errno():
+    import ctypes
+    return ctypes.get_errno()
+
+
+_FANOTIFY_METADATA_VERSION = 3
+_FAN_METADATA = struct.Struct('=IBxHQi4x')  # event_len, vers, metadata_len, mask, fd
+_FAN_INFO_HEADER = struct.Struct('=BxH')
+_FAN_INFO_DFID_NAME = 2
+_FAN_INFO_DFID = 3
+_FAN_INFO_OLD_DFID_NAME = 10
+_FAN_INFO_NEW_DFID_NAME = 12
+_FAN_INIT_FLAGS = (0x1 |    # FAN_CLOEXEC
+                   0x2 |    # FAN_NONBLOCK
+                   0xc00)   # FAN_REPORT_DFID_NAME
+_FAN_MARK_ADD = 0x1
+_FAN_MARK_FILESYSTEM = 0x100
+_FAN_ONDIR = 0x40000000  # same as IN_ISDIR
+_FAN_RENAME = 0x10000000
+_AT_FDCWD = -100
+_O_PATH = getattr(os, 'O_PATH', 0o10000000)
+# order of the events merged by the kernel, masks are the same as inotify's
+_FAN_ORDER = (IN_CREATE, IN_MOVED_TO, IN_OPEN,
+              IN_ACCESS, IN_MODIFY, IN_ATTRIB,
+              IN_CLOSE_WRITE, IN_CLOSE_NOWRITE,
+              IN_MOVED_FROM, IN_MOVE_SELF, IN_DELETE,
+              IN_DELETE_SELF)
+
+
+class ReplayBackend(object):
+    '''
+    Gets the events from a log written by `Detector.record()`, to run
+    the handlers (and the detector) with recorded bursts. See
+    `InotifyBackend` for the interface.
+
+    With `speed` the events are replayed with their original timing,
+    `speed` times faster, otherwise as fast as possible. `batch` events
+    are read per `read()`. `done` tells when all of them were handled.
+
+    The events go through the filters and the rest of the processing of
+    the detector like live ones, but nothing is watched: 'resync' and
+    'snapshot' look at the tree as it is now.
+
+    '''
+
+    batch = 1000
+
+    def __init__(self, path, speed=None):
+        self.path = path
+        self.speed = speed
+        self._queue = deque()
+        self._records = None  # iterator over the log, once watching
+        self._next = None     # next record not queued yet
+        self._first = None    # time of the first record
+        self._start = None    # when the replay started
+
+    @property
+    def done(self):
+        return self._records is not None and self._next is None and not self._queue
+
+    def open(self, roots, path_filter):
+        pass
+
+    def watch(self, mask, roots, workers=1, progress=None):
+        if self._records is None:
+            self._records = _read_log(self.path)
+            self._start = time.time()
+            self._advance()
+
+    def update(self, mask):
+        pass
+
+    def fileno(self):
+        return None
+
+    def next_deadline(self):
+        if self._next is None:
+            return None
+        return self._due(self._next)
+
+    def wait(self, timeout):
+        return _sleep_until(self.next_deadline(), timeout)
+
+    def read(self):
+        now = time.time()
+        for i in range(self.batch):
+            if self._next is None or self._due(self._next) > now:
+                break
+            when, mask, cookie, pathname, src_pathname = self._next
+            event = _RawEvent(None, mask, cookie, '')
+            event.path = pathname
+            event.src_pathname = src_pathname
+            self._queue.append(event)
+            self._advance()
+
+    def queued(self):
+        return bool(self._queue)
+
+    def process(self, callback, max_events=None, deadline=None):
+        queue = self._queue
+        handled = 0
+        while queue and not _limit_reached(handled, max_events, deadline):
+            callback(queue.popleft())
+            handled += 1
+        return handled
+
+    def stats(self):
+        return {
+            'watches': 0,
+            'max_user_watches': None,
+            'polled': 0,
+        }
+
+    def _advance(self):
+        self._next = next(self._records, None)
+        if self._first is None and self._next is not None:
+            self._first = self._next[0]
+
+    def _due(self, record):
+        if self.speed is None:
+            return self._start
+        return self._start + (record[0] - self._first) / self.speed
+
+
+class _Recorder(object):
+    '''
+    Appends the events received by `Detector` to a log, see
+    `Detector.record()`.
+
+    The log is a sequence of segments, one per `flush()`: a
+    `_SEGMENT_HEADER`, the fixed size `_LOG_RECORD` of each event and the
+    string table of the segment, with each path stored once and NUL
+    terminated. `_read_log()` reads it with mmap.
+
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'ab')
+        self._records = []
+        self._strings = []
+        self._offsets = {}  # path -> offset in the string table
+        self._size = 0      # of the string table
+
+    def add(self, raw_event, now):
+        self._records.append(_LOG_RECORD.pack(
+            now, raw_event.mask, getattr(raw_event, 'cookie', 0) or 0,
+            self._string(getattr(raw_event, 'pathname', None)),
+            self._string(getattr(raw_event, 'src_pathname', None))))
+
+    def flush(self):
+        if not self._records:
+            return
+        self._file.write(_SEGMENT_HEADER.pack(_LOG_MAGIC, len(self._records), self._size))
+        self._file.write(b''.join(self._records))
+        self._file.write(b''.join(self._strings))
+        self._file.flush()
+        self._records = []
+        self._strings = []
+        self._offsets.clear()
+        self._size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def _string(self, value):
+        if value is None:
+            return _NO_STRING
+        offset = self._offsets.get(value)
+        if offset is None:
+            data = _fsencode(value) + b'\0'
+            offset = self._offsets[value] = self._size
+            self._strings.append(data)
+            self._size += len(data)
+        return offset
+
+
+def _read_log(path):
+    '''
+    Yields (time, mask, cookie, pathname, src_pathname) for the events in
+    a log written by `_Recorder`. A segment being written is ignored
+
+    '''
+    with open(path, 'rb') as fileobj:
+        if not os.fstat(fileobj.fileno()).st_size:
+            return
+        data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def string(offset):
+        if offset == _NO_STRING:
+            return None
+        start = strings + offset
+        return _fsdecode(data[start:data.find(b'\0', start)])
+
+    try:
+        offset = 0
+        while offset < len(data):
+            if not _LOG_MAGIC.startswith(data[offset:offset + len(_LOG_MAGIC)]):
+                raise ValueError('not an fsdetect log: {0}'.format(path))
+            if offset + _SEGMENT_HEADER.size > len(data):
+                break
+            magic, count, strings_size = _SEGMENT_HEADER.unpack_from(data, offset)
+            records = offset + _SEGMENT_HEADER.size
+            strings = records + count * _LOG_RECORD.size
+            offset = strings + strings_size
+            if offset > len(data):
+                break
+            for position in range(records, strings, _LOG_RECORD.size):
+                when, mask, cookie, pathname, src_pathname = \
+                    _LOG_RECORD.unpack_from(data, position)
+                yield when, mask, cookie, string(pathname), string(src_pathname)
+    finally:
+        data.close()
+
+
+_LOG_MAGIC = b'FSDL'
+_SEGMENT_HEADER = struct.Struct('=4sII')  # magic, records, size of the string table
+_LOG_RECORD = struct.Struct('=dIIII')     # time, mask, cookie, pathname, src_pathname
+_NO_STRING = 0xffffffff
+
+
+class _RawReader(object):
+    '''
+    Reads the events from the inotify fd of a pyinotify `WatchManager` into
+    a reusable buffer and parses them directly, replacing the `Notifier`
+    `read_events()` and `process_events()`.
+
+    Keeps the watches updated like pyinotify does: adds watches for new
+    directories (simulating IN_CREATE for what was created inside them
+    before), updates the path of directories moved inside the watched
+    tree and removes the watches for IN_IGNORED.
+
+    '''
+
+    buffer_size = 64 * 1024
+    max_moves = 4096  # IN_MOVED_FROM kept to be paired
+    header = struct.Struct('iIII')
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._buffer = bytearray(self.buffer_size)
+        self._available = array.array('i', [0])
+        self.queue = deque()  # events read, and simulated ones
+        self._moved_from = OrderedDict()  # cookie -> src_pathname
+
+    def read(self):
+        '''
+        Reads the events available when called into `queue`
+
+        '''
+        fd = self._manager.get_fd()
+        fcntl.ioctl(fd, termios.FIONREAD, self._available, True)
+        remaining = self._available[0]
+        while remaining > 0:
+            size = _readinto(fd, self._buffer)
+            if not size:
+                break
+            remaining -= size
+            self._parse(size)
+
+    def process(self, callback, max_events=None, deadline=None):
+        '''
+        Calls `callback` for the queued events, up to `max_events` or until
+        `deadline`. Returns how many were handled
+
+        '''
+        queue = self.queue
+        handled = 0
+        while queue and not _limit_reached(handled, max_events, deadline):
+            self._process(queue.popleft(), callback)
+            handled += 1
+        return handled
+
+    def _parse(self, size):
+        buffer, unpack_from = self._buffer, self.header.unpack_from
+        offset = 0
+        while offset < size:
+            wd, mask, cookie, length = unpack_from(buffer, offset)
+            offset += 16
+            name = ''
+            if length:
+                end = buffer.find(b'\0', offset, offset + length)
+                name = _fsdecode(bytes(buffer[offset:end if end != -1 else offset + length]))
+                offset += length
+            self.queue.append(_RawEvent(wd, mask, cookie, name))
+
+    def _process(self, event, callback):
+        mask = event.mask
+        if mask & IN_Q_OVERFLOW:
+            callback(event)
+            return
+        watch = self._manager.watches.get(event.wd)
+        if watch is None:
+            return
+        event.path = watch.path
+        if mask & IN_MOVED_FROM:
+            self._moved_from[event.cookie] = event.pathname
+            if len(self._moved_from) > self.max_moves:
+                self._moved_from.popitem(last=False)
+        elif mask & IN_MOVED_TO:
+            event.src_pathname = self._moved_from.pop(event.cookie, None)
+            if event.src_pathname is not None:
+                if mask & IN_ISDIR:
+                    self._update_moved_paths(event.src_pathname, event.pathname)
+            elif mask & IN_ISDIR and watch.auto_add and \
+                    not watch.exclude_filter(event.pathname):
+                self._manager.add_watch(event.pathname, watch.mask, rec=True,
+                                        auto_add=True,
+                                        exclude_filter=watch.exclude_filter)
+        elif mask & IN_CREATE and mask & IN_ISDIR:
+            self._add_created_directory(watch, event.pathname)
+        callback(event)
+        if mask & IN_IGNORED:
+            self._manager.del_watch(event.wd)
+
+    def _add_created_directory(self, watch, pathname):
+        if not watch.auto_add or watch.exclude_filter(pathname):
+            return
+        wd = self._manager.add_watch(pathname, watch.mask, rec=False, auto_add=True,
+                                     exclude_filter=watch.exclude_filter).get(pathname)
+        if wd is None or wd < 0:
+            return
+        # whatever is inside was created before the watch was added
+        for name, pathname, st in _list_entries(pathname):
+            if self._manager.get_wd(pathname) is not None:
+                continue
+            mask = IN_CREATE
+            if stat.S_ISDIR(st.st_mode):
+                mask |= IN_ISDIR
+            self.queue.append(_RawEvent(wd, mask, 0, name))
+
+    def _update_moved_paths(self, src_path, dst_path):
+        prefix = src_path + os.sep
+        for watch in self._manager.watches.values():
+            if watch.path == src_path:
+                watch.path = dst_path
+            elif watch.path.startswith(prefix):
+                watch.path = os.path.join(dst_path, watch.path[len(prefix):])
+
+
+class _PendingMoves(object):
+    '''
+    IN_MOVED_FROM events waiting for the IN_MOVED_TO with the same cookie.
+    The ones not paired until their deadline are moves out of the watched
+    directory.
+
+    '''
+
+    def __init__(self):
+        self._by_cookie = OrderedDict()  # cookie -> (Event, deadline)
+        self._by_pathname = {}           # src_pathname -> cookie
+
+    def add(self, cookie, event, deadline):
+        self._by_cookie[cookie] = (event, deadline)
+        self._by_pathname[event.src_pathname] = cookie
+
+    def __len__(self):
+        return len(self._by_cookie)
+
+    def pop(self, cookie):
+        '''
+        Returns the `Event` of the move with `cookie`, or None
+
+        '''
+        event, deadline = self._by_cookie.pop(cookie, (None, None))
+        if event is not None:
+            del self._by_pathname[event.src_pathname]
+        return event
+
+    def pop_pathname(self, src_pathname):
+        '''
+        Returns the `Event` if `src_pathname` was moved and is still waiting,
+        or None
+
+        '''
+        cookie = self._by_pathname.get(src_pathname)
+        if cookie is None:
+            return None
+        return self.pop(cookie)
+
+    def pop_all(self):
+        moves = [event for event, deadline in self._by_cookie.values()]
+        self._by_cookie.clear()
+        self._by_pathname.clear()
+        return moves
+
+    def expired(self, now):
+        '''
+        Returns the `Event` of the moves not paired until now
+
+        '''
+        moves = []
+        # deadlines are increasing, only the oldest ones need to be checked
+        while self._by_cookie:
+            cookie, (event, deadline) = next(iter(self._by_cookie.items()))
+            if deadline > now:
+                break
+            moves.append(self.pop(cookie))
+        return moves
+
+    def next_deadline(self):
+        for event, deadline in self._by_cookie.values():
+            return deadline
+        return None
+
+
+class _Coalescer(object):
+    '''
+    Holds events for a quiet period before they are dispatched, merging
+    repeated events for the same pathname.
+
+    `windows` is either a number of milliseconds used for every event or
+    a dict of event name (same syntax as `Detector.on()`) to milliseconds,
+    events not in the dict are dispatched right away.
+
+    Deadlines are kept in a `_TimerWheel`, finding the expired ones
+    doesn't look at every pending path.
+
+    '''
+
+    # a modify following one of these is already implied by it
+    absorbs_modify = (IN_CREATE, IN_MODIFY,
+                      IN_CLOSE_WRITE)
+
+    def __init__(self, windows):
+        if isinstance(windows, dict):
+            self._default = None
+            self._windows = dict((mask, ms / 1000.0)
+                                 for name, ms in windows.items()
+                                 for mask in _event_masks(name))
+        else:
+            self._default = windows / 1000.0
+            self._windows = {}
+        self._pending = {}  # pathname -> [deadline, [(mask, event)]]
+        shortest = min([window for window in [self._default] + list(self._windows.values())
+                        if window] or [0])
+        self._wheel = _TimerWheel(max(shortest / 32, 0.001))
+
+    def __len__(self):
+        return sum(len(events) for deadline, events in self._pending.values())
+
+    def add(self, mask, event, now):
+        '''
+        Returns the list of (mask, event) ready to be dispatched now
+
+        '''
+        pathname = event.pathname or event.src_pathname
+        window = self._windows.get(mask, self._default)
+        if window is None:
+            # keep ordering: anything pending for this path goes first
+            ready = self._pop(pathname)
+            ready.append((mask, event))
+            return ready
+
+        entry = self._pending.get(pathname)
+        if entry is None:
+            entry = self._pending[pathname] = [now + window, []]
+            self._wheel.add(pathname, entry[0])
+        elif now + window > entry[0]:
+            entry[0] = now + window
+            self._wheel.add(pathname, entry[0])
+
+        events = entry[1]
+        if events:
+            last = events[-1]
+            if last == (mask, event):
+                return []
+            if mask == IN_MODIFY and last[0] in self.absorbs_modify:
+                return []
+        events.append((mask, event))
+        return []
+
+    def expired(self, now):
+        '''
+        Returns the list of (mask, event) whose quiet period is over
+
+        '''
+        ready = []
+        for pathname in self._wheel.expired(now):
+            ready.extend(self._pending.pop(pathname)[1])
+        return ready
+
+    def next_deadline(self):
+        '''
+        Returns when the next call to `expired()` will return events, or None
+
+        '''
+        return self._wheel.next_deadline()
+
+    def _pop(self, pathname):
+        self._wheel.remove(pathname)
+        entry = self._pending.pop(pathname, None)
+        return entry[1] if entry is not None else []
+
+
+class _ReadyFiles(object):
+    '''
+    Synthesizes 'ready' events for files that have been completely
+    written: `timeout_ms` after their last 'close_write', unless they're
+    modified, created again, moved or deleted in between (some writers
+    reopen the file), or right away when a file is moved into place
+    (written to a temporary name and renamed). Fires again if the file
+    is written again later.
+
+    Deadlines are kept in a `_TimerWheel`, the cost per file doesn't
+    depend on how many files are being written. A file that isn't
+    there anymore when the deadline passes is skipped, it was removed or
+    moved with its directory.
+
+    '''
+
+    def __init__(self, timeout_ms):
+        self.timeout = timeout_ms / 1000.0
+        self._wheel = _TimerWheel(max(self.timeout / 32, 0.001))
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def add(self, mask, event, now):
+        '''
+        Returns the list of ready `Event` because of this one
+
+        '''
+        if event.is_dir:
+            return []
+        if mask == IN_CLOSE_WRITE:
+            self._wheel.add(event.pathname, now + self.timeout)
+        elif mask == MOVE:
+            self._wheel.remove(event.src_pathname)
+            if event.pathname is not None:
+                self._wheel.remove(event.pathname)
+                return [Event(event.pathname, None, READY, False)]
+        elif mask in (IN_MODIFY, IN_CREATE, IN_DELETE):
+            self._wheel.remove(event.pathname)
+        return []
+
+    def expired(self, now):
+        return [Event(pathname, None, READY, False)
+                for pathname in self._wheel.expired(now) if os.path.isfile(pathname)]
+
+    def next_deadline(self):
+        return self._wheel.next_deadline()
+
+
+class _TimerWheel(object):
+    '''
+    Deadlines of keys in a ring of `slots` buckets, one per tick of
+    `resolution` seconds. Adding or removing a key is O(1), and
+    `expired()` only looks at the buckets of the ticks passed since the
+    last call. Deadlines more than a turn away stay in their bucket and
+    are looked at once per turn.
+
+    '''
+
+    def __init__(self, resolution, slots=256):
+        self.resolution = resolution
+        self._slots = [set() for i in range(slots)]
+        self._deadlines = {}  # key -> (deadline, slot)
+        self._done = int(time.time() / resolution) - 1  # last tick fully expired
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def add(self, key, deadline):
+        '''
+        Sets the deadline of `key`, replacing the previous one
+
+        '''
+        self.remove(key)
+        # deadlines already passed go to the next tick looked at
+        tick = max(int(deadline / self.resolution), self._done + 1)
+        slot = tick % len(self._slots)
+        self._slots[slot].add(key)
+        self._deadlines[key] = (deadline, slot)
+
+    def remove(self, key):
+        entry = self._deadlines.pop(key, None)
+        if entry is not None:
+            self._slots[entry[1]].discard(key)
+
+    def expired(self, now):
+        '''
+        Returns the keys whose deadline passed, in order, and removes them
+
+        '''
+        current = int(now / self.resolution)
+        expired = []
+        if self._deadlines:
+            first = max(self._done + 1, current - len(self._slots) + 1)
+            for tick in range(first, current + 1):
+                slot = self._slots[tick % len(self._slots)]
+                for key in [key for key in slot if self._deadlines[key][0] <= now]:
+                    slot.discard(key)
+                    expired.append((self._deadlines.pop(key)[0], key))
+        # the current tick can still have deadlines after `now`
+        self._done = max(self._done, current - 1)
+        expired.sort()
+        return [key for deadline, key in expired]
+
+    def next_deadline(self):
+        '''
+        Returns the next deadline, or None
+
+        '''
+        if not self._deadlines:
+            return None
+        for tick in range(self._done + 1, self._done + 1 + len(self._slots)):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                deadline = min(self._deadlines[key][0] for key in slot)
+                if deadline < (tick + 1) * self.resolution:  # not in a later turn
+                    return deadline
+        return min(deadline for deadline, slot in self._deadlines.values())
+
+
+class _Aggregator(object):
+    '''
+    Summarizes bursts of events, like extracting an archive or removing a
+    tree, into one 'tree_changed' event.
+
+    Events are counted per subtree: a directory directly inside a watched
+    root (with the events of the directory itself), or the root itself
+    for the files directly in it. When `events`
+    of them arrive within `window_ms` a burst starts, and the next events
+    of the subtree are held back until none arrives for `window_ms`. Then
+    they're replaced by one event for their closest common directory,
+    with the number of events per event name in `counts` and up to
+    `max_paths` of their pathnames in `paths` (None if `max_paths` is
+    None). The events received before the burst started were already
+    dispatched as usual.
+
+    Events that aren't changes (overflow, unmount and ignored) are never
+    held back nor counted.
+
+    '''
+
+    # not changes of the tree
+    passed = (IN_Q_OVERFLOW, IN_UNMOUNT, IN_IGNORED)
+
+    def __init__(self, roots, events, window_ms, max_paths=None):
+        self.events = events
+        self.window = window_ms / 1000.0
+        self.max_paths = max_paths
+        self._roots = roots
+        self._counters = {}           # subtree -> [start, count]
+        self._bursts = OrderedDict()  # subtree -> [deadline, directory, counts, paths]
+        self._next_sweep = 0
+
+    def __len__(self):
+        return sum(sum(burst[2].values()) for burst in self._bursts.values())
+
+    def add(self, mask, event, now):
+        '''
+        Returns True if the event is held back as part of a burst
+
+        '''
+        if mask in self.passed:
+            return False
+        pathname = event.pathname or event.src_pathname
+        subtree = self._subtree(pathname, event.is_dir)
+        if subtree is None:
+            return False
+        burst = self._bursts.get(subtree)
+        if burst is None:
+            counter = self._counters.get(subtree)
+            if counter is None or counter[0] + self.window < now:
+                counter = self._counters[subtree] = [now, 0]
+            counter[1] += 1
+            if counter[1] < self.events:
+                return False
+            del self._counters[subtree]
+            paths = [] if self.max_paths is not None else None
+            burst = self._bursts[subtree] = [None, None, defaultdict(int), paths]
+        burst[0] = now + self.window
+        burst[1] = self._common(burst[1], pathname, subtree)
+        if event.pathname is not None and event.src_pathname is not None:
+            burst[1] = self._common(burst[1], event.src_pathname, subtree)
+        burst[2][mask] += 1
+        if burst[3] is not None and len(burst[3]) < self.max_paths:
+            burst[3].append(pathname)
+        return True
+
+    def expired(self, now):
+        '''
+        Returns the 'tree_changed' `Event` of the bursts that are over
+
+        '''
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.window
+            for subtree, (start, count) in list(self._counters.items()):
+                if start + self.window < now:
+                    del self._counters[subtree]
+        changed = []
+        for subtree, (deadline, directory, counts, paths) in list(self._bursts.items()):
+            if deadline <= now:
+                del self._bursts[subtree]
+                counts = dict((_event_name(mask), count) for mask, count in counts.items())
+                changed.append(Event(directory, None, TREE_CHANGED, True, None, counts, paths))
+        return changed
+
+    def next_deadline(self):
+        if not self._bursts:
+            return None
+        return min(burst[0] for burst in self._bursts.values())
+
+    def _subtree(self, pathname, is_dir):
+        if pathname in self._roots:
+            return pathname
+        child, parent = pathname, os.path.dirname(pathname)
+        while parent not in self._roots:
+            if parent == child:
+                return None
+            child, parent = parent, os.path.dirname(parent)
+        return parent if child == pathname and not is_dir else child
+
+    def _common(self, directory, pathname, subtree):
+        if pathname in self._roots or pathname == subtree:
+            parent = pathname
+        else:
+            parent = os.path.dirname(pathname)
+        if directory is None:
+            return parent
+        while parent != directory and \
+                not parent.startswith(directory.rstrip(os.sep) + os.sep):
+            directory = os.path.dirname(directory)
+        return directory
+
+
+class _LazyWatches(object):
+    '''
+    Watches the directories up to `depth` levels under the roots at
+    first. The subdirectories of the deepest ones are watched when there
+    is an event in their parent, or when the crawl gets to them:
+    `crawl_batch` directories every `crawl_interval` seconds, shallowest
+    first (0 disables it).
+
+    Each directory is listed before and after adding its watch, and what
+    changed in between is reported as created or deleted, so nothing
+    created while the watch is added is missed (it can be reported
+    twice). Changes in unwatched directories before that are not
+    reported.
+
+    '''
+
+    crawl_interval = 1  # seconds
+    crawl_batch = 50
+
+    def __init__(self, manager, path_filter, depth):
+        self._manager = manager
+        self._filter = path_filter
+        self.depth = depth
+        # watched directories whose subdirectories aren't, shallowest first
+        self._frontier = OrderedDict()
+        self._next_crawl = 0
+
+    def __len__(self):
+        return len(self._frontier)
+
+    def walk(self, root):
+        '''
+        Yields `root` and its subdirectories up to `depth` levels deep
+
+        '''
+        yield root
+        level = [root]
+        for i in range(self.depth):
+            deeper = []
+            for directory in level:
+                for name, pathname, st in _list_directories(directory):
+                    if not self._filter.excluded_directory(pathname):
+                        deeper.append(pathname)
+                        yield pathname
+            level = deeper
+        for directory in level:
+            self._frontier[directory] = None
+
+    def touch(self, directory, mask):
+        '''
+        Called with the directory of each event, returns the list of
+        changes found (as `_RawEvent`) if its subdirectories were watched
+
+        '''
+        if directory not in self._frontier:
+            return []
+        return self._expand(directory, mask)
+
+    def crawl(self, now, mask):
+        if not self.crawl_batch or not self._frontier or now < self._next_crawl:
+            return []
+        self._next_crawl = now + self.crawl_interval
+        changes = []
+        for directory in list(self._frontier)[:self.crawl_batch]:
+            changes.extend(self._expand(directory, mask))
+        return changes
+
+    def next_deadline(self):
+        if not self.crawl_batch or not self._frontier:
+            return None
+        return self._next_crawl
+
+    def _expand(self, directory, mask):
+        del self._frontier[directory]
+        changes = []
+        for name, pathname, st in _list_directories(directory):
+            if self._filter.excluded_directory(pathname):
+                continue
+            before = self._list(pathname)
+            wd = self._manager.add_watch(pathname, mask, rec=False, auto_add=True,
+                                         do_glob=False).get(pathname)
+            if wd is None or wd < 0:
+                continue
+            after = self._list(pathname)
+            for name in sorted(set(after) - set(before)):
+                changes.append(_raw_event(pathname, name, IN_CREATE, after[name]))
+            for name in sorted(set(before) - set(after)):
+                changes.append(_raw_event(pathname, name, IN_DELETE, before[name]))
+            self._frontier[pathname] = None
+        return changes
+
+    def _list(self, directory):
+        '''
+        Returns {name: is_dir} of the entries of `directory`
+
+        '''
+        entries = {}
+        for name, pathname, st in _list_entries(directory):
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if not self._filter.excluded(pathname, is_dir):
+                entries[name] = is_dir
+        return entries
+
+
+class _WatchBudget(object):
+    '''
+    Keeps the number of inotify watches under `limit`, polling the
+    directories that don't fit.
+
+    The first directories watched are the shallowest. Polled directories
+    are listed every `poll_interval` seconds, `poll_batch` directories at a
+    time, generating 'create', 'delete' and 'modify' events for the
+    changes. A polled directory that changed is watched instead if there's
+    room, or in place of the watched directory with the oldest activity if
+    it's been quiet for `demote_after` seconds. When new directories are
+    watched automatically and the limit is exceeded, the least active
+    ones are polled instead. Roots are always watched.
+
+    '''
+
+    poll_interval = 5  # seconds
+    poll_batch = 100
+    demote_after = 60  # seconds
+
+    def __init__(self, manager, roots, excluded, limit):
+        self._manager = manager
+        self._roots = roots
+        self._excluded = excluded
+        self._limit = limit
+        self._activity = OrderedDict()  # watched directory -> last event, oldest first
+        self._polled = {}               # directory -> {name: (inode, mtime, size, is_dir)}
+        self._queue = deque()           # directories left to poll in this cycle
+        self._next_cycle = 0
+
+    def __len__(self):
+        return len(self._polled)
+
+    def split(self, directories):
+        '''
+        Yields the `directories` that fit in the budget, polls the rest
+
+        '''
+        room = self._limit - len(self._manager.watches)
+        for directory in directories:
+            if room > 0 or directory in self._roots:
+                room -= 1
+                yield directory
+            else:
+                self._poll_later(directory, self._list(directory))
+
+    def added(self, wds):
+        '''
+        Called with the watches added, polls the directories whose watch
+        couldn't be added (ENOSPC). Without activity the deepest ones are
+        the first to be polled if needed.
+
+        '''
+        added = []
+        for directory in sorted(wds, key=lambda directory: directory.count(os.sep),
+                                reverse=True):
+            if wds[directory] < 0:
+                self._poll_later(directory, self._list(directory))
+            elif directory not in self._activity:
+                added.append((directory, 0))
+        self._activity = OrderedDict(added + list(self._activity.items()))
+
+    def touch(self, pathname, is_dir, now):
+        '''
+        Records activity from an inotify event
+
+        '''
+        for directory in (os.path.dirname(pathname), pathname if is_dir else None):
+            if directory is not None and directory not in self._polled:
+                self._activity.pop(directory, None)
+                self._activity[directory] = now
+
+    def enforce(self, now):
+        '''
+        Polls the least active directories while over the limit
+
+        '''
+        while len(self._manager.watches) > self._limit:
+            if not self._demote(None):
+                break
+
+    def poll(self, now, mask):
+        '''
+        Polls the directories due, returns the list of the changes found
+        as `_RawEvent`
+
+        '''
+        if not self._queue:
+            if now < self._next_cycle or not self._polled:
+                return []
+            self._queue.extend(self._polled)
+            self._next_cycle = now + self.poll_interval
+        changes = []
+        for i in range(min(self.poll_batch, len(self._queue))):
+            directory = self._queue.popleft()
+            found = self._poll(directory)
+            changes.extend(found)
+            if found and directory in self._polled:
+                changes.extend(self._promote(directory, mask, now))
+        return changes
+
+    def next_deadline(self):
+        if self._queue:
+            return time.time()
+        if self._polled:
+            return self._next_cycle
+        return None
+
+    def _promote(self, directory, mask, now):
+        if len(self._manager.watches) >= self._limit and \
+                not self._demote(now - self.demote_after):
+            return []
+        wd = self._manager.add_watch(directory, mask, rec=False, auto_add=True,
+                                     do_glob=False).get(directory)
+        if wd is None or wd < 0:
+            return []
+        changes = self._poll(directory)  # changes before the watch was added
+        del self._polled[directory]
+        self._activity[directory] = now
+        return changes
+
+    def _demote(self, idle_since):
+        '''
+        Polls the watched directory with the oldest activity, if it's
+        older than `idle_since`. Returns if one was found
+
+        '''
+        for directory, last in list(self._activity.items()):
+            if idle_since is not None and last > idle_since:
+                return False
+            del self._activity[directory]
+            if directory in self._roots:
+                self._activity[directory] = last
+                continue
+            wd = self._manager.get_wd(directory)
+            if wd is None:
+                continue  # removed
+            self._poll_later(directory, self._list(directory))
+            self._manager.rm_watch(wd, quiet=True)
+            return True
+        return False
+
+    def _poll_later(self, directory, entries):
+        self._activity.pop(directory, None)
+        if entries is not None:
+            self._polled[directory] = entries
+
+    def _poll(self, directory):
+        old = self._polled.get(directory)
+        if old is None:
+            return []
+        new = self._list(directory)
+        if new is None:  # removed, the parent reports it
+            del self._polled[directory]
+            return []
+        self._polled[directory] = new
+        changes = []
+        def change(mask, name, entry):
+            changes.append(_raw_event(directory, name, mask, entry[3]))
+
+        for name in sorted(new):
+            entry, previous = new[name], old.get(name)
+            if previous is not None and previous[0] != entry[0]:
+                change(IN_DELETE, name, previous)
+                previous = None
+            if previous is None:
+                change(IN_CREATE, name, entry)
+                if entry[3]:
+                    # new directories are polled too, with everything inside
+                    # reported as created
+                    pathname = os.path.join(directory, name)
+                    self._poll_later(pathname, {})
+                    self._queue.append(pathname)
+            elif not entry[3] and previous[1:3] != entry[1:3]:
+                change(IN_MODIFY, name, entry)
+        for name in sorted(set(old) - set(new)):
+            change(IN_DELETE, name, old[name])
+        return changes
+
+    def _list(self, directory):
+        '''
+        Returns {name: (inode, mtime, size, is_dir)} of the entries of
+        `directory`, or None if it doesn't exist
+
+        '''
+        if not os.path.isdir(directory):
+            return None
+        entries = {}
+        for name, pathname, st in _list_entries(directory):
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if not self._excluded(pathname, is_dir):
+                entries[name] = st.st_ino, st.st_mtime, st.st_size, is_dir
+        return entries
+
+
+class _Fingerprinter(object):
+    '''
+    Drops 'modify' and 'close_write' events of files whose contents didn't
+    change, comparing a hash of the contents with the one from the previous
+    event for the same file, kept for the last `cache_size` files.
+
+    If the size and mtime are the same as last time the file is not read.
+    Otherwise it's hashed by `workers` threads, and the event (and the
+    ones after it for the same path, to keep their order) is returned by
+    `done()` once the hash is ready, with the hash in `fingerprint`.
+
+    There's at most one hash waiting or running per file: events received
+    meanwhile replace the waiting one, and if the hash already started
+    the file is hashed again once it finishes, so a file written in many
+    small chunks isn't read again for each of them.
+
+    The first event for a file is always delivered, there's nothing to
+    compare it with.
+
+    '''
+
+    masks = (IN_MODIFY, IN_CLOSE_WRITE)
+    cache_size = 4096
+    poll_interval = 0.005  # seconds between checks for finished hashes
+
+    def __init__(self, workers=1):
+        if ThreadPoolExecutor is None:
+            raise RuntimeError('concurrent.futures is not available')
+        self._executor = ThreadPoolExecutor(workers)
+        self._cache = OrderedDict()    # pathname -> (size, mtime, fingerprint)
+        self._pending = OrderedDict()  # pathname -> deque of [mask, event, future, stale]
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._pending.values())
+
+    def add(self, mask, event):
+        '''
+        Returns the list of (mask, event) ready to be dispatched now
+
+        '''
+        pathname = event.pathname
+        queue = self._pending.get(pathname)
+        future = None
+        if mask in self.masks and not event.is_dir:
+            cached = self._cache.get(pathname)
+            if cached is not None and queue is None and cached[:2] == _size_mtime(pathname):
+                return []
+            last = queue[-1] if queue else None
+            if last is not None and last[2] is not None and not last[2].done():
+                last[0], last[1] = mask, event
+                if last[2].cancel():
+                    last[2] = self._executor.submit(_fingerprint, pathname)
+                else:  # already hashing an older version of the contents
+                    last[3] = True
+                return []
+            future = self._executor.submit(_fingerprint, pathname)
+        elif queue is None:
+            self._forget(event)
+            return [(mask, event)]
+        if queue is None:
+            queue = self._pending[pathname] = deque()
+        queue.append([mask, event, future, False])
+        return []
+
+    def done(self):
+        '''
+        Returns the list of (mask, event) whose hashes are ready, without
+        the ones for unchanged files
+
+        '''
+        ready = []
+        for pathname, queue in list(self._pending.items()):
+            while queue and (queue[0][2] is None or queue[0][2].done()):
+                if queue[0][3]:
+                    queue[0][2] = self._executor.submit(_fingerprint, pathname)
+                    queue[0][3] = False
+                    break
+                mask, event, future, stale = queue.popleft()
+                if future is None:
+                    self._forget(event)
+                    ready.append((mask, event))
+                    continue
+                try:
+                    result = future.result()
+                except (IOError, OSError):
+                    result = None
+                if result is None:  # gone, or not a regular file
+                    self._cache.pop(pathname, None)
+                    ready.append((mask, event))
+                    continue
+                cached = self._cache.pop(pathname, None)
+                self._remember(pathname, result)
+                if cached is None or cached[2] != result[2]:
+                    ready.append((mask, event._replace(fingerprint=result[2])))
+            if not queue:
+                del self._pending[pathname]
+        return ready
+
+    def next_deadline(self):
+        '''
+        Returns when `done()` should be called again, or None
+
+        '''
+        if not self._pending:
+            return None
+        return time.time() + self.poll_interval
+
+    def _forget(self, event):
+        if event.mask == MOVE:
+            cached = self._cache.pop(event.src_pathname, None)
+            if cached is not None and event.pathname is not None:
+                self._remember(event.pathname, cached)
+        elif event.mask in (IN_DELETE, IN_CREATE):
+            self._cache.pop(event.pathname, None)
+
+    def _remember(self, pathname, entry):
+        self._cache.pop(pathname, None)
+        self._cache[pathname] = entry
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+def _size_mtime(pathname):
+    try:
+        st = os.stat(pathname)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+_hash = getattr(hashlib, 'blake2b', hashlib.sha1)
+
+
+def _fingerprint(pathname, chunk_size=256 * 1024):
+    '''
+    Returns (size, mtime, hash) of the contents of a regular file, or None
+
+    '''
+    with open(pathname, 'rb') as fileobj:
+        st = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        digest = _hash()
+        buffer = bytearray(min(chunk_size, st.st_size) or 1)
+        view = memoryview(buffer)
+        while True:
+            size = fileobj.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+    return st.st_size, st.st_mtime, digest.hexdigest()
+
+
+class _ThreadedDispatcher(object):
+    '''
+    Runs handler chains on an executor, one at a time per key and with a
+    limit on how many events can be pending. See `Detector.start()`
+
+    '''
+
+    overflow_modes = ('block', 'drop_oldest', 'coalesce')
+
+    def __init__(self, executor, max_pending, overflow, owns_executor=False):
+        self._executor = executor
+        self._max_pending = max_pending
+        self._overflow = overflow
+        self._owns_executor = owns_executor
+        self._cond = threading.Condition()
+        self._queues = {}       # key -> deque of waiting items, while running
+        self._waiting = deque()  # waiting items, oldest first, for 'drop_oldest'
+        self._pending = 0       # waiting or running items
+        self.dropped = 0
+
+    def submit(self, key, handlers, event):
+        item = [key, handlers, event, True]  # last element: still waiting
+        with self._cond:
+            queue = self._queues.get(key)
+            if self._pending >= self._max_pending:
+                if self._overflow == 'coalesce' and queue is not None and \
+                        any(waiting[3] and waiting[2] == event for waiting in queue):
+                    self.dropped += 1
+                    return
+                if self._overflow == 'drop_oldest':
+                    self._drop_oldest()
+                while self._pending >= self._max_pending:
+                    self._cond.wait()
+                queue = self._queues.get(key)
+            self._pending += 1
+            if self._overflow == 'drop_oldest':
+                while self._waiting and not self._waiting[0][3]:
+                    self._waiting.popleft()
+                self._waiting.append(item)
+            if queue is None:
+                self._queues[key] = deque([item])
+                self._executor.submit(self._run, key)
+            else:
+                queue.append(item)
+
+    def __len__(self):
+        return self._pending
+
+    def flush(self):
+        pass
+
+    def shutdown(self, wait=True):
+        if wait:
+            with self._cond:
+                while self._pending:
+                    self._cond.wait()
+        if self._owns_executor:
+            self._executor.shutdown(wait)
+
+    def _drop_oldest(self):
+        while self._waiting:
+            item = self._waiting.popleft()
+            if item[3]:
+                item[3] = False
+                self._pending -= 1
+                self.dropped += 1
+                return
+
+    def _run(self, key):
+        with self._cond:
+            queue = self._queues[key]
+            while queue and not queue[0][3]:
+                queue.popleft()
+            if not queue:
+                del self._queues[key]
+                return
+            item = queue[0]
+            item[3] = False
+        try:
+            _call_chain(item[1], item[2])
+        except Exception:
+            log.exception('Error handling %r', item[2])
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+            queue.popleft()
+            while queue and not queue[0][3]:
+                queue.popleft()
+            if queue:
+                self._executor.submit(self._run, key)
+            else:
+                del self._queues[key]
+
+
+class _ProcessDispatcher(object):
+    '''
+    Runs handler chains in `processes` forked processes, see
+    `Detector.start()`. Each process has a copy of the detector with the
+    handlers, and gets the events through its own pipe so the ones with
+    the same shard key are handled in order. Events are packed with
+    `_pack_event()` and sent on `flush()`, once per read.
+
+    Exceptions raised by handlers are logged by the processes. The
+    'handler_seconds' metrics of the handlers are not collected.
+
+    '''
+
+    shard_modes = ('path', 'subdirectory')
+
+    def __init__(self, detector, processes, shard_by='path'):
+        import multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing  # python 2, always forks
+        self._root_of = detector._root_of
+        self._shard_by = shard_by
+        self._connections = []
+        self._processes = []
+        for i in range(processes):
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=_run_handlers, args=(detector, reader),
+                                      name='fsdetect-handlers-{0}'.format(i))
+            process.daemon = True
+            process.start()
+            reader.close()
+            self._connections.append(writer)
+            self._processes.append(process)
+        self._buffers = [[] for i in range(processes)]
+        self._buffered = 0
+        self.dropped = 0
+
+    def submit(self, key, handlers, event):
+        if isinstance(event, list):  # batch, the key is ('batch', mask)
+            buffer = self._buffers[hash(key) % len(self._buffers)]
+            buffer.append(_BATCH_RECORD.pack(1, key[1], len(event)))
+            buffer.extend(_pack_event(batch_event) for batch_event in event)
+        else:
+            self._buffers[self._shard(key)].append(_pack_event(event))
+        self._buffered += 1
+
+    def __len__(self):
+        return self._buffered
+
+    def flush(self):
+        '''
+        Sends the events submitted, blocks while the pipes are full
+
+        '''
+        for connection, buffer in zip(self._connections, self._buffers):
+            if buffer:
+                connection.send_bytes(b''.join(buffer))
+                del buffer[:]
+        self._buffered = 0
+
+    def shutdown(self, wait=True):
+        self.flush()
+        for connection in self._connections:
+            connection.send_bytes(b'')  # stops the process after the queued events
+            connection.close()
+        for process in self._processes:
+            if not wait:
+                process.terminate()
+            process.join()
+
+    def _shard(self, pathname):
+        if self._shard_by == 'subdirectory':
+            root = self._root_of(pathname)
+            if root is not None and root != pathname:
+                name = pathname[len(root):].lstrip(os.sep).split(os.sep, 1)[0]
+                pathname = os.path.join(root, name)
+        return hash(pathname) % len(self._buffers)
+
+
+def _run_handlers(detector, connection):
+    '''
+    Loop of the processes of `_ProcessDispatcher`
+
+    '''
+    while True:
+        try:
+            data = connection.recv_bytes()
+        except EOFError:
+            break
+        if not data:
+            break
+        for mask, event in _unpack_events(data):
+            if isinstance(event, list):
+                handlers = detector._batch_handlers[mask]
+            else:
+                handlers = detector._chain(mask, event)
+            try:
+                _call_chain(handlers, event)
+            except Exception:
+                log.exception('Error handling %r', event)
+
+
+# kind (0), flags, mask, lengths of pathname, src_pathname and fingerprint
+_EVENT_RECORD = struct.Struct('=BBIHHH')
+# kind (1), mask, number of events after it
+_BATCH_RECORD = struct.Struct('=BII')
+_IS_DIR, _HAS_PATHNAME, _HAS_SRC_PATHNAME, _HAS_FINGERPRINT = 1, 2, 4, 8
+_HAS_COUNTS, _HAS_PATHS = 16, 32
+# sizes of the counts ('name=count' separated by NUL) and paths (separated
+# by NUL) of 'tree_changed' events, after the strings of _EVENT_RECORD
+_CHANGES_RECORD = struct.Struct('=II')
+
+
+def _pack_event(event):
+    '''
+    Returns `event` as bytes, a `_EVENT_RECORD` followed by its strings
+
+    '''
+    flags = _IS_DIR if event.is_dir else 0
+    pathname = src_pathname = fingerprint = b''
+    if event.pathname is not None:
+        flags |= _HAS_PATHNAME
+        pathname = _fsencode(event.pathname)
+    if event.src_pathname is not None:
+        flags |= _HAS_SRC_PATHNAME
+        src_pathname = _fsencode(event.src_pathname)
+    if event.fingerprint is not None:
+        flags |= _HAS_FINGERPRINT
+        fingerprint = event.fingerprint.encode('ascii')
+    parts = [None, pathname, src_pathname, fingerprint]
+    if event.counts is not None or event.paths is not None:
+        counts = paths = b''
+        if event.counts is not None:
+            flags |= _HAS_COUNTS
+            counts = b'\0'.join('{0}={1}'.format(name, count).encode('ascii')
+                                for name, count in event.counts.items())
+        if event.paths is not None:
+            flags |= _HAS_PATHS
+            paths = b'\0'.join(_fsencode(path) for path in event.paths)
+        parts.extend((_CHANGES_RECORD.pack(len(counts), len(paths)), counts, paths))
+    parts[0] = _EVENT_RECORD.pack(0, flags, event.mask, len(pathname),
+                                  len(src_pathname), len(fingerprint))
+    return b''.join(parts)
+
+
+def _unpack_events(data):
+    '''
+    Yields the (mask, event) packed in `data`, with a list of events for
+    batches
+
+    '''
+    offset = 0
+    while offset < len(data):
+        if data[offset:offset + 1] == b'\x01':
+            kind, mask, count = _BATCH_RECORD.unpack_from(data, offset)
+            offset += _BATCH_RECORD.size
+            events = []
+            for i in range(count):
+                event, offset = _unpack_event(data, offset)
+                events.append(event)
+            yield mask, events
+        else:
+            event, offset = _unpack_event(data, offset)
+            yield event.mask, event
+
+
+def _unpack_event(data, offset):
+    kind, flags, mask, pathname_length, src_length, fingerprint_length = \
+        _EVENT_RECORD.unpack_from(data, offset)
+    offset += _EVENT_RECORD.size
+    pathname = src_pathname = fingerprint = None
+    if flags & _HAS_PATHNAME:
+        pathname = _fsdecode(data[offset:offset + pathname_length])
+    offset += pathname_length
+    if flags & _HAS_SRC_PATHNAME:
+        src_pathname = _fsdecode(data[offset:offset + src_length])
+    offset += src_length
+    if flags & _HAS_FINGERPRINT:
+        fingerprint = data[offset:offset + fingerprint_length].decode('ascii')
+    offset += fingerprint_length
+    counts = paths = None
+    if flags & (_HAS_COUNTS | _HAS_PATHS):
+        counts_length, paths_length = _CHANGES_RECORD.unpack_from(data, offset)
+        offset += _CHANGES_RECORD.size
+        if flags & _HAS_COUNTS:
+            counts = {}
+            for item in data[offset:offset + counts_length].split(b'\0'):
+                if item:
+                    name, count = item.decode('ascii').split('=')
+                    counts[name] = int(count)
+        offset += counts_length
+        if flags & _HAS_PATHS:
+            paths = [_fsdecode(path) for path in data[offset:offset + paths_length].split(b'\0')
+                     if path]
+        offset += paths_length
+    return Event(pathname, src_pathname, mask, bool(flags & _IS_DIR), fingerprint,
+                 counts, paths), offset
+
+
+class _Metrics(object):
+    '''
+    Counters and histograms of `Detector.stats()`, only kept when enabled
+
+    '''
+
+    def __init__(self):
+        self.received = defaultdict(int)    # mask -> count
+        self.dispatched = defaultdict(int)  # mask -> count
+        self.ignored = 0
+        self.check = _Histogram()
+        self._handlers = {}            # handler -> _TimedHandler
+        self._names = defaultdict(int)  # handler name -> handlers with it
+
+    def timed(self, handler):
+        '''
+        Returns a wrapper of `handler` that records how long it takes.
+        Handlers with the same name, like methods of different instances,
+        are told apart by appending '#2', '#3'... in the order they're seen
+
+        '''
+        timed = self._handlers.get(handler)
+        if timed is None:
+            name = _handler_name(handler)
+            self._names[name] += 1
+            if self._names[name] > 1:
+                name = '{0}#{1}'.format(name, self._names[name])
+            timed = self._handlers[handler] = _TimedHandler(handler, _Histogram(), name)
+        return timed
+
+    def stats(self):
+        return {
+            'events_received': _named_counts(self.received),
+            'events_dispatched': _named_counts(self.dispatched),
+            'events_ignored': self.ignored,
+            'handler_seconds': dict((timed.name, timed.histogram.stats())
+                                    for timed in list(self._handlers.values())),
+            'check_seconds': self.check.stats(),
+        }
+
+
+class _TimedHandler(object):
+
+    __slots__ = ('handler', 'histogram', 'name')
+
+    def __init__(self, handler, histogram, name):
+        self.handler = handler
+        self.histogram = histogram
+        self.name = name
+
+    def __call__(self, event):
+        start = time.time()
+        try:
+            return self.handler(event)
+        finally:
+            self.histogram.observe(time.time() - start)
+
+
+class _Histogram(object):
+    '''
+    Counts observed values in buckets of fixed upper bounds, in seconds
+
+    '''
+
+    bounds = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self._lock = threading.Lock()  # handlers can run in many threads
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def stats(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'count': cumulative, 'sum': total, 'buckets': buckets}
+
+
+class PrometheusExporter(object):
+    '''
+    Exporter for `Detector.add_exporter()` that formats the stats in the
+    Prometheus text format, and writes them to the file `path` (replaced
+    atomically, for the node exporter textfile collector) or passes them
+    to `callback`.
+
+    '''
+
+    def __init__(self, path=None, callback=None, prefix='fsdetect'):
+        if (path is None) == (callback is None):
+            raise ValueError('either path or callback is required')
+        self.path = path
+        self.callback = callback
+        self.prefix = prefix
+
+    def __call__(self, stats):
+        text = self.format(stats)
+        if self.callback is not None:
+            self.callback(text)
+            return
+        temporary = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temporary, 'w') as fileobj:
+            fileobj.write(text)
+        os.rename(temporary, self.path)
+
+    def format(self, stats):
+        lines = []
+        def metric(name, kind, samples):
+            name = '{0}_{1}'.format(self.prefix, name)
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('{0}="{1}"'.format(key, _escape_label(value))
+                                  for key, value in labels)
+                lines.append('{0}{1}{2} {3!r}'.format(
+                    name, suffix, '{' + labels + '}' if labels else '', value))
+
+        def histograms(name, by_label):
+            samples = []
+            for labels, histogram in by_label:
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', labels + (('le', le),), count))
+                samples.append(('_sum', labels, histogram['sum']))
+                samples.append(('_count', labels, histogram['count']))
+            metric(name, 'histogram', samples)
+
+        metric('watches', 'gauge', [('', (), stats['watches'])])
+        if stats['max_user_watches'] is not None:
+            metric('max_user_watches', 'gauge', [('', (), stats['max_user_watches'])])
+        metric('queue_depth', 'gauge', [('', (('queue', queue),), depth)
+                                        for queue, depth in sorted(stats['queue_depth'].items())])
+        for name in ('overflows', 'resynced', 'dropped'):
+            metric(name + '_total', 'counter', [('', (), stats[name])])
+        if 'events_received' in stats:
+            for name in ('events_received', 'events_dispatched'):
+                metric(name + '_total', 'counter', [('', (('event', event),), count)
+                                                    for event, count in sorted(stats[name].items())])
+            metric('events_ignored_total', 'counter', [('', (), stats['events_ignored'])])
+            histograms('handler_seconds', [((('handler', handler),), histogram)
+                                           for handler, histogram in
+                                           sorted(stats['handler_seconds'].items())])
+            histograms('check_seconds', [((), stats['check_seconds'])])
+        return '\n'.join(lines) + '\n'
+
+
+def _named_counts(counts):
+    return dict((_event_name(mask) or hex(mask), count) for mask, count in list(counts.items()))
+
+
+def _handler_name(handler):
+    name = getattr(handler, '__qualname__', None) or getattr(handler, '__name__', None)
+    if name is None:
+        return repr(handler)
+    module = getattr(handler, '__module__', None)
+    return '{0}.{1}'.format(module, name) if module else name
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _max_user_watches():
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as fileobj:
+            return int(fileobj.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _call_chain(handlers, event):
+    for handler in handlers:
+        if handler(event):
+            break
+
+
+class _EventStream(object):
+    '''
+    Asynchronous iterator returned by `Detector.events()`
+
+    '''
+
+    def __init__(self, detector, event_name, maxsize):
+        self._detector = detector
+        self._queue = _asyncio().Queue(maxsize)
+        detector.on(event_name, self._put)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._queue.get()
+
+    def close(self):
+        '''
+        Stops receiving events
+
+        '''
+        self._detector._remove_handler(self._put)
+
+    def _put(self, event):
+        if not self._queue.full():
+            self._queue.put_nowait(event)
+
+
+def _asyncio():
+    # imported on first use, it is slow to import and only needed with attach()
+    import asyncio
+    return asyncio
+
+
+def _isawaitable(obj):
+    asyncio = _asyncio()
+    return asyncio.iscoroutine(obj) or isinstance(obj, asyncio.Future) \
+        or hasattr(obj, '__await__')
+
+
+class _Snapshot(object):
+    '''
+    Keeps the (inode, mtime, size, is directory) of every path in a tree,
+    updated from the received events, to find out what changed when events
+    were lost.
+
+    Paths are also indexed by their directory, removing a directory only
+    looks at the entries inside it.
+
+    '''
+
+    stale = False  # never needs to be resynced before watching
+
+    def __init__(self, roots, excluded):
+        self._roots = roots
+        self._excluded = excluded
+        self._entries = {}
+        self._children = {}  # directory -> set of pathnames in it
+
+    def scan(self):
+        self._set_entries(self._walk_roots())
+
+    def flush(self):
+        pass
+
+    def record(self, raw_event):
+        '''
+        Updates the snapshot from a pyinotify event
+
+        '''
+        mask, pathname = raw_event.mask, raw_event.pathname
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self._remove(pathname, mask & IN_ISDIR)
+        elif mask & IN_MOVED_TO and mask & IN_ISDIR:
+            entry = _stat_entry(pathname)
+            if entry is not None:
+                self._add(pathname, entry)
+            for child, entry in self._walk(pathname).items():
+                self._add(child, entry)
+        elif mask & (IN_CREATE | IN_MOVED_TO |
+                     IN_MODIFY | IN_CLOSE_WRITE):
+            entry = _stat_entry(pathname)
+            if entry is not None:
+                self._add(pathname, entry)
+
+    def resync(self):
+        '''
+        Scans the tree again, returns the list of (mask, Event) needed to
+        go from the previous state to the current one
+
+        '''
+        old, new = self._entries, self._walk_roots()
+        self._set_entries(new)
+        changes = []
+        deleted = dict((entry[0], pathname) for pathname, entry in old.items()
+                       if pathname not in new)
+        def change(mask, pathname, src_pathname, entry):
+            changes.append((mask, Event(pathname, src_pathname, mask, entry[3])))
+
+        for pathname in sorted(new):
+            entry = new[pathname]
+            previous = old.get(pathname)
+            if previous is None:
+                src_pathname = deleted.pop(entry[0], None)
+                if src_pathname is not None:
+                    change(MOVE, pathname, src_pathname, entry)
+                else:
+                    change(IN_CREATE, pathname, None, entry)
+            elif previous[0] != entry[0]:
+                change(IN_DELETE, pathname, None, previous)
+                change(IN_CREATE, pathname, None, entry)
+            elif not entry[3] and previous[1:3] != entry[1:3]:
+                change(IN_MODIFY, pathname, None, entry)
+        for pathname in sorted(deleted.values(), reverse=True):
+            change(IN_DELETE, pathname, None, old[pathname])
+        return changes
+
+    def _set_entries(self, entries):
+        self._entries = entries
+        self._children = {}
+        for pathname in entries:
+            self._children.setdefault(os.path.dirname(pathname), set()).add(pathname)
+
+    def _add(self, pathname, entry):
+        if pathname not in self._entries:
+            self._children.setdefault(os.path.dirname(pathname), set()).add(pathname)
+        self._entries[pathname] = entry
+
+    def _remove(self, pathname, is_dir):
+        if self._entries.pop(pathname, None) is not None:
+            siblings = self._children.get(os.path.dirname(pathname))
+            siblings.discard(pathname)
+            if not siblings:
+                del self._children[os.path.dirname(pathname)]
+        if is_dir:
+            directories = [pathname]
+            while directories:
+                for child in self._children.pop(directories.pop(), ()):
+                    del self._entries[child]
+                    directories.append(child)
+
+    def _walk_roots(self):
+        entries = {}
+        for root in self._roots:
+            entries.update(self._walk(root))
+        return entries
+
+    def _walk(self, directory):
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [name for name in dirnames
+                           if not self._excluded(os.path.join(dirpath, name), True)]
+            filenames = [name for name in filenames
+                         if not self._excluded(os.path.join(dirpath, name), False)]
+            for name in dirnames + filenames:
+                pathname = os.path.join(dirpath, name)
+                entry = _stat_entry(pathname)
+                if entry is not None:
+                    entries[pathname] = entry
+        return entries
+
+
+class _StoredSnapshot(object):
+    '''
+    Same as `_Snapshot` but stored in a sqlite database at `path`, so the
+    changes made while nothing was watching can be found at startup.
+
+    `scan()` only marks the snapshot as `stale`, `resync()` is then called
+    by `Detector` before the first events are read. It walks the tree one
+    directory at a time comparing it with the stored entries for that
+    directory, so big trees don't need to be loaded in memory. Entries are
+    marked with the number of the walk that saw them, the ones not seen are
+    deleted at the end.
+
+    Roots not found in the database are stored without generating any
+    event, there's nothing to compare them with.
+
+    Changes are committed on `flush()`. The database is opened on first
+    use, and again by a forked process: a sqlite connection can't be used
+    across a fork.
+
+    '''
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS entries ('
+        ' path TEXT PRIMARY KEY, parent TEXT NOT NULL, inode INTEGER NOT NULL,'
+        ' mtime REAL NOT NULL, size INTEGER NOT NULL, is_dir INTEGER NOT NULL,'
+        ' generation INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)',
+        'CREATE INDEX IF NOT EXISTS entries_inode ON entries (inode)',
+        'CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY)',
+    )
+
+    def __init__(self, path, roots, excluded):
+        try:
+            import sqlite3
+        except ImportError:  # python built without sqlite
+            raise RuntimeError('sqlite3 is not available')
+        self._sqlite3 = sqlite3
+        self._path = path
+        self._roots = roots
+        self._excluded = excluded
+        self._connection = None
+        self._inherited = []  # connections of the parent, never closed here
+        self._pid = None
+        self._generation = 0
+        self.stale = False
+
+    @property
+    def _db(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._connection
+
+    def _connect(self):
+        if self._connection is not None:
+            self._inherited.append(self._connection)
+        self._pid = os.getpid()
+        self._connection = self._sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.schema:
+            self._connection.execute(statement)
+        self._generation = self._connection.execute(
+            'SELECT coalesce(max(generation), 0) FROM entries').fetchone()[0]
+
+    def scan(self):
+        self.stale = True
+
+    def flush(self):
+        self._db.commit()
+
+    def record(self, raw_event):
+        '''
+        Updates the snapshot from a pyinotify event
+
+        '''
+        mask, pathname = raw_event.mask, raw_event.pathname
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self._remove(pathname, mask & IN_ISDIR)
+        elif mask & IN_MOVED_TO and mask & IN_ISDIR:
+            self._remove(pathname, True)
+            for directory, entries, old in self._walk(pathname, include_self=True):
+                self._store(directory, entries)
+        elif mask & (IN_CREATE | IN_MOVED_TO |
+                     IN_MODIFY | IN_CLOSE_WRITE):
+            entry = _stat_entry(pathname)
+            if entry is not None:
+                self._store(os.path.dirname(pathname), {pathname: entry})
+
+    def resync(self):
+        '''
+        Walks the tree, yields the (mask, Event) needed to go from the
+        stored state to the current one
+
+        '''
+        self.stale = False
+        known_roots = set(row[0] for row in self._db.execute('SELECT path FROM roots'))
+        self._generation += 1  # after connecting, which reads the last one
+        for root in self._roots:
+            if root not in known_roots:
+                for directory, entries, old in self._walk(root):
+                    self._store(directory, entries)
+                self._db.execute('INSERT INTO roots (path) VALUES (?)', (root,))
+                continue
+            for directory, entries, old in self._walk(root):
+                for change in self._compare(entries, old):
+                    yield change
+                self._store(directory, entries)
+            for change in self._sweep(root):
+                yield change
+        self.flush()
+
+    def _compare(self, entries, old):
+        for pathname in sorted(entries):
+            entry = entries[pathname]
+            previous = old.get(pathname)
+            if previous is None:
+                src_pathname = self._moved_from(pathname, entry)
+                if src_pathname is not None:
+                    yield MOVE, Event(pathname, src_pathname, MOVE, entry[3])
+                else:
+                    yield IN_CREATE, Event(pathname, None, IN_CREATE,
+                                                     entry[3])
+            elif previous[0] != entry[0]:
+                yield IN_DELETE, Event(pathname, None, IN_DELETE,
+                                                 bool(previous[3]))
+                yield IN_CREATE, Event(pathname, None, IN_CREATE,
+                                                 entry[3])
+            elif not entry[3] and previous[1:3] != entry[1:3]:
+                yield IN_MODIFY, Event(pathname, None, IN_MODIFY,
+                                                 False)
+
+    def _moved_from(self, pathname, entry):
+        '''
+        Looks for an entry not seen yet with the same inode (and the same
+        mtime and size for files, inodes are reused) that doesn't exist
+        anymore. Moves it, with everything inside, to `pathname`
+
+        '''
+        rows = self._db.execute(
+            'SELECT path, mtime, size FROM entries'
+            ' WHERE inode = ? AND is_dir = ? AND generation != ?',
+            (entry[0], entry[3], self._generation))
+        for src_pathname, mtime, size in rows.fetchall():
+            if not entry[3] and (mtime, size) != entry[1:3]:
+                continue
+            current = _stat_entry(src_pathname)
+            if current is not None and current[0] == entry[0]:
+                continue  # a hard link, or not moved
+            self._db.execute('DELETE FROM entries WHERE path = ?', (src_pathname,))
+            if entry[3]:
+                start = len(src_pathname) + 1
+                self._db.execute(
+                    'UPDATE OR REPLACE entries SET path = ? || substr(path, ?),'
+                    ' parent = ? || substr(parent, ?) WHERE path > ? AND path < ?',
+                    (pathname, start, pathname, start) + _subtree_range(src_pathname))
+            return src_pathname
+        return None
+
+    def _sweep(self, root):
+        '''
+        Yields the events for the entries of `root` not seen in the last
+        walk and removes them
+
+        '''
+        where = 'generation != ? AND path > ? AND path < ?'
+        args = (self._generation,) + _subtree_range(root)
+        rows = self._db.execute(
+            'SELECT path, is_dir FROM entries WHERE ' + where + ' ORDER BY path DESC', args)
+        while True:
+            chunk = rows.fetchmany(1000)
+            if not chunk:
+                break
+            for pathname, is_dir in chunk:
+                yield IN_DELETE, Event(pathname, None, IN_DELETE,
+                                                 bool(is_dir))
+        self._db.execute('DELETE FROM entries WHERE ' + where, args)
+
+    def _store(self, directory, entries):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO entries'
+            ' (path, parent, inode, mtime, size, is_dir, generation)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(pathname, directory, entry[0], entry[1], entry[2], entry[3], self._generation)
+             for pathname, entry in entries.items()])
+
+    def _remove(self, pathname, is_dir):
+        self._db.execute('DELETE FROM entries WHERE path = ?', (pathname,))
+        if is_dir:
+            self._db.execute('DELETE FROM entries WHERE path > ? AND path < ?',
+                             _subtree_range(pathname))
+
+    def _walk(self, directory, include_self=False):
+        '''
+        Yields (directory, current entries, stored entries) for every
+        directory inside `directory`, entries are {pathname: entry}
+
+        '''
+        if include_self:
+            entry = _stat_entry(directory)
+            if entry is None:
+                return
+            yield os.path.dirname(directory), {directory: entry}, {}
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            entries = {}
+            for name, pathname, st in _list_entries(directory):
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if self._excluded(pathname, is_dir):
+                    continue
+                entries[pathname] = st.st_ino, st.st_mtime, st.st_size, is_dir
+                if is_dir:
+                    stack.append(pathname)
+            old = dict((row[0], row[1:]) for row in self._db.execute(
+                'SELECT path, inode, mtime, size, is_dir FROM entries WHERE parent = ?',
+                (directory,)))
+            yield directory, entries, old
+
+
+def _subtree_range(pathname):
+    '''
+    (low, high) bounds of the paths inside directory `pathname`, to be
+    compared as strings
+
+    '''
+    return pathname + os.sep, pathname + chr(ord(os.sep) + 1)
+
+
+class _PathFilter(object):
+    '''
+    Decides if paths inside the `roots` directories are ignored, from lists
+    of rules compiled into a single regular expression.
+
+    Rules are glob patterns matched against the name of the file or
+    directory, like '*.tmp', or compiled regular expressions searched in
+    the full path. Patterns ending with '/' only match directories, like
+    'node_modules/'.
+
+    Paths matching an `exclude` rule are ignored, and everything inside
+    excluded directories. If `include` rules are given, files not
+    matching any of them are ignored too (directories are not affected).
+
+    Decisions for directories are cached, for the last `cache_size`
+    directories.
+
+    '''
+
+    cache_size = 4096
+
+    def __init__(self, roots, exclude=None, include=None):
+        self._roots = roots
+        names, dir_names, self._exclude_regexes = self._split(['.*'] + list(exclude or ()))
+        self._exclude_file = self._compile(names)
+        self._exclude_dir = self._compile(names + dir_names)
+        self._include = None
+        if include:
+            names, dir_names, self._include_regexes = self._split(include)
+            self._include = self._compile(names)
+        self._cache = OrderedDict()
+
+    def excluded(self, pathname, is_dir=False):
+        if is_dir or pathname in self._roots:
+            # roots are never excluded, not even a file in a hidden directory
+            return self.excluded_directory(pathname)
+        dirname, name = os.path.split(pathname)
+        if self.excluded_directory(dirname) or self._exclude_file.match(name) or \
+                any(regex.search(pathname) for regex in self._exclude_regexes):
+            return True
+        if self._include is not None:
+            return not (self._include.match(name) or
+                        any(regex.search(pathname) for regex in self._include_regexes))
+        return False
+
+    def excluded_directory(self, pathname):
+        if pathname in self._roots or pathname == os.sep:
+            return False
+        try:
+            decision = self._cache.pop(pathname)
+        except KeyError:
+            dirname, name = os.path.split(pathname)
+            decision = bool(self.excluded_directory(dirname) or
+                            self._exclude_dir.match(name) or
+                            any(regex.search(pathname) for regex in self._exclude_regexes))
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[pathname] = decision
+        return decision
+
+    @staticmethod
+    def _split(rules):
+        names, dir_names, regexes = [], [], []
+        for rule in rules:
+            if hasattr(rule, 'search'):
+                regexes.append(rule)
+            elif rule.endswith('/'):
+                dir_names.append(rule.rstrip('/'))
+            else:
+                names.append(rule)
+        return names, dir_names, regexes
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return re.compile('(?!)')  # never matches
+        return re.compile('|'.join('(?:{0})'.format(fnmatch.translate(pattern))
+                                   for pattern in patterns))
+
+
+def _normalize(pathname):
+    return os.path.normpath(pathname)
+
+
+def _is_inside(pathname, directory):
+    return pathname == directory or pathname.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def _walk_directories(directory, excluded, breadth_first=False):
+    '''
+    Yields `directory` and all its subdirectories not `excluded`, parents
+    first (and shallow ones first if `breadth_first`). Doesn't follow
+    symlinks and yields each inode only once (bind mounts can create loops).
+
+    '''
+    yield directory
+    seen = set()
+    try:
+        st = os.stat(directory)
+        seen.add((st.st_dev, st.st_ino))
+    except OSError:
+        pass
+    stack = deque([directory])
+    pop = stack.popleft if breadth_first else stack.pop
+    while stack:
+        parent = pop()
+        for name, pathname, st in _list_directories(parent):
+            if (st.st_dev, st.st_ino) in seen or excluded(pathname):
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            yield pathname
+            stack.append(pathname)
+
+
+def _list_entries(directory):
+    '''
+    Yields (name, pathname, lstat) of the entries of `directory`
+
+    '''
+    if scandir is not None:
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                yield entry.name, entry.path, entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+        return
+
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        pathname = os.path.join(directory, name)
+        try:
+            yield name, pathname, os.lstat(pathname)
+        except OSError:
+            continue
+
+
+def _list_directories(directory):
+    '''
+    Yields (name, pathname, lstat) of the subdirectories of `directory`,
+    nothing if it's not a directory or can't be listed
+
+    '''
+    if scandir is not None:
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name, entry.path, entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+        return
+
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        pathname = os.path.join(directory, name)
+        try:
+            st = os.lstat(pathname)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            yield name, pathname, st
+
+
+def _sleep_until(deadline, timeout):
+    '''
+    Sleeps until `deadline` or for `timeout` milliseconds, whatever comes
+    first. Returns if `deadline` was reached
+
+    '''
+    if deadline is None:
+        time.sleep(timeout / 1000.0)
+        return False
+    delay = deadline - time.time()
+    if delay > timeout / 1000.0:
+        time.sleep(timeout / 1000.0)
+        return False
+    if delay > 0:
+        time.sleep(delay)
+    return True
+
+
+def _limit_reached(handled, max_events, deadline):
+    if max_events is not None and handled >= max_events:
+        return True
+    return deadline is not None and time.time() >= deadline
+
+
+def _readinto(fd, buffer):
+    if hasattr(os, 'readv'):
+        return os.readv(fd, [buffer])
+    data = os.read(fd, len(buffer))  # python 2
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def _fsdecode(name):
+    if hasattr(os, 'fsdecode'):
+        return os.fsdecode(name)
+    return name  # python 2, keep the bytes
+
+
+def _fsencode(name):
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(name)
+    if isinstance(name, bytes):
+        return name
+    return name.encode(sys.getfilesystemencoding())  # python 2 unicode
+
+
+def _stat_entry(pathname):
+    try:
+        st = os.lstat(pathname)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime, st.st_size, stat.S_ISDIR(st.st_mode)
+
+
+_EVENT_MASKS = {
+    'access': IN_ACCESS,
+    'modify': IN_MODIFY,
+    'attrib': IN_ATTRIB,
+    'close_write': IN_CLOSE_WRITE,
+    'close_nowrite': IN_CLOSE_NOWRITE,
+    'open': IN_OPEN,
+    'moved_from': IN_MOVED_FROM,
+    'moved_to': IN_MOVED_TO,
+    'create': IN_CREATE,
+    'delete': IN_DELETE,
+    'delete_self': IN_DELETE_SELF,
+    'move_self': IN_MOVE_SELF,
+    'unmount': IN_UNMOUNT,
+    'q_overflow': IN_Q_OVERFLOW,
+    'ignored': IN_IGNORED,
+}
+_EVENT_MASKS['move'] = MOVE
+_EVENT_MASKS['ready'] = READY
+_EVENT_MASKS['tree_changed'] = TREE_CHANGED
+_EVENT_MASKS['overflow'] = IN_Q_OVERFLOW
+_EVENT_NAMES = dict((mask, name) for name, mask in _EVENT_MASKS.items())
+_EVENT_NAMES[IN_Q_OVERFLOW] = 'overflow'
+
+# event bits that can be in a mask received from the kernel
+_EVENT_BITS = [mask for mask in sorted(_EVENT_NAMES) if mask not in (MOVE, READY, TREE_CHANGED)]
+_SPLIT_MASKS = {}
+
+
+def _event_masks(event_name):
+    '''
+    Returns the list of masks for the event names accepted by
+    `Detector.on()`, or None for '*'
+
+    '''
+    if event_name == '*':
+        return None
+    try:
+        return [_EVENT_MASKS[name.strip()] for name in event_name.split('|')]
+    except KeyError as error:
+        raise ValueError('unknown event: {0}'.format(error.args[0]))
+
+
+def _event_name(mask):
+    return _EVENT_NAMES.get(mask)
+
+
+def _split_mask(mask):
+    '''
+    Returns the list of event bits in a mask received from the kernel
+
+    '''
+    try:
+        return _SPLIT_MASKS[mask]
+    except KeyError:
+        bits = _SPLIT_MASKS[mask] = [bit for bit in _EVENT_BITS if mask & bit]
+        return bits
+
+
 def is_hidden(pathname):
     '''
     Returns True if `pathname` is a hidden file or directory
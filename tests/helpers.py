@@ -0,0 +1,24 @@
+import mock
+
+from fsdetect import Detector
+
+
+def make_detector(tmpdir, event_name, **options):
+    '''
+    Returns a detector for `tmpdir` created with `options`, and a mock
+    handler for `event_name`
+
+    '''
+    detector = Detector(str(tmpdir), **options)
+    handler = mock.Mock(return_value=None)
+    detector.on(event_name, handler)
+    return detector, handler
+
+
+def changes(handler):
+    '''
+    Returns the (name, pathname, src_pathname) of the events received by
+    a mock handler
+
+    '''
+    return [(c[0][0].name,) + c[0][0][:2] for c in handler.call_args_list]
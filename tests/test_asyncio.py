@@ -0,0 +1,117 @@
+import asyncio
+
+import mock
+
+from fsdetect import Detector
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(asyncio.wait_for(coroutine, 2))
+    finally:
+        loop.close()
+
+
+def test_should_fire_handlers_when_attached_to_loop(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    async def main():
+        detector = Detector(str(tmpdir))
+        detector.on('create', on_create)
+        detector.attach(asyncio.get_running_loop())
+
+        tmpdir.join('file.txt').ensure(file=True)
+        while not on_create.call_count:
+            await asyncio.sleep(0.01)
+        detector.detach()
+
+    run(main())
+
+    assert on_create.call_count == 1
+
+
+def test_should_await_coroutine_handlers_before_next_handler_on_chain(tmpdir):
+    calls = []
+
+    async def on_create1(event):
+        await asyncio.sleep(0.01)
+        calls.append('first')
+
+    def on_create2(event):
+        calls.append('second')
+
+    async def main():
+        detector = Detector(str(tmpdir))
+        detector.on('create', on_create1) \
+                .on('create', on_create2)
+        detector.attach(asyncio.get_running_loop())
+
+        tmpdir.join('file.txt').ensure(file=True)
+        while len(calls) < 2:
+            await asyncio.sleep(0.01)
+        detector.detach()
+
+    run(main())
+
+    assert calls == ['first', 'second']
+
+
+def test_should_allow_coroutine_handler_to_prevent_next_handlers_on_chain(tmpdir):
+    on_create2 = mock.Mock(return_value=None)
+
+    async def on_create1(event):
+        return True
+
+    async def main():
+        detector = Detector(str(tmpdir))
+        detector.on('create', on_create1) \
+                .on('create', on_create2)
+        detector.attach(asyncio.get_running_loop())
+
+        tmpdir.join('file.txt').ensure(file=True)
+        await asyncio.sleep(0.1)
+        detector.detach()
+
+    run(main())
+
+    assert on_create2.call_count == 0
+
+
+def test_should_iterate_over_events_asynchronously(tmpdir):
+
+    async def main():
+        detector = Detector(str(tmpdir))
+        events = detector.events('create')
+        detector.attach(asyncio.get_running_loop())
+
+        tmpdir.join('file1.txt').ensure(file=True)
+        tmpdir.join('file2.txt').ensure(file=True)
+        pathnames = []
+        async for event in events:
+            pathnames.append(event.pathname)
+            if len(pathnames) == 2:
+                break
+        detector.detach()
+        return pathnames
+
+    assert run(main()) == [str(tmpdir.join('file1.txt')),
+                           str(tmpdir.join('file2.txt'))]
+
+
+def test_should_deliver_coalesced_events_without_check(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    async def main():
+        detector = Detector(str(tmpdir), coalesce_ms=20)
+        detector.on('create', on_create)
+        detector.attach(asyncio.get_running_loop())
+
+        tmpdir.join('file.txt').ensure(file=True)
+        await asyncio.sleep(0.01)
+        assert on_create.call_count == 0
+        while not on_create.call_count:
+            await asyncio.sleep(0.01)
+        detector.detach()
+
+    run(main())
@@ -0,0 +1,71 @@
+import os
+
+from .helpers import changes, make_detector
+
+
+def watch_with_budget(tmpdir, max_watches, demote_after=60):
+    detector, handler = make_detector(tmpdir, 'create|delete|modify',
+                                      max_watches=max_watches)
+    detector._backend.budget.poll_interval = 0
+    detector._backend.budget.demote_after = demote_after
+    return detector, handler
+
+
+def test_should_watch_shallow_directories_and_poll_the_rest(tmpdir):
+    tmpdir.join('a', 'deep', 'deeper').ensure(dir=True)
+    tmpdir.join('b').ensure(dir=True)
+
+    detector, handler = watch_with_budget(tmpdir, 3)
+
+    assert sorted(w.path for w in detector._backend.manager.watches.values()) == [
+        str(tmpdir), str(tmpdir.join('a')), str(tmpdir.join('b'))]
+    assert detector.stats()['polled'] == 2
+
+
+def test_should_report_changes_in_polled_directories(tmpdir):
+    tmpdir.join('a', 'deep', 'file.txt').ensure(file=True)
+
+    detector, handler = watch_with_budget(tmpdir, 2)
+    tmpdir.join('a', 'deep', 'file.txt').write('changed')
+    tmpdir.join('a', 'deep', 'new.txt').ensure(file=True)
+    os.utime(str(tmpdir.join('a', 'deep', 'file.txt')), (0, 0))
+    detector.check()
+
+    assert changes(handler) == [
+        ('modify', str(tmpdir.join('a', 'deep', 'file.txt')), None),
+        ('create', str(tmpdir.join('a', 'deep', 'new.txt')), None),
+    ]
+
+
+def test_should_watch_active_polled_directory_in_place_of_idle_one(tmpdir):
+    tmpdir.join('a').ensure(dir=True)
+    tmpdir.join('b', 'deep').ensure(dir=True)
+
+    detector, handler = watch_with_budget(tmpdir, 3, demote_after=0)
+    tmpdir.join('b', 'deep', 'file.txt').ensure(file=True)
+    detector.check()
+    tmpdir.join('b', 'deep', 'other.txt').ensure(file=True)
+    detector.check()
+
+    watched = [w.path for w in detector._backend.manager.watches.values()]
+    assert str(tmpdir.join('b', 'deep')) in watched
+    assert len(watched) == 3
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('b', 'deep', 'file.txt')), None),
+        ('create', str(tmpdir.join('b', 'deep', 'other.txt')), None),
+    ]
+
+
+def test_should_poll_new_directories_over_the_limit(tmpdir):
+    detector, handler = watch_with_budget(tmpdir, 1)
+
+    tmpdir.join('new').ensure(dir=True)
+    detector.check()
+    tmpdir.join('new', 'file.txt').ensure(file=True)
+    detector.check()
+
+    assert len(detector._backend.manager.watches) == 1
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('new')), None),
+        ('create', str(tmpdir.join('new', 'file.txt')), None),
+    ]
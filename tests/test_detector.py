@@ -1,6 +1,10 @@
 import os
+import re
+import threading
+import time
 
 import mock
+import pyinotify
 import pytest
 
 from fsdetect import Detector, is_hidden
@@ -275,24 +279,37 @@ def test_should_detect_file_move_from_inside_watched_directory_to_outside(tmpdir
 
     os.rename(str(basedir.join('watched', 'old.txt')),
               str(basedir.join('new.txt')))
-    # there is a small problem here, if this event (IS_MOVED_FROM)
-    # happened just before an IN_MOVED_TO it means the file is being
-    # moved inside our watched directory, but this case we handle
-    # catching the IN_MOVED_TO event.
-    # what we are simulating here is when the next event has no relation
-    # with the file move.
-    # so unfortunately the detector has to wait until the next event
+    # there is a small problem here, if this event (IN_MOVED_FROM)
+    # is followed by an IN_MOVED_TO with the same cookie it means the
+    # file is being moved inside our watched directory.
+    # so the detector has to wait `move_timeout` milliseconds for it
     # until he makes a decision.
-    # so let's create a file just to fire another unrelated event
     detector.check()
     assert on_move.call_count == 0
 
-    basedir.join('watched', 'useless.txt').ensure(file=True)
+    wait_move_timeout(detector)
     detector.check()
 
     assert on_move.call_count == 1
 
 
+def test_should_report_move_to_outside_before_new_events_for_same_path(tmpdir):
+    basedir = tmpdir.mkdir('base')
+    basedir.mkdir('watched').join('old.txt').ensure(file=True)
+    calls = []
+
+    detector = Detector(str(basedir.join('watched')))
+    detector.on('move', lambda event: calls.append('move')) \
+            .on('create', lambda event: calls.append('create'))
+
+    os.rename(str(basedir.join('watched', 'old.txt')),
+              str(basedir.join('new.txt')))
+    basedir.join('watched', 'old.txt').ensure(file=True)
+    detector.check()
+
+    assert calls == ['move', 'create']
+
+
 def test_should_provide_object_with_empty_pathname_and_src_pathname_when_moved_from_inside_watched_dir_to_outsite(tmpdir):
     basedir = tmpdir.mkdir('base')
     basedir.mkdir('watched').join('old.txt').ensure(file=True)
@@ -306,7 +323,8 @@ def test_should_provide_object_with_empty_pathname_and_src_pathname_when_moved_f
 
     os.rename(str(basedir.join('watched', 'old.txt')),
               str(basedir.join('new.txt')))
-    basedir.join('watched', 'useless.txt').ensure(file=True)
+    detector.check()
+    wait_move_timeout(detector)
     detector.check()
 
 
@@ -325,9 +343,10 @@ def test_should_correctly_detect_two_consecutive_moves_from_inside_watched_direc
               str(basedir.join('new1.txt')))
     os.rename(str(basedir.join('watched', 'old2.txt')),
               str(basedir.join('new2.txt')))
-    basedir.join('watched', 'useless.txt').ensure(file=True)
 
     detector.check()
+    wait_move_timeout(detector)
+    detector.check()
 
     assert on_move.call_count == 2
 
@@ -356,9 +375,33 @@ def test_should_provide_consistent_object_with_consecutive_moves_from_inside_wat
               str(basedir.join('new1.txt')))
     os.rename(str(basedir.join('watched', 'old2.txt')),
               str(basedir.join('new2.txt')))
-    basedir.join('watched', 'useless.txt').ensure(file=True)
 
     detector.check()
+    wait_move_timeout(detector)
+    detector.check()
+
+
+def test_should_pair_interleaved_moves_by_cookie(tmpdir):
+    tmpdir.join('a1.txt').ensure(file=True)
+    tmpdir.join('b1.txt').ensure(file=True)
+    on_move = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('move', on_move)
+
+    # simulate IN_MOVED_FROM of both moves before their IN_MOVED_TO
+    def raw_event(mask, name, cookie):
+        return pyinotify.Event({'mask': mask, 'cookie': cookie,
+                                'pathname': str(tmpdir.join(name))})
+    detector._on_event(raw_event(pyinotify.IN_MOVED_FROM, 'a1.txt', 1))
+    detector._on_event(raw_event(pyinotify.IN_MOVED_FROM, 'b1.txt', 2))
+    detector._on_event(raw_event(pyinotify.IN_MOVED_TO, 'b2.txt', 2))
+    detector._on_event(raw_event(pyinotify.IN_MOVED_TO, 'a2.txt', 1))
+
+    assert [c[0][0][:2] for c in on_move.call_args_list] == [
+        (str(tmpdir.join('b2.txt')), str(tmpdir.join('b1.txt'))),
+        (str(tmpdir.join('a2.txt')), str(tmpdir.join('a1.txt'))),
+    ]
 
 
 #
@@ -408,6 +451,88 @@ def test_should_allow_nested_on_method_calls(tmpdir):
     assert on_delete.call_count == 1
 
 
+def test_should_listen_to_multiple_events_with_one_handler(tmpdir):
+    on_change = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create|delete', on_change)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    os.remove(str(tmpdir.join('file.txt')))
+    detector.check()
+
+    assert [c[0][0].name for c in on_change.call_args_list] == ['create', 'delete']
+
+
+def test_should_provide_event_mask_and_kind_to_handlers(tmpdir):
+    events = []
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', events.append)
+
+    tmpdir.join('dir').ensure(dir=True)
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert [(e.mask, e.is_dir) for e in events] == [(pyinotify.IN_CREATE, True),
+                                                   (pyinotify.IN_CREATE, False)]
+
+
+def test_events_should_still_be_pathname_and_src_pathname_tuples(tmpdir):
+    events = []
+
+    detector = Detector(str(tmpdir))
+    detector.on('move', events.append)
+
+    tmpdir.join('old.txt').ensure(file=True)
+    tmpdir.join('old.txt').rename(tmpdir.join('new.txt'))
+    detector.check()
+
+    pathname, src_pathname = events[0]
+    assert (pathname, src_pathname) == (str(tmpdir.join('new.txt')), str(tmpdir.join('old.txt')))
+    assert events[0] == (pathname, src_pathname)
+    assert events[0]._replace(fingerprint='x').mask == events[0].mask
+
+
+def test_should_allow_handlers_only_for_directories_or_files(tmpdir):
+    on_dir = mock.Mock(return_value=None)
+    on_file = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_dir, kind='dir') \
+            .on('create', on_file, kind='file')
+
+    tmpdir.join('dir').ensure(dir=True)
+    tmpdir.join('file1.txt').ensure(file=True)
+    tmpdir.join('file2.txt').ensure(file=True)
+    detector.check()
+
+    assert on_dir.call_count == 1
+    assert on_file.call_count == 2
+
+
+def test_should_call_wildcard_handlers_for_every_watched_event(tmpdir):
+    on_any = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', mock.Mock(return_value=None)) \
+            .on('move', mock.Mock(return_value=None)) \
+            .on('*', on_any)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    os.rename(str(tmpdir.join('file.txt')), str(tmpdir.join('doc.txt')))
+    detector.check()
+
+    assert [c[0][0].name for c in on_any.call_args_list] == ['create', 'move']
+
+
+def test_should_not_allow_unknown_events(tmpdir):
+    detector = Detector(str(tmpdir))
+
+    with pytest.raises(ValueError):
+        detector.on('explode', mock.Mock())
+
+
 #
 # ignore hidden files
 #
@@ -469,6 +594,818 @@ def test_should_not_ignore_hidden_files_when_renamed_to_visible_files(tmpdir):
 
     assert on_move.call_count == 1
 
+#
+# watch()
+#
+
+def test_should_watch_all_subdirectories_using_threads(tmpdir):
+    for i in range(10):
+        tmpdir.join('dir{0}'.format(i), 'sub').ensure(dir=True)
+    on_create = mock.Mock(return_value=None)
+    progress = mock.Mock()
+
+    detector = Detector(str(tmpdir))
+    detector.watch(['create'], workers=4, progress=progress)
+    detector.on('create', on_create)
+
+    for i in range(10):
+        tmpdir.join('dir{0}'.format(i), 'sub', 'file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 10
+    assert progress.call_args[0][0] == 21
+
+
+def test_should_not_update_watches_on_already_watched_events(tmpdir):
+    detector = Detector(str(tmpdir))
+    detector.watch(['create', 'delete'])
+
+    with mock.patch.object(detector._backend.manager, 'update_watch') as update_watch:
+        detector.on('create', mock.Mock()) \
+                .on('delete', mock.Mock())
+
+    assert update_watch.call_count == 0
+
+
+def test_should_watch_new_events_on_automatically_added_directories(tmpdir):
+    on_delete = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', mock.Mock(return_value=None))
+    detector.on('delete', on_delete)
+    tmpdir.join('newdir').ensure(dir=True)
+    detector.check()
+
+    tmpdir.join('newdir', 'file.txt').ensure(file=True)
+    detector.check()
+    tmpdir.join('newdir', 'file.txt').remove()
+    detector.check()
+
+    assert on_delete.call_count == 1
+
+
+def test_should_not_watch_the_same_directory_twice_through_symlinks(tmpdir):
+    tmpdir.join('dir').ensure(dir=True)
+    tmpdir.join('link').mksymlinkto(tmpdir.join('dir'))
+
+    detector = Detector(str(tmpdir))
+    detector.watch(['create'])
+
+    assert sorted(watch.path for watch in detector._backend.manager.watches.values()) == [
+        str(tmpdir), str(tmpdir.join('dir'))]
+
+
+#
+# batch handlers
+#
+
+def test_should_call_batch_handler_once_per_check_with_all_events(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on_batch('create', on_create)
+
+    tmpdir.join('file1.txt').ensure(file=True)
+    tmpdir.join('file2.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 1
+    events = on_create.call_args[0][0]
+    assert [event.pathname for event in events] == [str(tmpdir.join('file1.txt')),
+                                                    str(tmpdir.join('file2.txt'))]
+
+
+def test_should_not_call_batch_handler_without_events(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on_batch('create', on_create)
+    detector.check()
+
+    assert on_create.call_count == 0
+
+
+def test_should_call_batch_and_single_event_handlers_together(tmpdir):
+    on_create = mock.Mock(return_value=True)
+    on_create_batch = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create) \
+            .on_batch('create', on_create_batch)
+
+    tmpdir.join('file1.txt').ensure(file=True)
+    tmpdir.join('file2.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 2
+    assert len(on_create_batch.call_args[0][0]) == 2
+
+
+def test_should_not_allow_wildcard_batch_handlers(tmpdir):
+    detector = Detector(str(tmpdir))
+
+    with pytest.raises(ValueError):
+        detector.on_batch('*', mock.Mock())
+
+
+#
+# check() limits
+#
+
+def test_check_should_not_block_with_zero_timeout(tmpdir):
+    detector = Detector(str(tmpdir))
+    detector.on('create', mock.Mock(return_value=None))
+
+    start = time.time()
+    assert detector.check(timeout=0) == 0
+    assert time.time() - start < detector.check_timeout / 1000.0
+
+
+def test_check_should_wait_for_events_up_to_timeout(tmpdir):
+    detector = Detector(str(tmpdir))
+    detector.on('create', mock.Mock(return_value=None))
+
+    start = time.time()
+    detector.check(timeout=50)
+    assert time.time() - start >= 0.05
+
+
+@pytest.mark.parametrize('raw_reader', [False, True])
+def test_check_should_leave_events_over_max_events_for_next_call(tmpdir, raw_reader):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), raw_reader=raw_reader)
+    detector.on('create', on_create)
+
+    for i in range(5):
+        tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+
+    assert detector.check(max_events=2) == 2
+    assert on_create.call_count == 2
+    assert detector.check(timeout=0, max_events=2) == 2
+    assert detector.check(timeout=0, max_events=2) == 1
+    assert [c[0][0].pathname for c in on_create.call_args_list] == [
+        str(tmpdir.join('file{0}.txt'.format(i))) for i in range(5)]
+
+
+def test_check_should_stop_handling_events_after_budget(tmpdir):
+    on_create = mock.Mock(side_effect=lambda event: time.sleep(0.01))
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create)
+
+    for i in range(10):
+        tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+
+    assert detector.check(budget_ms=25) < 10
+    assert on_create.call_count < 10
+    while detector.check(timeout=0):
+        pass
+    assert on_create.call_count == 10
+
+
+def test_check_should_leave_resync_changes_over_max_events_for_next_call(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), resync=True)
+    detector.on('create', on_create)
+
+    for i in range(5):
+        tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+    assert simulate_overflow(detector, timeout=0, max_events=2) == 2
+    assert on_create.call_count == 2
+    assert detector.stats()['queue_depth']['backlog'] == 0
+    tmpdir.join('late.txt').ensure(file=True)
+
+    assert detector.check(timeout=0, max_events=2) == 2
+    # the events read after the resync is over
+    assert detector.check(timeout=0, max_events=2) == 2
+    assert [c[0][0].pathname for c in on_create.call_args_list] == [
+        str(tmpdir.join('file{0}.txt'.format(i))) for i in range(5)] + [
+        str(tmpdir.join('late.txt'))]
+
+
+def test_check_should_leave_coalesced_events_over_max_events_for_next_call(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), coalesce_ms=10)
+    detector.on('create', on_create)
+
+    for i in range(5):
+        tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+    detector.check(timeout=0)
+    assert detector.stats()['queue_depth']['coalescer'] == 5
+    time.sleep(0.02)
+
+    assert detector.check(timeout=0, max_events=2) == 2
+    assert on_create.call_count == 2
+    assert detector.stats()['queue_depth']['backlog'] == 3
+    assert detector.check(timeout=0, max_events=2) == 2
+    assert detector.check(timeout=0, max_events=2) == 1
+    assert [c[0][0].pathname for c in on_create.call_args_list] == [
+        str(tmpdir.join('file{0}.txt'.format(i))) for i in range(5)]
+
+
+#
+# coalescing
+#
+
+def test_should_merge_repeated_modify_events_for_same_file(tmpdir):
+    tmpdir.join('file.txt').ensure(file=True)
+    on_modify = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), coalesce_ms=50)
+    detector.on('modify', on_modify)
+
+    with open(str(tmpdir.join('file.txt')), 'w') as fileobj:
+        for i in range(10):
+            fileobj.write('chunk')
+            fileobj.flush()
+    detector.check()
+    assert on_modify.call_count == 0
+
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_modify.call_count == 1
+
+
+def test_should_collapse_modify_events_into_pending_create(tmpdir):
+    on_create = mock.Mock(return_value=None)
+    on_modify = mock.Mock(return_value=None)
+    on_close_write = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), coalesce_ms=50)
+    detector.on('create', on_create) \
+            .on('modify', on_modify) \
+            .on('close_write', on_close_write)
+
+    with open(str(tmpdir.join('file.txt')), 'w') as fileobj:
+        for i in range(10):
+            fileobj.write('chunk')
+            fileobj.flush()
+    detector.check()
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_create.call_count == 1
+    assert on_modify.call_count == 0
+    assert on_close_write.call_count == 1
+
+
+def test_should_only_coalesce_events_with_configured_window(tmpdir):
+    on_create = mock.Mock(return_value=None)
+    on_delete = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), coalesce_ms={'create': 50})
+    detector.on('create', on_create) \
+            .on('delete', on_delete)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    tmpdir.join('other.txt').ensure(file=True)
+    os.remove(str(tmpdir.join('file.txt')))
+    detector.check()
+
+    # delete is not coalesced and flushes the pending create of the same file
+    assert on_create.call_count == 1
+    assert on_delete.call_count == 1
+
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_create.call_count == 2
+
+
+def test_coalescer_should_not_look_at_every_pending_path_for_deadlines():
+    from fsdetect import _Coalescer, Event
+    coalescer = _Coalescer({'create': 60000, 'modify': 10})
+    now = time.time()
+    for i in range(100000):
+        coalescer.add(pyinotify.IN_CREATE, Event(str(i), None, pyinotify.IN_CREATE), now)
+    coalescer.add(pyinotify.IN_MODIFY, Event('modified', None, pyinotify.IN_MODIFY), now)
+
+    start = time.time()
+    for i in range(1000):
+        assert coalescer.expired(now) == []
+        assert coalescer.next_deadline() == now + 0.01
+    assert time.time() - start < 1
+
+    assert [event.pathname for mask, event in coalescer.expired(now + 0.01)] == ['modified']
+    assert len(coalescer) == 100000
+
+
+#
+# queue overflow
+#
+
+def test_should_fire_overflow_handlers_when_queue_overflows(tmpdir):
+    on_overflow = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('overflow', on_overflow)
+    simulate_overflow(detector)
+
+    assert on_overflow.call_count == 1
+    assert on_overflow.call_args[0][0].pathname == str(tmpdir)
+    assert detector.overflows == 1
+
+
+def test_should_synthesize_lost_events_after_overflow_when_resync_enabled(tmpdir):
+    tmpdir.join('deleted.txt').ensure(file=True)
+    tmpdir.join('old.txt').ensure(file=True)
+    tmpdir.join('modified.txt').ensure(file=True)
+    on_create = mock.Mock(return_value=None)
+    on_delete = mock.Mock(return_value=None)
+    on_move = mock.Mock(return_value=None)
+    on_modify = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), resync=True)
+    detector.on('create', on_create) \
+            .on('delete', on_delete) \
+            .on('move', on_move) \
+            .on('modify', on_modify)
+
+    tmpdir.join('sub').ensure(dir=True)
+    tmpdir.join('sub', 'created.txt').ensure(file=True)
+    tmpdir.join('deleted.txt').remove()
+    tmpdir.join('old.txt').rename(tmpdir.join('new.txt'))
+    tmpdir.join('modified.txt').write('content')
+    simulate_overflow(detector)
+
+    assert [c[0][0].pathname for c in on_create.call_args_list] == \
+        [str(tmpdir.join('sub')), str(tmpdir.join('sub', 'created.txt'))]
+    assert on_delete.call_args[0][0].pathname == str(tmpdir.join('deleted.txt'))
+    assert on_move.call_args[0][0][:2] == (str(tmpdir.join('new.txt')),
+                                           str(tmpdir.join('old.txt')))
+    assert on_modify.call_args[0][0].pathname == str(tmpdir.join('modified.txt'))
+    assert detector.resynced == 5
+
+
+def test_should_not_synthesize_events_already_received(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), resync=True)
+    detector.on('create', on_create)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+    simulate_overflow(detector)
+
+    assert on_create.call_count == 1
+
+
+def test_should_watch_directories_created_during_overflow(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), resync=True)
+    detector.on('create', on_create)
+
+    tmpdir.join('sub', 'nested').ensure(dir=True)
+    simulate_overflow(detector)
+    tmpdir.join('sub', 'file.txt').ensure(file=True)
+    tmpdir.join('sub', 'nested', 'file.txt').ensure(file=True)
+    detector.check()
+
+    assert [c[0][0].pathname for c in on_create.call_args_list] == [
+        str(tmpdir.join('sub')),
+        str(tmpdir.join('sub', 'nested')),
+        str(tmpdir.join('sub', 'file.txt')),
+        str(tmpdir.join('sub', 'nested', 'file.txt')),
+    ]
+
+
+def test_snapshot_should_remove_directories_without_looking_at_the_whole_tree():
+    from fsdetect import _Snapshot
+    snapshot = _Snapshot(set(['/w']), lambda pathname, is_dir: False)
+    for i in range(1000):
+        snapshot._add('/w/{0}'.format(i), (i, 0, 0, True))
+        for j in range(100):
+            snapshot._add('/w/{0}/{1}'.format(i, j), (i * 1000 + j, 0, 0, False))
+
+    start = time.time()
+    for i in range(300):
+        snapshot.record(mock.Mock(mask=pyinotify.IN_DELETE | pyinotify.IN_ISDIR,
+                                  pathname='/w/{0}'.format(i)))
+
+    assert time.time() - start < 1
+    assert len(snapshot._entries) == 700 * 101
+    assert not any(pathname.startswith('/w/299/') for pathname in snapshot._entries)
+
+
+def simulate_overflow(detector, **check_options):
+    # discards the events waiting to be read, as the kernel does
+    detector._backend.notifier.process_events()
+    while detector._backend.notifier.check_events(0):
+        os.read(detector._backend.manager.get_fd(), 1 << 16)
+    detector._on_event(pyinotify.Event({'mask': pyinotify.IN_Q_OVERFLOW}))
+    return detector.check(**check_options)
+
+
+#
+# exclude and include rules
+#
+
+def test_should_ignore_events_for_excluded_files(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), exclude=['*.tmp', '*.part'])
+    detector.on('create', on_create)
+
+    tmpdir.join('file.tmp').ensure(file=True)
+    tmpdir.join('file.part').ensure(file=True)
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 1
+    assert on_create.call_args[0][0].pathname == str(tmpdir.join('file.txt'))
+
+
+def test_should_not_ignore_file_root_inside_hidden_directory(tmpdir):
+    config = tmpdir.join('.config', 'app.conf').ensure(file=True)
+    on_modify = mock.Mock(return_value=None)
+
+    detector = Detector(str(config))
+    detector.on('modify', on_modify)
+
+    config.write('changed')
+    detector.check()
+
+    assert on_modify.call_count == 1
+
+
+def test_should_not_watch_excluded_directories(tmpdir):
+    tmpdir.join('node_modules', 'pkg').ensure(dir=True)
+    tmpdir.join('src').ensure(dir=True)
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), exclude=['node_modules/'])
+    detector.on('create', on_create)
+
+    assert sorted(watch.path for watch in detector._backend.manager.watches.values()) == [
+        str(tmpdir), str(tmpdir.join('src'))]
+
+    tmpdir.join('node_modules', 'pkg', 'index.js').ensure(file=True)
+    tmpdir.join('node_modules', 'new').ensure(dir=True)
+    detector.check()
+    tmpdir.join('node_modules', 'new', 'index.js').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 0
+
+
+def test_should_only_match_directories_with_trailing_slash_rules(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), exclude=['build/'])
+    detector.on('create', on_create)
+
+    tmpdir.join('build').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 1
+
+
+def test_should_only_report_included_files(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), include=['*.jpg', re.compile(r'/raw/')])
+    detector.on('create', on_create)
+
+    tmpdir.join('photo.jpg').ensure(file=True)
+    tmpdir.join('photo.txt').ensure(file=True)
+    tmpdir.join('raw').ensure(dir=True)
+    tmpdir.join('raw', 'photo.cr2').ensure(file=True)
+    detector.check()
+
+    assert [c[0][0].pathname for c in on_create.call_args_list] == \
+        [str(tmpdir.join('photo.jpg')), str(tmpdir.join('raw')),
+         str(tmpdir.join('raw', 'photo.cr2'))]
+
+
+def test_should_exclude_paths_matching_regular_expressions(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), exclude=[re.compile(r'~\d+$')])
+    detector.on('create', on_create)
+
+    tmpdir.join('file.txt~1').ensure(file=True)
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 1
+
+
+#
+# content fingerprints
+#
+
+def test_should_skip_close_write_when_contents_did_not_change(tmpdir):
+    tmpdir.join('file.txt').write('same')
+    on_close_write = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), fingerprint=True)
+    detector.on('close_write', on_close_write)
+
+    tmpdir.join('file.txt').write('same')
+    check_fingerprints(detector)
+    tmpdir.join('file.txt').write('same')
+    check_fingerprints(detector)
+    tmpdir.join('file.txt').write('changed')
+    check_fingerprints(detector)
+
+    assert [c[0][0].pathname for c in on_close_write.call_args_list] == [
+        str(tmpdir.join('file.txt')),
+        str(tmpdir.join('file.txt')),
+    ]
+    first, second = [c[0][0].fingerprint for c in on_close_write.call_args_list]
+    assert first and second and first != second
+
+
+def test_should_keep_order_of_events_waiting_for_fingerprint(tmpdir):
+    events = []
+    handler = lambda event: events.append((event.name, event.fingerprint is not None))
+
+    detector = Detector(str(tmpdir), fingerprint=True)
+    detector.on('close_write|delete', handler)
+
+    tmpdir.join('file.txt').write('contents')
+    tmpdir.join('file.txt').remove()
+    check_fingerprints(detector)
+
+    assert events == [('close_write', False), ('delete', False)]
+
+
+def test_should_keep_fingerprint_of_moved_files(tmpdir):
+    tmpdir.join('file.txt').write('same')
+    on_close_write = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), fingerprint=True)
+    detector.on('close_write', on_close_write)
+    detector.on('move', lambda event: None)
+
+    tmpdir.join('file.txt').write('same')
+    check_fingerprints(detector)
+    tmpdir.join('file.txt').rename(tmpdir.join('moved.txt'))
+    tmpdir.join('moved.txt').write('same')
+    check_fingerprints(detector)
+
+    assert on_close_write.call_count == 1
+
+
+def test_should_hash_file_written_in_chunks_at_most_twice():
+    from fsdetect import _Fingerprinter, Event
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fingerprint(pathname):
+        calls.append(pathname)
+        started.set()
+        release.wait(1)
+        return (len(calls), 0, str(len(calls)))
+
+    fingerprinter = _Fingerprinter()
+    with mock.patch('fsdetect._fingerprint', fingerprint):
+        for i in range(100):
+            fingerprinter.add(pyinotify.IN_MODIFY,
+                              Event('/upload', None, pyinotify.IN_MODIFY, False))
+            started.wait(1)  # the first hash is running
+        release.set()
+        deadline = time.time() + 1
+        ready = []
+        while fingerprinter._pending and time.time() < deadline:
+            time.sleep(0.01)
+            ready.extend(fingerprinter.done())
+
+    assert calls == ['/upload', '/upload']
+    assert [(event.pathname, event.fingerprint) for mask, event in ready] == [('/upload', '2')]
+
+
+def check_fingerprints(detector):
+    detector.check()
+    deadline = time.time() + 1
+    while detector._fingerprinter._pending and time.time() < deadline:
+        time.sleep(0.01)
+        detector.check()
+
+
+#
+# 'ready' event
+#
+
+def test_should_fire_ready_after_quiet_period_following_close_write(tmpdir):
+    on_ready = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.ready_timeout = 50
+    detector.on('ready', on_ready)
+
+    tmpdir.join('file.txt').write('part 1')
+    detector.check()
+    # reopened before the quiet period passed
+    tmpdir.join('file.txt').write('part 2', mode='a')
+    detector.check()
+    assert on_ready.call_count == 0
+
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_ready.call_count == 1
+    event = on_ready.call_args[0][0]
+    assert (event.name, event.pathname, event.is_dir) == \
+        ('ready', str(tmpdir.join('file.txt')), False)
+
+
+def test_should_not_fire_ready_while_file_is_being_written(tmpdir):
+    on_ready = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.ready_timeout = 50
+    detector.on('ready', on_ready)
+
+    tmpdir.join('file.txt').write('part 1')
+    detector.check()
+    with open(str(tmpdir.join('file.txt')), 'a') as fileobj:
+        fileobj.write('part 2')
+        fileobj.flush()
+        time.sleep(0.06)
+        detector.check()
+        assert on_ready.call_count == 0
+    detector.check()
+    time.sleep(0.06)
+    detector.check()
+
+    assert [c[0][0].pathname for c in on_ready.call_args_list] == [
+        str(tmpdir.join('file.txt'))]
+
+
+def test_should_fire_ready_when_file_is_moved_into_place(tmpdir):
+    on_ready = mock.Mock(return_value=None)
+    on_move = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('move', on_move) \
+            .on('ready', on_ready)
+
+    tmpdir.join('upload.tmp').write('contents')
+    tmpdir.join('upload.tmp').rename(tmpdir.join('upload.csv'))
+    detector.check()
+
+    assert on_move.call_count == 1
+    assert [c[0][0].pathname for c in on_ready.call_args_list] == [
+        str(tmpdir.join('upload.csv'))]
+
+
+def test_timer_wheel_should_return_expired_keys_in_order():
+    from fsdetect import _TimerWheel
+    wheel = _TimerWheel(0.01, slots=4)
+    now = time.time()
+    wheel.add('later', now + 1)
+    wheel.add('second', now + 0.02)
+    wheel.add('first', now + 0.01)
+    wheel.add('removed', now + 0.01)
+    wheel.remove('removed')
+
+    assert wheel.next_deadline() == now + 0.01
+    assert wheel.expired(now + 0.5) == ['first', 'second']
+    assert wheel.expired(now + 1) == ['later']
+    assert len(wheel) == 0
+
+
+#
+# 'tree_changed' event
+#
+
+def make_aggregating_detector(tmpdir, on_create, on_tree_changed, paths=None):
+    detector = Detector(str(tmpdir))
+    detector.aggregate_events = 10
+    detector.aggregate_ms = 50
+    detector.aggregate_paths = paths
+    detector.on('create', on_create) \
+            .on('tree_changed', on_tree_changed)
+    return detector
+
+
+def test_should_summarize_burst_of_events_in_subtree(tmpdir):
+    on_create = mock.Mock(return_value=None)
+    on_tree_changed = mock.Mock(return_value=None)
+    detector = make_aggregating_detector(tmpdir, on_create, on_tree_changed)
+    extracted = tmpdir.mkdir('extracted')
+    detector.check()
+
+    for i in range(100):
+        extracted.join(str(i)).ensure(file=True)
+    detector.check()
+    assert on_tree_changed.call_count == 0
+    assert detector.stats()['queue_depth']['tree_changed'] > 0
+
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_tree_changed.call_count == 1
+    event = on_tree_changed.call_args[0][0]
+    assert (event.name, event.pathname, event.is_dir, event.paths) == \
+        ('tree_changed', str(extracted), True, None)
+    assert sorted(event.counts) == ['close_write', 'create']
+    # the creates before the burst was detected are delivered as usual
+    assert on_create.call_count < 10
+    assert on_create.call_count + event.counts['create'] == 101
+
+
+def test_should_not_summarize_events_below_threshold(tmpdir):
+    on_create = mock.Mock(return_value=None)
+    on_tree_changed = mock.Mock(return_value=None)
+    detector = make_aggregating_detector(tmpdir, on_create, on_tree_changed)
+
+    for i in range(3):
+        tmpdir.join(str(i)).ensure(file=True)
+    detector.check()
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_create.call_count == 3
+    assert on_tree_changed.call_count == 0
+
+
+def test_should_summarize_removed_tree_in_its_parent(tmpdir):
+    on_create = mock.Mock(return_value=None)
+    on_tree_changed = mock.Mock(return_value=None)
+    removed = tmpdir.mkdir('data').mkdir('removed')
+    for i in range(30):
+        removed.join(str(i)).ensure(file=True)
+    detector = make_aggregating_detector(tmpdir, on_create, on_tree_changed, paths=5)
+
+    removed.remove()
+    detector.check()
+    time.sleep(0.06)
+    detector.check()
+
+    assert on_tree_changed.call_count == 1
+    event = on_tree_changed.call_args[0][0]
+    assert event.pathname == str(tmpdir.join('data'))
+    assert len(event.paths) == 5
+    assert all(path.startswith(str(removed)) for path in event.paths)
+
+
+def test_should_summarize_removed_directory_with_its_own_delete(tmpdir):
+    received = []
+    big = tmpdir.mkdir('big')
+    for i in range(30):
+        big.join(str(i)).ensure(file=True)
+    detector = Detector(str(tmpdir))
+    detector.aggregate_events = 10
+    detector.aggregate_ms = 50
+    detector.on('delete|tree_changed', received.append)
+
+    big.remove()
+    detector.check()
+    time.sleep(0.06)
+    detector.check()
+
+    assert [event.name for event in received][-1] == 'tree_changed'
+    assert str(big) not in [event.pathname for event in received[:-1]]
+    assert received[-1].pathname == str(big)
+    assert list(received[-1].counts) == ['delete']
+    assert len(received) - 1 + received[-1].counts['delete'] == 31
+
+
+def test_aggregator_should_count_per_subtree():
+    from fsdetect import _Aggregator, Event, TREE_CHANGED
+    aggregator = _Aggregator(set(['/w']), 2, 100, max_paths=10)
+    now = time.time()
+
+    def add(pathname, mask=pyinotify.IN_CREATE):
+        return aggregator.add(mask, Event(pathname, None, mask, False), now)
+
+    assert [add('/w/a/1'), add('/w/b/1'), add('/w/a/2'), add('/w/a/x/3')] == \
+        [False, False, True, True]
+    assert not add('/w', pyinotify.IN_Q_OVERFLOW)
+    assert not add('/w/a/x', pyinotify.IN_IGNORED)
+    assert aggregator.expired(now) == []
+    assert aggregator.next_deadline() == now + 0.1
+
+    assert aggregator.expired(now + 0.1) == [
+        Event('/w/a', None, TREE_CHANGED, True, None, {'create': 2}, ['/w/a/2', '/w/a/x/3'])]
+    assert len(aggregator) == 0
+
+
+def test_aggregator_should_count_directory_events_in_its_own_subtree():
+    from fsdetect import _Aggregator, Event, TREE_CHANGED
+    aggregator = _Aggregator(set(['/w']), 2, 100)
+    now = time.time()
+
+    def delete(pathname, is_dir):
+        return aggregator.add(pyinotify.IN_DELETE,
+                              Event(pathname, None, pyinotify.IN_DELETE, is_dir), now)
+
+    # the directory itself is in its subtree, a file in the root is not
+    assert [delete('/w/a/1', False), delete('/w/a', True), delete('/w/b', False)] == \
+        [False, True, False]
+
+    assert aggregator.expired(now + 0.1) == [
+        Event('/w/a', None, TREE_CHANGED, True, None, {'delete': 1}, None)]
+
+
 #
 # is_hidden() helper function
 #
@@ -488,6 +1425,10 @@ def test_is_hidden():
 # asserts
 #
 
+def wait_move_timeout(detector):
+    time.sleep(detector.move_timeout / 1000.0)
+
+
 def assert_not_called(detector, handler):
     detector.check()
     assert handler.call_count == 0
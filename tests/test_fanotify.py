@@ -0,0 +1,97 @@
+import mock
+import pytest
+
+from fsdetect import Detector
+
+from .helpers import changes
+
+
+@pytest.fixture
+def detector(tmpdir):
+    try:
+        detector = Detector(str(tmpdir), backend='fanotify')
+        detector.watch(['create', 'delete', 'move', 'close_write'])
+    except (RuntimeError, OSError) as error:
+        pytest.skip('fanotify not available: {0}'.format(error))
+    return detector
+
+
+def check(detector):
+    for i in range(3):
+        detector.check(timeout=50)
+
+
+def test_should_detect_events_in_the_whole_tree_with_one_mark(tmpdir, detector):
+    handler = mock.Mock(return_value=None)
+    detector.on('create|delete|close_write', handler)
+
+    tmpdir.join('dir', 'file.txt').write('contents', ensure=True)
+    tmpdir.join('dir', 'file.txt').remove()
+    check(detector)
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('dir')), None),
+        ('create', str(tmpdir.join('dir', 'file.txt')), None),
+        ('close_write', str(tmpdir.join('dir', 'file.txt')), None),
+        ('delete', str(tmpdir.join('dir', 'file.txt')), None),
+    ]
+    assert detector.stats()['watches'] == 1
+
+
+def test_should_pair_moves_with_fanotify(tmpdir, detector):
+    tmpdir.join('file.txt').ensure(file=True)
+    tmpdir.join('dir').ensure(dir=True)
+    handler = mock.Mock(return_value=None)
+    detector.on('move', handler)
+
+    tmpdir.join('file.txt').rename(tmpdir.join('dir', 'moved.txt'))
+    tmpdir.join('dir').rename(tmpdir.join('other'))
+    check(detector)
+
+    # the path of the directory is resolved when the events are read
+    assert changes(handler) == [
+        ('move', str(tmpdir.join('other', 'moved.txt')), str(tmpdir.join('file.txt'))),
+        ('move', str(tmpdir.join('other')), str(tmpdir.join('dir'))),
+    ]
+
+
+def test_should_ignore_events_outside_the_roots_with_fanotify(tmpdir):
+    tmpdir.join('watched').ensure(dir=True)
+    try:
+        detector = Detector(str(tmpdir.join('watched')), backend='fanotify')
+        detector.watch(['create'])
+    except (RuntimeError, OSError) as error:
+        pytest.skip('fanotify not available: {0}'.format(error))
+    handler = mock.Mock(return_value=None)
+    detector.on('create', handler)
+
+    tmpdir.join('outside.txt').ensure(file=True)
+    tmpdir.join('watched', 'inside.txt').ensure(file=True)
+    check(detector)
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('watched', 'inside.txt')), None),
+    ]
+
+
+def test_should_watch_other_roots_in_the_same_filesystem_with_fanotify(tmpdir):
+    tmpdir.join('a').ensure(dir=True)
+    tmpdir.join('b').ensure(dir=True)
+    try:
+        detector = Detector(str(tmpdir.join('a')), backend='fanotify')
+        detector.watch(['create'])
+    except (RuntimeError, OSError) as error:
+        pytest.skip('fanotify not available: {0}'.format(error))
+    handler = mock.Mock(return_value=None)
+    detector.on('create', handler)
+
+    tmpdir.join('b', 'before.txt').ensure(file=True)
+    check(detector)
+    detector.add_root(str(tmpdir.join('b')))
+    tmpdir.join('b', 'after.txt').ensure(file=True)
+    check(detector)
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('b', 'after.txt')), None),
+    ]
+    assert detector.stats()['watches'] == 1
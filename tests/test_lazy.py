@@ -0,0 +1,83 @@
+import mock
+import pytest
+
+from fsdetect import Detector
+
+from .helpers import changes, make_detector
+
+
+def watch_lazily(tmpdir, lazy_depth, crawl_batch=0):
+    detector, handler = make_detector(tmpdir, 'create', lazy_depth=lazy_depth)
+    detector._backend.lazy.crawl_batch = crawl_batch
+    detector._backend.lazy.crawl_interval = 0
+    return detector, handler
+
+
+def watched(detector):
+    return sorted(watch.path for watch in detector._backend.manager.watches.values())
+
+
+def test_should_only_watch_shallow_directories_at_first(tmpdir):
+    tmpdir.join('a', 'b', 'c').ensure(dir=True)
+
+    detector, handler = watch_lazily(tmpdir, 1)
+
+    assert watched(detector) == [str(tmpdir), str(tmpdir.join('a'))]
+
+
+def test_should_watch_subdirectories_after_activity_in_parent(tmpdir):
+    tmpdir.join('a', 'b', 'c').ensure(dir=True)
+    detector, handler = watch_lazily(tmpdir, 1)
+
+    tmpdir.join('a', 'file.txt').ensure(file=True)
+    detector.check()
+    assert watched(detector) == [str(tmpdir), str(tmpdir.join('a')),
+                                 str(tmpdir.join('a', 'b'))]
+    tmpdir.join('a', 'b', 'file.txt').ensure(file=True)
+    detector.check()
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('a', 'file.txt')), None),
+        ('create', str(tmpdir.join('a', 'b', 'file.txt')), None),
+    ]
+
+
+def test_should_report_files_created_while_adding_lazy_watch(tmpdir):
+    tmpdir.join('a', 'b').ensure(dir=True)
+    detector, handler = watch_lazily(tmpdir, 1)
+    manager = detector._backend.manager
+    add_watch = manager.add_watch
+
+    def racing_add_watch(pathname, *args, **kwargs):
+        tmpdir.join('a', 'b', 'racing.txt').ensure(file=True)
+        return add_watch(pathname, *args, **kwargs)
+
+    tmpdir.join('a', 'file.txt').ensure(file=True)
+    with mock.patch.object(manager, 'add_watch', racing_add_watch):
+        detector.check()
+    detector.check()
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('a', 'file.txt')), None),
+        ('create', str(tmpdir.join('a', 'b', 'racing.txt')), None),
+    ]
+
+
+def test_should_crawl_deeper_directories_in_background(tmpdir):
+    tmpdir.join('a', 'b', 'c').ensure(dir=True)
+    tmpdir.join('d', 'e').ensure(dir=True)
+    detector, handler = watch_lazily(tmpdir, 0, crawl_batch=1)
+
+    for i in range(5):
+        detector.check(timeout=0)
+
+    assert watched(detector) == [str(tmpdir.join(path)) for path in
+                                 ('', 'a', 'a/b', 'a/b/c', 'd', 'd/e')]
+    assert handler.call_count == 0
+
+
+def test_should_not_allow_lazy_watching_with_watch_budget(tmpdir):
+    with pytest.raises(ValueError):
+        Detector(str(tmpdir), lazy_depth=1, max_watches=10)
+    with pytest.raises(ValueError):
+        Detector(str(tmpdir), lazy_depth=1, backend='polling')
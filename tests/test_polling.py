@@ -0,0 +1,119 @@
+import mock
+import pytest
+
+from fsdetect import Detector
+
+from .helpers import changes
+
+
+@pytest.fixture
+def detector(tmpdir):
+    detector = Detector(str(tmpdir), backend='polling')
+    detector._backend.interval = 0
+    return detector
+
+
+def test_should_detect_created_and_deleted_files_by_polling(tmpdir, detector):
+    tmpdir.join('deleted.txt').ensure(file=True)
+    handler = mock.Mock(return_value=None)
+    detector.on('create|delete', handler)
+
+    tmpdir.join('deleted.txt').remove()
+    tmpdir.join('dir', 'file.txt').ensure(file=True)
+    detector.check()
+    detector.check()
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('dir')), None),
+        ('delete', str(tmpdir.join('deleted.txt')), None),
+        ('create', str(tmpdir.join('dir', 'file.txt')), None),
+    ]
+
+
+def test_should_detect_modified_files_by_polling(tmpdir, detector):
+    tmpdir.join('file.txt').write('contents')
+    handler = mock.Mock(return_value=None)
+    detector.on('modify', handler)
+
+    tmpdir.join('file.txt').write('changed contents')
+    detector.check()
+
+    assert changes(handler) == [('modify', str(tmpdir.join('file.txt')), None)]
+
+
+def test_should_detect_moves_by_polling(tmpdir, detector):
+    tmpdir.join('a', 'file.txt').ensure(file=True)
+    tmpdir.join('b').ensure(dir=True)
+    handler = mock.Mock(return_value=None)
+    detector.on('move|create|delete', handler)
+
+    tmpdir.join('a', 'file.txt').rename(tmpdir.join('b', 'moved.txt'))
+    detector.check()
+
+    assert changes(handler) == [
+        ('move', str(tmpdir.join('b', 'moved.txt')), str(tmpdir.join('a', 'file.txt'))),
+    ]
+
+
+def test_should_keep_watching_moved_directories_by_polling(tmpdir, detector):
+    tmpdir.join('a', 'sub', 'file.txt').ensure(file=True)
+    handler = mock.Mock(return_value=None)
+    detector.on('move|create|delete', handler)
+
+    tmpdir.join('a').rename(tmpdir.join('b'))
+    detector.check()
+    tmpdir.join('b', 'sub', 'new.txt').ensure(file=True)
+    detector.check()
+
+    assert changes(handler) == [
+        ('move', str(tmpdir.join('b')), str(tmpdir.join('a'))),
+        ('create', str(tmpdir.join('b', 'sub', 'new.txt')), None),
+    ]
+
+
+def test_should_scan_a_bounded_number_of_directories_per_check(tmpdir, detector):
+    for i in range(5):
+        tmpdir.join(str(i)).ensure(dir=True)
+    handler = mock.Mock(return_value=None)
+    detector.on('create', handler)
+    detector._backend.batch = 2
+
+    for i in range(5):
+        tmpdir.join(str(i), 'file.txt').ensure(file=True)
+    detector.check(timeout=0)
+
+    assert handler.call_count < 5
+    for i in range(5):
+        detector.check(timeout=0)
+    assert handler.call_count == 5
+
+
+def test_should_reject_inotify_options_with_polling(tmpdir):
+    with pytest.raises(ValueError):
+        Detector(str(tmpdir), backend='polling', raw_reader=True)
+
+
+def test_should_reject_unknown_backends(tmpdir):
+    with pytest.raises(ValueError):
+        Detector(str(tmpdir), backend='poll')
+
+
+def test_should_poll_file_roots(tmpdir):
+    tmpdir.join('other.txt').ensure(file=True)
+    tmpdir.join('file.txt').write('contents')
+    handler = mock.Mock(return_value=None)
+    detector = Detector(str(tmpdir.join('file.txt')), backend='polling')
+    detector._backend.interval = 0
+    detector.on('modify|delete|create', handler)
+
+    tmpdir.join('file.txt').write('changed contents')
+    tmpdir.join('other.txt').write('changed contents')
+    tmpdir.join('new.txt').ensure(file=True)
+    detector.check()
+    tmpdir.join('file.txt').remove()
+    detector.check()
+
+    assert changes(handler) == [
+        ('modify', str(tmpdir.join('file.txt')), None),
+        ('delete', str(tmpdir.join('file.txt')), None),
+    ]
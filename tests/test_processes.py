@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+
+import pytest
+
+from fsdetect import Detector, Event, MOVE, TREE_CHANGED
+from fsdetect import _pack_event, _unpack_events
+
+
+@pytest.fixture
+def calls():
+    return multiprocessing.get_context('fork').Queue()
+
+
+def received(calls, count):
+    return [calls.get(timeout=2) for i in range(count)]
+
+
+def test_should_run_handlers_in_worker_processes(tmpdir, calls):
+    def on_create(event):
+        calls.put((os.getpid(), event.name, event.pathname))
+
+    def on_delete(event):
+        calls.put((os.getpid(), event.name, event.pathname))
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create) \
+            .on('delete', on_delete)
+    detector.start(processes=2)
+    try:
+        for i in range(10):
+            tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+            tmpdir.join('file{0}.txt'.format(i)).remove()
+        events = received(calls, 20)
+    finally:
+        detector.stop()
+
+    assert os.getpid() not in set(pid for pid, name, pathname in events)
+    for i in range(10):
+        pathname = str(tmpdir.join('file{0}.txt'.format(i)))
+        assert [name for pid, name, event_pathname in events
+                if event_pathname == pathname] == ['create', 'delete']
+
+
+def test_should_keep_handler_chain_semantics_in_worker_processes(tmpdir, calls):
+    def on_create1(event):
+        calls.put('first')
+        return True
+
+    def on_create2(event):
+        calls.put('second')
+
+    def on_delete(event):
+        calls.put('delete')
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create1) \
+            .on('create', on_create2) \
+            .on('delete', on_delete)
+    detector.start(processes=1)
+    try:
+        tmpdir.join('file.txt').ensure(file=True)
+        tmpdir.join('file.txt').remove()
+        events = received(calls, 2)
+    finally:
+        detector.stop()
+
+    assert events == ['first', 'delete']
+
+
+def test_should_shard_by_subdirectory(tmpdir, calls):
+    def on_create(event):
+        calls.put((os.getpid(), event.pathname))
+
+    tmpdir.join('dir').ensure(dir=True)
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create)
+    detector.start(processes=4, shard_by='subdirectory')
+    try:
+        for i in range(10):
+            tmpdir.join('dir', 'file{0}.txt'.format(i)).ensure(file=True)
+        events = received(calls, 10)
+    finally:
+        detector.stop()
+
+    assert len(set(pid for pid, pathname in events)) == 1
+    assert [pathname for pid, pathname in events] == [
+        str(tmpdir.join('dir', 'file{0}.txt'.format(i))) for i in range(10)]
+
+
+def test_should_run_batch_handlers_in_worker_processes(tmpdir, calls):
+    def on_create(events):
+        calls.put((os.getpid(), [event.pathname for event in events]))
+
+    detector = Detector(str(tmpdir))
+    detector.on_batch('create', on_create)
+    detector.start(processes=2)
+    try:
+        tmpdir.join('file.txt').ensure(file=True)
+        pid, pathnames = calls.get(timeout=2)
+    finally:
+        detector.stop()
+
+    assert pid != os.getpid()
+    assert pathnames == [str(tmpdir.join('file.txt'))]
+
+
+def test_should_not_add_handlers_after_starting_processes(tmpdir):
+    detector = Detector(str(tmpdir))
+    detector.on('create', lambda event: None)
+    detector.start(processes=1)
+    try:
+        with pytest.raises(RuntimeError):
+            detector.on('delete', lambda event: None)
+    finally:
+        detector.stop()
+
+
+def test_should_pack_events_for_worker_processes():
+    events = [
+        Event('/tmp/a', None, 256, False),
+        Event('/tmp/b', '/tmp/\udcff', MOVE, True),
+        Event(None, '/tmp/c', MOVE, False),
+        Event('/tmp/d', None, 2, False, 'abcdef'),
+        Event('/tmp/e', None, TREE_CHANGED, True, None, {'create': 2}, ['/tmp/e/1', '/tmp/e/2']),
+        Event('/tmp/f', None, TREE_CHANGED, True, None, {'delete': 1, 'move': 3}),
+    ]
+    data = b''.join(_pack_event(event) for event in events)
+
+    assert [event for mask, event in _unpack_events(data)] == events
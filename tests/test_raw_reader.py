@@ -0,0 +1,83 @@
+import mock
+
+from fsdetect import Detector
+
+
+def test_should_detect_file_creation_with_raw_reader(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), raw_reader=True)
+    detector.on('create', on_create)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_args[0][0][:2] == (str(tmpdir.join('file.txt')), None)
+
+
+def test_should_detect_creation_inside_new_directories_with_raw_reader(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), raw_reader=True)
+    detector.on('create', on_create)
+
+    tmpdir.join('a', 'b', 'file.txt').ensure(file=True)
+    detector.check()
+    tmpdir.join('a', 'b', 'other.txt').ensure(file=True)
+    detector.check()
+
+    assert sorted(c[0][0].pathname for c in on_create.call_args_list) == [
+        str(tmpdir.join('a')),
+        str(tmpdir.join('a', 'b')),
+        str(tmpdir.join('a', 'b', 'file.txt')),
+        str(tmpdir.join('a', 'b', 'other.txt')),
+    ]
+
+
+def test_should_pair_moves_with_raw_reader(tmpdir):
+    on_move = mock.Mock(return_value=None)
+    tmpdir.join('a', 'file.txt').ensure(file=True)
+
+    detector = Detector(str(tmpdir), raw_reader=True)
+    detector.on('move', on_move)
+
+    tmpdir.join('a').rename(tmpdir.join('b'))
+    detector.check()
+    tmpdir.join('b', 'file.txt').rename(tmpdir.join('b', 'moved.txt'))
+    detector.check()
+
+    assert [c[0][0][:2] for c in on_move.call_args_list] == [
+        (str(tmpdir.join('b')), str(tmpdir.join('a'))),
+        (str(tmpdir.join('b', 'moved.txt')), str(tmpdir.join('b', 'file.txt'))),
+    ]
+
+
+def test_should_remove_watches_of_deleted_directories_with_raw_reader(tmpdir):
+    on_delete = mock.Mock(return_value=None)
+    tmpdir.join('a', 'file.txt').ensure(file=True)
+
+    detector = Detector(str(tmpdir), raw_reader=True)
+    detector.on('delete', on_delete)
+
+    tmpdir.join('a').remove()
+    detector.check()
+
+    assert [c[0][0].pathname for c in on_delete.call_args_list] == [
+        str(tmpdir.join('a', 'file.txt')),
+        str(tmpdir.join('a')),
+    ]
+    assert detector._backend.manager.get_wd(str(tmpdir.join('a'))) is None
+
+
+def test_should_read_more_events_than_fit_in_the_buffer_with_raw_reader(tmpdir):
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), raw_reader=True)
+    detector.on('create', on_create)
+    detector._backend.raw_reader._buffer = bytearray(256)
+
+    for i in range(100):
+        tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 100
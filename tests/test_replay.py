@@ -0,0 +1,92 @@
+import time
+
+import mock
+import pytest
+
+from fsdetect import Detector, ReplayBackend, MOVE
+from fsdetect import _read_log
+
+from .helpers import changes
+
+
+def record(tmpdir, log):
+    tmpdir.join('watched').ensure(dir=True)
+    detector = Detector(str(tmpdir.join('watched')))
+    detector.record(str(log))
+    detector.watch(['create', 'delete', 'move'])
+
+    tmpdir.join('watched', 'file.txt').ensure(file=True)
+    tmpdir.join('watched', 'file.txt').rename(tmpdir.join('watched', 'moved.txt'))
+    detector.check()
+    tmpdir.join('watched', 'moved.txt').remove()
+    detector.check()
+    detector.record(None)
+
+
+def replay(tmpdir, log, speed=None):
+    backend = ReplayBackend(str(log), speed=speed)
+    detector = Detector(str(tmpdir.join('watched')), backend=backend)
+    handler = mock.Mock(return_value=None)
+    detector.on('create|delete|move', handler)
+    while not backend.done:
+        detector.check()
+    return handler
+
+
+def test_should_replay_recorded_events(tmpdir):
+    log = tmpdir.join('events.log')
+    record(tmpdir, log)
+
+    handler = replay(tmpdir, log)
+
+    assert changes(handler) == [
+        ('create', str(tmpdir.join('watched', 'file.txt')), None),
+        ('move', str(tmpdir.join('watched', 'moved.txt')),
+         str(tmpdir.join('watched', 'file.txt'))),
+        ('delete', str(tmpdir.join('watched', 'moved.txt')), None),
+    ]
+
+
+def test_should_replay_events_with_original_timing(tmpdir):
+    log = tmpdir.join('events.log')
+    detector = Detector(str(tmpdir.join('watched').ensure(dir=True)))
+    detector.record(str(log))
+    detector.watch(['create'])
+    tmpdir.join('watched', 'first.txt').ensure(file=True)
+    detector.check()
+    time.sleep(0.2)
+    tmpdir.join('watched', 'second.txt').ensure(file=True)
+    detector.check()
+    detector.record(None)
+
+    start = time.time()
+    handler = replay(tmpdir, log, speed=2)
+
+    assert handler.call_count == 2
+    assert 0.1 <= time.time() - start < 0.2
+
+
+def test_should_write_log_in_segments_with_string_table(tmpdir):
+    log = tmpdir.join('events.log')
+    record(tmpdir, log)
+    # half written segment at the end
+    with open(str(log), 'ab') as fileobj:
+        fileobj.write(b'FSDL\x05\x00\x00\x00')
+
+    events = list(_read_log(str(log)))
+
+    pathname = str(tmpdir.join('watched', 'moved.txt'))
+    assert [(mask, pathname, src_pathname) for time_, mask, cookie, pathname, src_pathname
+            in events if mask & MOVE] == [
+        (0x40, str(tmpdir.join('watched', 'file.txt')), None),
+        (0x80, pathname, str(tmpdir.join('watched', 'file.txt'))),
+    ]
+    # one string per path in each segment
+    assert log.read_binary().count(pathname.encode()) == 2
+
+
+def test_should_reject_files_that_are_not_logs(tmpdir):
+    tmpdir.join('events.log').write('not a log')
+
+    with pytest.raises(ValueError):
+        list(_read_log(str(tmpdir.join('events.log'))))
@@ -0,0 +1,85 @@
+import mock
+import pytest
+
+from fsdetect import Detector
+
+
+def test_should_watch_multiple_directories_with_one_detector(tmpdir):
+    dir1 = tmpdir.mkdir('tenant1')
+    dir2 = tmpdir.mkdir('tenant2')
+    tmpdir.mkdir('other')
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector([str(dir1), str(dir2)])
+    detector.on('create', on_create)
+
+    dir1.join('file.txt').ensure(file=True)
+    dir2.join('sub').ensure(dir=True)
+    dir2.join('sub', 'file.txt').ensure(file=True)
+    tmpdir.join('other', 'file.txt').ensure(file=True)
+    detector.check()
+
+    assert [c[0][0].pathname for c in on_create.call_args_list] == [
+        str(dir1.join('file.txt')),
+        str(dir2.join('sub')),
+        str(dir2.join('sub', 'file.txt')),
+    ]
+
+
+def test_should_call_root_handlers_only_for_events_inside_root(tmpdir):
+    dir1 = tmpdir.mkdir('tenant1')
+    dir2 = tmpdir.mkdir('tenant2')
+    on_create1 = mock.Mock(return_value=None)
+    on_create2 = mock.Mock(return_value=None)
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector([str(dir1), str(dir2)])
+    detector.on('create', on_create1, root=str(dir1)) \
+            .on('create', on_create2, root=str(dir2)) \
+            .on('create', on_create)
+
+    dir1.join('file.txt').ensure(file=True)
+    dir1.join('sub').ensure(dir=True)
+    dir1.join('sub', 'file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create1.call_count == 3
+    assert on_create2.call_count == 0
+    assert on_create.call_count == 3
+
+
+def test_should_chain_root_handlers_before_global_handlers(tmpdir):
+    on_create1 = mock.Mock(return_value=True)
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector([str(tmpdir)])
+    detector.on('create', on_create) \
+            .on('create', on_create1, root=str(tmpdir))
+
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create1.call_count == 1
+    assert on_create.call_count == 0
+
+
+def test_should_add_roots_after_watching_started(tmpdir):
+    dir1 = tmpdir.mkdir('tenant1')
+    dir2 = tmpdir.mkdir('tenant2')
+    on_create = mock.Mock(return_value=None)
+
+    detector = Detector(str(dir1))
+    detector.on('create', on_create)
+    detector.add_root(str(dir2))
+
+    dir2.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert on_create.call_count == 1
+
+
+def test_should_not_allow_handlers_for_unknown_roots(tmpdir):
+    detector = Detector(str(tmpdir.mkdir('tenant1')))
+
+    with pytest.raises(ValueError):
+        detector.on('create', mock.Mock(), root=str(tmpdir))
@@ -0,0 +1,71 @@
+from .helpers import changes, make_detector
+
+
+def watch(tmpdir, directory):
+    detector, handler = make_detector(directory, 'create|delete|modify|move',
+                                      snapshot=str(tmpdir.join('snapshot.db')))
+    detector.check()
+    return detector, handler
+
+
+def test_should_not_send_events_the_first_time_a_directory_is_watched(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    tree.join('file.txt').ensure(file=True)
+
+    detector, handler = watch(tmpdir, tree)
+
+    assert not handler.called
+
+
+def test_should_send_changes_made_while_not_watching(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    tree.join('deleted.txt').ensure(file=True)
+    tree.join('modified.txt').ensure(file=True)
+    tree.join('moved.txt').ensure(file=True)
+    tree.join('dir', 'deleted.txt').ensure(file=True)
+    watch(tmpdir, tree)
+
+    tree.join('deleted.txt').remove()
+    tree.join('dir', 'deleted.txt').remove()
+    tree.join('modified.txt').write('changed')
+    tree.join('moved.txt').rename(tree.join('dir', 'moved.txt'))
+    tree.join('dir', 'created', 'file.txt').ensure(file=True)
+    detector, handler = watch(tmpdir, tree)
+
+    assert changes(handler) == [
+        ('modify', str(tree.join('modified.txt')), None),
+        ('create', str(tree.join('dir', 'created')), None),
+        ('move', str(tree.join('dir', 'moved.txt')), str(tree.join('moved.txt'))),
+        ('create', str(tree.join('dir', 'created', 'file.txt')), None),
+        ('delete', str(tree.join('dir', 'deleted.txt')), None),
+        ('delete', str(tree.join('deleted.txt')), None),
+    ]
+
+
+def test_should_send_moved_directory_as_a_single_move(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    tree.join('a', 'sub', 'file.txt').ensure(file=True)
+    watch(tmpdir, tree)
+
+    tree.join('a').rename(tree.join('b'))
+    detector, handler = watch(tmpdir, tree)
+
+    assert changes(handler) == [('move', str(tree.join('b')), str(tree.join('a')))]
+
+
+def test_should_keep_snapshot_updated_from_events(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    detector, handler = watch(tmpdir, tree)
+
+    tree.join('dir', 'file.txt').ensure(file=True)
+    tree.join('dir').rename(tree.join('moved'))
+    detector.check()
+    del detector
+
+    detector, handler = watch(tmpdir, tree)
+
+    assert not handler.called
+    tree.join('moved', 'file.txt').remove()
+    detector, handler = watch(tmpdir, tree)
+
+    assert changes(handler) == [('delete', str(tree.join('moved', 'file.txt')), None)]
@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import mock
+import pytest
+
+import fsdetect
+from fsdetect import Detector
+
+
+def test_should_not_import_pyinotify_until_watching(tmpdir):
+    code = '\n'.join([
+        'import sys',
+        'import fsdetect',
+        'print("pyinotify" in sys.modules)',
+        'print(any(name in sys.modules for name in ("asyncio", "multiprocessing", "sqlite3")))',
+        'detector = fsdetect.Detector({0!r})'.format(str(tmpdir)),
+        'print("pyinotify" in sys.modules)',
+        'detector.on("create", print)',
+        'print("pyinotify" in sys.modules)',
+    ])
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.dirname(os.path.abspath(fsdetect.__file__)))
+
+    assert output.split() == [b'False', b'False', b'False', b'True']
+
+
+def test_should_not_open_inotify_until_watching(tmpdir):
+    detector = Detector(str(tmpdir))
+    assert detector._backend.manager is None
+    assert detector.check(timeout=0) == 0
+
+    detector.on('create', mock.Mock())
+
+    assert detector._backend.manager.get_fd() >= 0
+
+
+def test_should_open_inotify_again_after_fork(tmpdir):
+    context = multiprocessing.get_context('fork')
+    received = context.Queue()
+    on_create = mock.Mock(return_value=None)
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create)
+
+    def child():
+        detector.check(timeout=0)  # watches again in this process
+        tmpdir.join('file.txt').ensure(file=True)
+        detector.check()
+        received.put(on_create.call_count)
+
+    process = context.Process(target=child)
+    process.start()
+    count = received.get(timeout=5)
+    process.join()
+    detector.check()
+
+    # the parent still gets its events, the child didn't read them
+    assert count == 1
+    assert on_create.call_count == 1
+
+
+def test_should_not_open_snapshot_database_until_watching(tmpdir):
+    watched = tmpdir.mkdir('watched')
+    detector = Detector(str(watched), snapshot=str(tmpdir.join('snapshot.db')))
+    assert detector._snapshot._connection is None
+
+    detector.on('create', mock.Mock())
+    assert detector._snapshot._connection is None
+    detector.check(timeout=0)
+
+    assert detector._snapshot._connection is not None
+
+
+def test_should_open_snapshot_database_again_after_fork(tmpdir):
+    context = multiprocessing.get_context('fork')
+    received = context.Queue()
+    watched = tmpdir.mkdir('watched')
+    detector = Detector(str(watched), snapshot=str(tmpdir.join('snapshot.db')))
+    detector.on('create', mock.Mock(return_value=None))
+    detector.check(timeout=0)
+    connection = detector._snapshot._connection
+
+    def child():
+        watched.join('file.txt').ensure(file=True)
+        detector.check()
+        received.put((detector._snapshot._connection is not connection,
+                      detector._snapshot._inherited == [connection]))
+
+    process = context.Process(target=child)
+    process.start()
+    result = received.get(timeout=5)
+    process.join()
+
+    assert result == (True, True)
+    assert detector._snapshot._connection is connection
+
+
+def test_should_not_open_fanotify_until_watching(tmpdir):
+    detector = Detector(str(tmpdir), backend='fanotify')
+    assert detector._backend._fd is None
+    try:
+        detector.watch(['create'])
+    except (RuntimeError, OSError) as error:
+        pytest.skip('fanotify not available: {0}'.format(error))
+
+    assert detector._backend._fd is not None
@@ -0,0 +1,105 @@
+import mock
+import pytest
+
+from fsdetect import Detector, PrometheusExporter
+
+
+def test_should_report_watches_and_queues_without_metrics(tmpdir):
+    tmpdir.mkdir('sub')
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', mock.Mock(return_value=None))
+    stats = detector.stats()
+
+    assert stats['watches'] == 2
+    assert stats['max_user_watches'] > 0
+    assert stats['queue_depth']['moves'] == 0
+    assert 'events_received' not in stats
+
+
+def test_should_count_events_and_time_handlers(tmpdir):
+    def on_create(event):
+        pass
+
+    detector = Detector(str(tmpdir), metrics=True)
+    detector.on('create', on_create)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    tmpdir.join('.hidden').ensure(file=True)
+    detector.check()
+    stats = detector.stats()
+
+    assert stats['events_received'] == {'create': 2}
+    assert stats['events_ignored'] == 1
+    assert stats['events_dispatched'] == {'create': 1}
+    handler, = stats['handler_seconds'].values()
+    assert handler['count'] == 1
+    assert handler['buckets'][-1] == (float('inf'), 1)
+    assert stats['check_seconds']['count'] == 1
+
+
+def test_should_time_handlers_with_the_same_name_apart(tmpdir):
+    class Indexer(object):
+        def on_create(self, event):
+            pass
+
+    first, second = Indexer(), Indexer()
+    detector = Detector(str(tmpdir), metrics=True)
+    detector.on('create', first.on_create).on('create', second.on_create)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+    names = sorted(detector.stats()['handler_seconds'])
+
+    assert len(names) == 2
+    assert names[1] == names[0] + '#2'
+
+
+def test_should_keep_handler_chain_results_with_metrics(tmpdir):
+    first = mock.Mock(return_value=True)
+    second = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir), metrics=True)
+    detector.on('create', first).on('create', second)
+
+    tmpdir.join('file.txt').ensure(file=True)
+    detector.check()
+
+    assert first.call_count == 1
+    assert second.call_count == 0
+
+
+def test_should_export_prometheus_text_to_file(tmpdir):
+    path = tmpdir.join('metrics.prom')
+
+    detector = Detector(str(tmpdir.mkdir('tree')), metrics=True)
+    detector.on('create', mock.Mock(return_value=None))
+    detector.add_exporter(PrometheusExporter(str(path)), interval=60)
+
+    tmpdir.join('tree', 'file.txt').ensure(file=True)
+    detector.check()
+    text = path.read()
+
+    assert '# TYPE fsdetect_watches gauge\nfsdetect_watches 1\n' in text
+    assert 'fsdetect_events_received_total{event="create"} 1\n' in text
+    # including the check() that exported it
+    assert 'fsdetect_check_seconds_bucket{le="+Inf"} 1\n' in text
+    assert 'fsdetect_queue_depth{queue="moves"} 0\n' in text
+
+
+def test_should_call_exporters_once_per_interval(tmpdir):
+    exporter = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', mock.Mock(return_value=None))
+    detector.add_exporter(exporter, interval=60)
+    detector.check()
+    detector.check()
+
+    assert exporter.call_count == 1
+    assert exporter.call_args[0][0]['watches'] == 1
+
+
+def test_prometheus_exporter_requires_path_or_callback():
+    with pytest.raises(ValueError):
+        PrometheusExporter()
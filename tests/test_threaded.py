@@ -0,0 +1,126 @@
+import threading
+import time
+
+import mock
+import pytest
+
+from fsdetect import Detector
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_should_fire_handlers_from_thread_pool_after_start(tmpdir):
+    threads = []
+
+    def on_create(event):
+        threads.append(threading.current_thread())
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create)
+    detector.start(workers=2)
+    try:
+        tmpdir.join('file1.txt').ensure(file=True)
+        tmpdir.join('file2.txt').ensure(file=True)
+        wait_for(lambda: len(threads) == 2)
+    finally:
+        detector.stop()
+
+    assert threading.current_thread() not in threads
+
+
+def test_should_handle_events_for_same_path_in_order(tmpdir):
+    calls = []
+
+    def on_create(event):
+        time.sleep(0.05)
+        calls.append('create')
+
+    def on_delete(event):
+        calls.append('delete')
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create) \
+            .on('delete', on_delete)
+    detector.start(workers=4)
+    try:
+        tmpdir.join('file.txt').ensure(file=True)
+        tmpdir.join('file.txt').remove()
+        wait_for(lambda: len(calls) == 2)
+    finally:
+        detector.stop()
+
+    assert calls == ['create', 'delete']
+
+
+def test_should_keep_handler_chain_semantics(tmpdir):
+    on_create1 = mock.Mock(return_value=True)
+    on_create2 = mock.Mock(return_value=None)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create1) \
+            .on('create', on_create2)
+    detector.start()
+    tmpdir.join('file.txt').ensure(file=True)
+    wait_for(lambda: on_create1.call_count == 1)
+    detector.stop()
+
+    assert on_create2.call_count == 0
+
+
+def test_should_wait_pending_events_on_stop(tmpdir):
+    calls = []
+
+    def on_create(event):
+        time.sleep(0.01)
+        calls.append(event.pathname)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create)
+    detector.start(workers=1)
+    for i in range(5):
+        tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+    wait_for(lambda: calls)
+    detector.stop(wait=True)
+
+    assert len(calls) == 5
+
+
+def test_should_drop_oldest_waiting_events_when_full(tmpdir):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def on_create(event):
+        started.set()
+        release.wait(2)
+        calls.append(event.pathname)
+
+    detector = Detector(str(tmpdir))
+    detector.on('create', on_create)
+    detector.start(workers=1, max_pending=2, overflow='drop_oldest')
+    try:
+        tmpdir.join('file0.txt').ensure(file=True)
+        started.wait(2)
+        for i in range(1, 5):
+            tmpdir.join('file{0}.txt'.format(i)).ensure(file=True)
+        wait_for(lambda: detector._dispatcher.dropped == 3)
+        release.set()
+        wait_for(lambda: len(calls) == 2)
+    finally:
+        release.set()
+        detector.stop()
+
+    # first one was already running, only the last one still waited
+    assert calls == [str(tmpdir.join('file0.txt')), str(tmpdir.join('file4.txt'))]
+
+
+def test_should_not_allow_invalid_overflow_mode(tmpdir):
+    detector = Detector(str(tmpdir))
+
+    with pytest.raises(ValueError):
+        detector.start(overflow='explode')